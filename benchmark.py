@@ -0,0 +1,452 @@
+"""
+This script benchmarks the stages of the ETL process (extract, transform, load
+and monitoring views) on synthetic data, to measure how the pipeline scales.
+Users, subscriptions and messages with the same shape as the records of the
+API (PII fields, 'profile' and 'subscription' included) are generated at the
+requested sizes and served by a local stand-in of the API, and the data is
+loaded to a MySQL server, which should be a scratch server as the benchmark
+writes to (and with --reset-database drops) the database 'spark_dwh'.
+
+For each size and stage, the wall time, rows per second, database round trips
+(statements sent), API requests and peak memory (RSS) of the process are
+printed and saved to a JSON file, so that runs can be compared.
+
+Example:
+    python benchmark.py --sizes 1000 100000 --db-host 127.0.0.1 \\
+        --db-password p@ssw0rd1 --reset-database --output results.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from tabulate import tabulate
+import metrics
+from connectors import (MySqlDbConnector, SparkApiConnector,
+                        format_api_timestamp)
+from response_cache import ResponseCache
+from load import (LoadSummary, insert_message_data, insert_subscription_data,
+                  insert_user_data)
+from masking import MASKING_STRATEGIES, create_masker
+from columnar import compare_with_row_path, transform_users_columnar
+from rollups import create_rollup_tables
+from transform import (create_monitoring_views, get_subscription_data,
+                       sanitize_sensitive_data_users)
+
+
+FIRST_NAMES = ['Anna', 'Ben', 'Carla', 'David', 'Eva', 'Felix', 'Greta',
+               'Hugo', 'Ines', 'Jonas', 'Klara', 'Lukas', 'Mia', 'Noah']
+LAST_NAMES = ['Schmidt', 'Garcia', 'Rossi', 'Martin', 'Novak', 'Jensen',
+              'Silva', 'Dubois', 'Kowalski', 'Murphy']
+COUNTRIES = ['DE', 'ES', 'IT', 'FR', 'AT', 'PL', 'NL', 'PT']
+PROFESSIONS = [f'profession {idx}' for idx in range(50)]
+CITIES = [f'city {idx}' for idx in range(200)]
+SUBSCRIPTION_STATUSES = ['Active', 'Inactive', 'Rejected']
+# the number of users on which the columnar path is checked against the row path
+PARITY_CHECK_USERS = 10000
+
+
+def generate_users(num_users, start_time, rng):
+    """
+    Function to generate user records shaped as the records of the users API
+    end point, each with zero to three subscriptions.
+
+    :param num_users: The number of users to generate.
+    :param start_time: The creation time of the first user.
+    :param rng: The random.Random instance to draw the values from.
+    """
+    num_zipcodes = max(1, num_users // 5)
+    users = []
+    for user_id in range(1, num_users + 1):
+        created_at = start_time + timedelta(minutes=user_id)
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        subscriptions = []
+        for _ in range(rng.choice([0, 1, 1, 2, 3])):
+            start_date = created_at + timedelta(days=rng.randint(0, 365))
+            subscriptions.append({
+                'createdAt': format_api_timestamp(start_date),
+                'startDate': format_api_timestamp(start_date),
+                'endDate': format_api_timestamp(
+                    start_date + timedelta(days=rng.choice([30, 90, 365]))),
+                'status': rng.choice(SUBSCRIPTION_STATUSES),
+                'amount': f'{rng.uniform(5, 50):.2f}'})
+        users.append({
+            'id': str(user_id),
+            'createdAt': format_api_timestamp(created_at),
+            'updatedAt': format_api_timestamp(
+                created_at + timedelta(hours=rng.randint(0, 1000))),
+            'firstName': first_name,
+            'lastName': last_name,
+            'address': f'{rng.randint(1, 200)} Main Street',
+            'city': rng.choice(CITIES),
+            'country': rng.choice(COUNTRIES),
+            'zipCode': f'{rng.randrange(num_zipcodes):05d}',
+            'email': f'{first_name}.{last_name}{user_id}@example.com'.lower(),
+            'birthDate': format_api_timestamp(
+                datetime(1960, 1, 1) + timedelta(days=rng.randint(0, 15000))),
+            'profile': {'gender': rng.choice(['male', 'female', 'other']),
+                        'isSmoking': rng.random() < 0.2,
+                        'profession': rng.choice(PROFESSIONS),
+                        'income': f'{rng.uniform(1000, 9000):.2f}'},
+            'subscription': subscriptions})
+    return users
+
+
+def generate_messages(num_messages, num_users, start_time, rng):
+    """
+    Function to generate message records shaped as the records of the messages
+    API end point, sent between random users.
+
+    :param num_messages: The number of messages to generate.
+    :param num_users: The number of users sending / receiving the messages.
+    :param start_time: The creation time of the first message.
+    :param rng: The random.Random instance to draw the values from.
+    """
+    return [{'id': str(message_id),
+             'createdAt': format_api_timestamp(
+                 start_time + timedelta(seconds=30 * message_id)),
+             'message': 'lorem ipsum ' * rng.randint(1, 10),
+             'senderId': str(rng.randint(1, num_users)),
+             'receiverId': str(rng.randint(1, num_users))}
+            for message_id in range(1, num_messages + 1)]
+
+
+class _StandInApiHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the stand-in API, serving the pages of the records of the
+    server's data sets, with the 'page', 'limit', 'sortBy' and 'order' query
+    parameters of the real API. The pages are served with an ETag, and
+    answered with 304 Not Modified when requested with the same If-None-Match.
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        records = self.server.data_sets.get(url.path.strip('/'))
+        if records is None:
+            self.send_error(404)
+            return
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        sort_by = params.get('sortBy')
+        if sort_by:
+            records = self.server.sorted_records(url.path.strip('/'), sort_by,
+                                                 params.get('order') == 'desc')
+        limit = int(params.get('limit', len(records) or 1))
+        page = int(params.get('page', 1))
+        body = json.dumps(records[(page - 1) * limit:page * limit]).encode()
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInApiServer(ThreadingHTTPServer):
+    """
+    Local HTTP server standing in for the API, serving the users and messages
+    generated for the benchmark at http://127.0.0.1:<port>/users and
+    /messages.
+    """
+    daemon_threads = True
+
+    def __init__(self, users, messages):
+        """
+        :param users: The user records to serve.
+        :param messages: The message records to serve.
+        """
+        super().__init__(('127.0.0.1', 0), _StandInApiHandler)
+        self.data_sets = {'users': users, 'messages': messages}
+        self._sorted = {}
+        self._sorted_lock = threading.Lock()
+
+    def sorted_records(self, name, sort_by, descending):
+        """
+        Method to get the records of a data set sorted on a field, computed once
+        per field and order.
+
+        :param name: The name of the data set, 'users' or 'messages'.
+        :param sort_by: The field to sort the records on.
+        :param descending: Sort in descending order.
+        """
+        key = (name, sort_by, descending)
+        with self._sorted_lock:
+            if key not in self._sorted:
+                self._sorted[key] = sorted(
+                    self.data_sets[name],
+                    key=lambda record: (record.get(sort_by) or '',
+                                        int(record['id'])),
+                    reverse=descending)
+            return self._sorted[key]
+
+    def end_point(self, name):
+        """
+        Method to get the url of the end point of a data set.
+
+        :param name: The name of the data set, 'users' or 'messages'.
+        """
+        return f'http://127.0.0.1:{self.server_address[1]}/{name}'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def peak_rss_mb():
+    """
+    Function to get the peak resident memory of the process so far, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+class StageTimer:
+    """
+    This class measures the stages of a benchmark run: wall time, rows per
+    second, database statements and API requests sent during the stage, and
+    the peak memory of the process at its end.
+    """
+    def __init__(self, size):
+        """
+        :param size: The size of the benchmark run the stages belong to.
+        """
+        self._size = size
+        self.results = []
+
+    def run(self, stage, function, count_rows):
+        """
+        Method to run and measure a stage.
+
+        :param stage: The name of the stage.
+        :param function: The function running the stage, without arguments.
+        :param count_rows: A function returning the number of rows processed
+                           by the stage from its result.
+        :return: The result of the stage function.
+        """
+        statements = metrics.REGISTRY.total('db_statements_total')
+        requests_sent = metrics.REGISTRY.total('api_requests_total')
+        start = time.perf_counter()
+        result = function()
+        wall_time = time.perf_counter() - start
+        rows = count_rows(result)
+        self.results.append({
+            'size': self._size,
+            'stage': stage,
+            'rows': rows,
+            'wall_time_s': round(wall_time, 3),
+            'rows_per_s': round(rows / wall_time, 1) if wall_time else None,
+            'db_round_trips': (metrics.REGISTRY.total('db_statements_total') -
+                               statements),
+            'api_requests': (metrics.REGISTRY.total('api_requests_total') -
+                             requests_sent),
+            'peak_rss_mb': round(peak_rss_mb(), 1)})
+        print(f'{stage} ({self._size}): {rows} rows in {wall_time:.2f}s')
+        return result
+
+
+def check_columnar_parity(users_data, masker):
+    """
+    Function to check that the columnar transform path gives the same records
+    as the row path (see columnar.compare_with_row_path), exiting with an error
+    listing the first differences otherwise.
+
+    :param users_data: The users coming from the API.
+    :param masker: The masker used by the transform stage.
+    """
+    differences = compare_with_row_path(users_data, masker)
+    if differences:
+        for table, idx, row_record, columnar_record in differences[:10]:
+            print(f'{table} record {idx} differs:\n  row path:      '
+                  f'{row_record}\n  columnar path: {columnar_record}')
+        sys.exit(f'the columnar transform path differs from the row path for '
+                 f'{len(differences)} records')
+    print(f'columnar transform path checked against the row path on '
+          f'{len(users_data)} users')
+
+
+def run_benchmark(size, db_connector, args):
+    """
+    Function to run the ETL stages once on generated data of a given size.
+
+    :param size: The number of messages to generate, with one user per
+                 args.messages_per_user messages.
+    :param db_connector: The database connector (connected as root).
+    :param args: The parsed command line arguments.
+    :return: The list of the measures of each stage.
+    """
+    rng = random.Random(args.seed + size)
+    num_users = max(1, size // args.messages_per_user)
+    start_time = datetime(2021, 1, 1)
+    print(f'generating {num_users} users and {size} messages')
+    generation_start = time.perf_counter()
+    users = generate_users(num_users, start_time, rng)
+    messages = generate_messages(size, num_users, start_time, rng)
+    print(f'generated in {time.perf_counter() - generation_start:.2f}s')
+
+    response_cache = (ResponseCache(os.path.join(args.response_cache_dir,
+                                                 str(size)))
+                      if args.response_cache_dir else None)
+    with StandInApiServer(users, messages) as server:
+        api_connector = SparkApiConnector(
+            page_size=args.page_size,
+            requests_per_second=None,
+            users_end_point=server.end_point('users'),
+            messages_end_point=server.end_point('messages'),
+            response_cache=response_cache)
+        timer = StageTimer(size)
+        masker = create_masker(args.masking_strategy, db_connector,
+                               masking_secret='benchmark secret')
+
+        api_users_data, api_messages_data = timer.run(
+            'extract', api_connector.fetch_users_and_messages_data,
+            lambda result: len(result[0]) + len(result[1]))
+        if response_cache is not None:
+            # all the pages are now cached: conditional requests answered
+            # with 304, then the pages read from the cache without requests
+            timer.run('extract_not_modified',
+                      api_connector.fetch_users_and_messages_data,
+                      lambda result: len(result[0]) + len(result[1]))
+            replay_connector = SparkApiConnector(
+                page_size=args.page_size,
+                users_end_point=server.end_point('users'),
+                messages_end_point=server.end_point('messages'),
+                response_cache=response_cache, replay=True)
+            timer.run('extract_replay',
+                      replay_connector.fetch_users_and_messages_data,
+                      lambda result: len(result[0]) + len(result[1]))
+
+        def transform():
+            if args.columnar:
+                return transform_users_columnar(api_users_data, masker)
+            subscriptions = get_subscription_data(api_users_data)
+            sanitized_users = sanitize_sensitive_data_users(
+                api_users_data, root_password=args.db_password,
+                db_connector=db_connector, masker=masker)
+            return sanitized_users, subscriptions
+
+        sanitized_users, subscriptions = timer.run(
+            'transform', transform, lambda result: len(result[0]))
+
+        def load():
+            summary = LoadSummary()
+            # the columnar path gives the users_raw / subscriptions_raw records
+            prepared = {'prepared': True} if args.columnar else {}
+            for insert_function, data, options in [
+                    (insert_user_data, sanitized_users, prepared),
+                    (insert_subscription_data, subscriptions, prepared),
+                    (insert_message_data, api_messages_data, {})]:
+                insert_function(data, 'root', args.db_password,
+                                db_connector=db_connector, summary=summary,
+                                update_rollups=args.rollups, **options)
+            return summary
+
+        timer.run('load', load,
+                  lambda _: (len(sanitized_users) + len(subscriptions) +
+                             len(api_messages_data)))
+        timer.run('monitoring', lambda: create_monitoring_views(
+            'root', args.db_password, db_connector=db_connector),
+                  lambda _: 0)
+        if args.columnar:
+            check_columnar_parity(api_users_data[:PARITY_CHECK_USERS], masker)
+        masker.close()
+    return timer.results
+
+
+def parse_args():
+    """
+    Parse the command line arguments of the benchmark script.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ETL stages on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 100000],
+                        help='Numbers of messages to generate, one run each '
+                             '(e.g. 1000 100000 1000000).')
+    parser.add_argument('--messages-per-user', type=int, default=10,
+                        help='Number of messages generated per user.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the data generator.')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='Number of records requested per page.')
+    parser.add_argument('--masking-strategy', choices=MASKING_STRATEGIES,
+                        default='auto_increment')
+    parser.add_argument('--db-host', default='127.0.0.1')
+    parser.add_argument('--db-port', type=int, default=3306)
+    parser.add_argument('--db-password', required=True,
+                        help='Root password of the (scratch) MySQL server.')
+    parser.add_argument('--reset-database', action='store_true',
+                        help='Drop and create the database before each run, '
+                             'so that all the records are new.')
+    parser.add_argument('--typed-schema', action='store_true',
+                        help='Use the typed raw tables.')
+    parser.add_argument('--local-infile-dir', default=None,
+                        help='Enable the bulk loader, writing its files to '
+                             'this directory.')
+    parser.add_argument('--response-cache-dir', default=None,
+                        help='Store the API responses in this directory, and '
+                             'also measure the extraction with conditional '
+                             'requests and in replay mode.')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Use the columnar transform path (requires '
+                             'pandas), and check that it gives the same '
+                             'records as the row path.')
+    parser.add_argument('--rollups', action='store_true',
+                        help='Update the rollup tables while loading.')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='JSON file the results are written to.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    db_connector = MySqlDbConnector(username='root',
+                                    password=args.db_password,
+                                    host=args.db_host,
+                                    port=args.db_port,
+                                    local_infile_dir=args.local_infile_dir)
+    db_connector.check_db_availability(max_retries=2)
+
+    results = []
+    for size in args.sizes:
+        db_connector.initialise_db_and_create_tables(
+            drop_if_exists=args.reset_database,
+            typed_schema=args.typed_schema)
+        if args.rollups:
+            create_rollup_tables(db_connector)
+        results.extend(run_benchmark(size, db_connector, args))
+    db_connector.close()
+
+    print(tabulate(results, headers='keys'))
+    with open(args.output, 'w') as file:
+        json.dump({'created_at': datetime.now().isoformat(),
+                   'python': platform.python_version(),
+                   'arguments': {k: v for k, v in vars(args).items()
+                                 if k != 'db_password'},
+                   'results': results},
+                  file, indent=2)
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+This script measures the memory and CPU time saved by the compact record types
+of records.py, compared to the dictionaries the messages were held and
+prepared as before, on generated messages (see benchmark.py). It needs no
+database or API server.
+
+For each representation of the extracted messages (the API dictionaries, the
+dictionaries of the messages_raw columns, MessageRecords and a MessageBatch),
+the memory held by the records (traced with tracemalloc) and the CPU time to
+build them are measured, as well as the CPU time of the preparation done by
+the loader for the VARCHAR tables (str values and row fingerprint, see
+load._insert_data), checking that both preparations give the same rows. The
+results are scaled to one million messages.
+
+Example:
+    python benchmark_records.py --messages 1000000
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from datetime import datetime
+from tabulate import tabulate
+from benchmark import generate_messages
+from connectors import compute_row_hash
+from load import prepare_message_records
+from records import MessageBatch, str_record
+
+
+def prepare_message_dicts(message_data):
+    """
+    Function converting the messages to the dictionaries of the messages_raw
+    columns, as prepare_message_records did before the record types.
+
+    :param message_data: An iterable of messages as obtained from the API.
+    """
+    for record in message_data:
+        yield {'id': record.get('id'),
+               'created_at': record.get('createdAt'),
+               'receiver_id': record.get('receiverId'),
+               'sender_id': record.get('senderId')}
+
+
+def _prepare_dict_for_load(record, load_time):
+    """
+    The preparation of a record for a VARCHAR table by the loader before the
+    record types: a copy with str values and the row fingerprint.
+    """
+    record['last_updated_at'] = load_time
+    prepared = {k: str(v) for k, v in record.items()}
+    prepared['row_hash'] = compute_row_hash(prepared)
+    return prepared
+
+
+def _prepare_record_for_load(record, load_time):
+    """
+    The preparation of a record for a VARCHAR table by the loader with the
+    record types (see load._insert_data).
+    """
+    record['last_updated_at'] = load_time
+    prepared = str_record(record)
+    prepared['row_hash'] = compute_row_hash(record)
+    return prepared
+
+
+def measure(build):
+    """
+    Function to measure the memory held by the result of build, and the CPU
+    time taken to build it. As tracing the memory slows the allocations down,
+    the CPU time is measured on a second build, without tracing.
+
+    :param build: The function building the records, without arguments.
+    :return: A tuple with the result, the memory held (in bytes) and the CPU
+             time (in seconds).
+    """
+    gc.collect()
+    tracemalloc.start()
+    traced_result = build()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del traced_result
+    gc.collect()
+    start = time.process_time()
+    result = build()
+    cpu_time = time.process_time() - start
+    return result, memory, cpu_time
+
+
+def run(num_messages, seed=0):
+    """
+    Function running the measures on num_messages generated messages.
+
+    :return: The list of the measures of each representation.
+    """
+    api_messages, api_memory, _ = measure(lambda: generate_messages(
+        num_messages, max(1, num_messages // 10), datetime(2021, 1, 1),
+        random.Random(seed)))
+    scale = 1000000 / num_messages
+    results = [{'representation': 'API dictionaries',
+                'memory_mb_per_1m': round(api_memory * scale / 2 ** 20, 1),
+                'build_cpu_s_per_1m': None, 'prepare_cpu_s_per_1m': None}]
+
+    load_time = str(datetime.now())
+    prepared_rows = {}
+    for name, build, prepare in [
+            ('column dictionaries',
+             lambda: list(prepare_message_dicts(api_messages)),
+             _prepare_dict_for_load),
+            ('MessageRecord', lambda: list(prepare_message_records(
+                 api_messages)), _prepare_record_for_load),
+            ('MessageBatch', lambda: MessageBatch.from_api(api_messages),
+             _prepare_record_for_load)]:
+        records, memory, build_time = measure(build)
+        start = time.process_time()
+        prepared = [prepare(record, load_time) for record in records]
+        prepare_time = time.process_time() - start
+        prepared_rows[name] = [tuple(record.items()) for record in prepared]
+        del records, prepared
+        results.append({
+            'representation': name,
+            'memory_mb_per_1m': round(memory * scale / 2 ** 20, 1),
+            'build_cpu_s_per_1m': round(build_time * scale, 2),
+            'prepare_cpu_s_per_1m': round(prepare_time * scale, 2)})
+
+    reference = prepared_rows.pop('column dictionaries')
+    for name, rows in prepared_rows.items():
+        if rows != reference:
+            raise RuntimeError(f'the rows prepared from {name} differ from '
+                               f'the ones prepared from dictionaries')
+    return results
+
+
+def parse_args():
+    """
+    Parse the command line arguments of the record benchmark script.
+    """
+    parser = argparse.ArgumentParser(
+        description='Measure the memory and CPU time of the record types.')
+    parser.add_argument('--messages', type=int, default=200000,
+                        help='Number of messages to generate.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the data generator.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(tabulate(run(args.messages, seed=args.seed), headers='keys'))
@@ -0,0 +1,245 @@
+"""
+This module contains the columnar transform path of the users data, an
+alternative to the row by row functions of transform.py for large batches.
+The users, their profile and their subscriptions are flattened into columns in
+a single pass over the API records (the direct PII fields 'firstName',
+'lastName' and 'address' are never copied), and the email domains and masking
+ids are then computed column by column with pandas, rather than by copying and
+updating each user dictionary. The output is the records of the users_raw and
+subscriptions_raw tables, the same as prepare_user_records and
+prepare_subscription_records of load.py give for the row path (see
+compare_with_row_path).
+
+pandas is an optional dependency, only required when this path is used.
+"""
+import metrics
+from connectors import iter_batches
+from load import prepare_subscription_records, prepare_user_records
+from records import SubscriptionRecord, UserRecord
+from transform import get_subscription_data, sanitize_sensitive_data_users
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+# the columns of the users_raw records and the API fields they are read from
+USER_FIELDS = {'user_id': 'id',
+               'created_at': 'createdAt',
+               'updated_at': 'updatedAt',
+               'city_id': 'city',
+               'country': 'country',
+               'zipcode_id': 'zipCode',
+               'email': 'email',
+               'birth_date': 'birthDate'}
+PROFILE_FIELDS = {'gender': 'gender',
+                  'is_smoking': 'isSmoking',
+                  'profession_id': 'profession',
+                  'income': 'income'}
+SUBSCRIPTION_FIELDS = {'created_at': 'createdAt',
+                       'start_date': 'startDate',
+                       'end_date': 'endDate',
+                       'status': 'status',
+                       'amount': 'amount'}
+
+# the order of the columns of the prepared records, as in records.py
+USER_RECORD_COLUMNS = list(UserRecord.FIELDS)
+SUBSCRIPTION_RECORD_COLUMNS = list(SubscriptionRecord.FIELDS)
+
+
+def _require_pandas():
+    if pd is None:
+        raise ImportError('The columnar transform path requires pandas, '
+                          'install it with "pip install pandas".')
+
+
+def flatten_users(users_data):
+    """
+    Function to flatten the users coming from the API, with the fields of their
+    profile, and their subscriptions (with the id of the user) into two
+    DataFrames, in a single pass over the users. The columns are named as in
+    the users_raw / subscriptions_raw records and hold the values as they are
+    (object dtype), so that no value is converted by pandas. Emails that are
+    not strings are read as missing.
+
+    :param users_data: An iterable of dictionaries specifiying user data
+                       records as obtained directly from the API.
+    :return: A tuple with the users and the subscriptions DataFrames. The users
+             one also has a 'zipcode' column, with the value of the API field
+             of that name (as kept by the row path when zipCode is empty).
+    """
+    _require_pandas()
+    user_columns = {column: [] for column in
+                    list(USER_FIELDS) + list(PROFILE_FIELDS) + ['zipcode']}
+    subscription_columns = {column: [] for column
+                            in SUBSCRIPTION_RECORD_COLUMNS}
+    user_appends = [(user_columns[column].append, field)
+                    for column, field in USER_FIELDS.items()]
+    profile_appends = [(user_columns[column].append, field)
+                       for column, field in PROFILE_FIELDS.items()]
+    subscription_appends = [(subscription_columns[column].append, field)
+                            for column, field in SUBSCRIPTION_FIELDS.items()]
+    append_zipcode = user_columns['zipcode'].append
+    append_subscription_user = subscription_columns['user_id'].append
+    emails = user_columns['email']
+
+    for user_data in users_data:
+        get = user_data.get
+        for append, field in user_appends:
+            append(get(field))
+        if not isinstance(emails[-1], str):
+            emails[-1] = None
+        append_zipcode(get('zipcode'))
+        profile = get('profile') or {}
+        for append, field in profile_appends:
+            append(profile.get(field))
+        user_id = get('id')
+        for subscription in get('subscription') or ():
+            append_subscription_user(user_id)
+            for append, field in subscription_appends:
+                append(subscription.get(field))
+
+    return (pd.DataFrame(user_columns, dtype=object),
+            pd.DataFrame(subscription_columns, dtype=object))
+
+
+def _mask_column(column, field, masker):
+    """
+    Convenience function replacing the non-empty values of a column by their
+    masking ids, obtained from the masker for all the values at once and mapped
+    onto the column. The empty values are kept as they are.
+
+    :param column: The Series of values to mask.
+    :param field: The sensitive field of the masker, e.g. 'city'.
+    :param masker: The MaskIdCache or HmacMasker to get the masking ids from.
+    :return: A tuple with the masked Series and the boolean Series of the
+             values that were masked.
+    """
+    to_mask = column.astype(bool)
+    masked = column.copy()
+    if to_mask.any():
+        values = column[to_mask]
+        mask_ids = masker.get_ids(field, values.tolist())
+        masked[to_mask] = values.map(mask_ids).astype(object)
+    return masked, to_mask
+
+
+def sanitize_users_frame(users, masker):
+    """
+    Function to remove / mask the PII fields of a users DataFrame (see
+    flatten_users), as sanitize_sensitive_data_users does for the row path:
+    city, zipcode and profession are replaced by their masking ids and the
+    email by its domain. Users with an unmasked value left in a sensitive
+    column are dropped, as the loader does in the row path.
+
+    :param users: The users DataFrame, as returned by flatten_users.
+    :param masker: The MaskIdCache or HmacMasker to get the masking ids from.
+    :return: The sanitised users DataFrame, with the USER_RECORD_COLUMNS.
+    """
+    metrics.inc('users_sanitized_total', len(users))
+    sanitized = users.copy()
+    sanitized['city_id'], _ = _mask_column(users['city_id'], 'city', masker)
+    sanitized['profession_id'], _ = _mask_column(users['profession_id'],
+                                                 'profession', masker)
+    zipcode_ids, zipcode_masked = _mask_column(users['zipcode_id'], 'zipcode',
+                                               masker)
+    # as in the row path, the API field 'zipcode' is kept when zipCode is empty
+    sanitized['zipcode_id'] = zipcode_ids.where(zipcode_masked,
+                                                users['zipcode'])
+
+    emails = users['email']
+    has_domain = emails.str.contains('@', regex=False, na=False)
+    domains = emails.str.split('@', n=2).str[1]
+    domains[~has_domain] = None
+    sanitized['email'] = domains
+    metrics.inc('emails_without_domain_total', int((~has_domain).sum()))
+
+    unmasked_zipcodes = (~zipcode_masked &
+                         users['zipcode'].astype(bool) &
+                         ~users['zipcode'].map(lambda value:
+                                               isinstance(value, int)))
+    for _ in range(int(unmasked_zipcodes.sum())):
+        print('PII values not removed from data record! skipping insert!')
+    return sanitized.loc[~unmasked_zipcodes, USER_RECORD_COLUMNS]
+
+
+def frame_to_records(frame, record_type):
+    """
+    Function to convert a DataFrame into a list of records, keeping the values
+    as they are.
+
+    :param frame: The DataFrame to convert, with the columns of the records.
+    :param record_type: The type of the records, e.g. UserRecord.
+    """
+    return list(map(record_type, *[frame[column].tolist()
+                                   for column in record_type.FIELDS]))
+
+
+def transform_users_columnar(users_data, masker):
+    """
+    Function running the columnar transform path on a batch of users coming
+    from the API.
+
+    :param users_data: An iterable of dictionaries specifiying user data
+                       records as obtained directly from the API.
+    :param masker: The MaskIdCache or HmacMasker to get the masking ids from.
+    :return: A tuple with the list of users_raw records and the list of
+             subscriptions_raw records, to be loaded with prepared=True (see
+             insert_user_data and insert_subscription_data).
+    """
+    users, subscriptions = flatten_users(users_data)
+    users = sanitize_users_frame(users, masker)
+    return (frame_to_records(users, UserRecord),
+            frame_to_records(subscriptions, SubscriptionRecord))
+
+
+def iter_columnar_user_chunks(users_data, masker, chunk_size=1000):
+    """
+    Columnar version of transform.iter_sanitized_user_chunks, yielding for each
+    chunk of users the users_raw and subscriptions_raw records (see
+    transform_users_columnar).
+
+    :param users_data: An iterable of dictionaries specifiying user data
+                       records as obtained directly from the API.
+    :param masker: The MaskIdCache or HmacMasker to get the masking ids from.
+    :param chunk_size: The number of users per chunk.
+    """
+    for chunk in iter_batches(users_data, chunk_size):
+        yield transform_users_columnar(chunk, masker)
+
+
+def compare_with_row_path(users_data, masker):
+    """
+    Function to check that the columnar path gives the same records as the row
+    path (sanitize_sensitive_data_users and get_subscription_data, followed by
+    the prepare functions of load.py) for a list of users. The masker should
+    give the same id for the same value on every call, e.g. a MaskIdCache or
+    an HmacMasker.
+
+    :param users_data: A list of dictionaries specifiying user data records as
+                       obtained directly from the API.
+    :param masker: The MaskIdCache or HmacMasker to get the masking ids from.
+    :return: A list of (table, index, row path record, columnar record) tuples
+             for the records that differ, empty if both paths agree.
+    """
+    row_subscriptions = list(prepare_subscription_records(
+        get_subscription_data(users_data)))
+    row_users = list(prepare_user_records(sanitize_sensitive_data_users(
+        users_data, root_password=None, masker=masker)))
+    columnar_users, columnar_subscriptions = transform_users_columnar(
+        users_data, masker)
+
+    differences = []
+    for table, row_records, columnar_records in [
+            ('users_raw', row_users, columnar_users),
+            ('subscriptions_raw', row_subscriptions, columnar_subscriptions)]:
+        for idx in range(max(len(row_records), len(columnar_records))):
+            row_record = row_records[idx] if idx < len(row_records) else None
+            columnar_record = (columnar_records[idx]
+                               if idx < len(columnar_records) else None)
+            if row_record != columnar_record or \
+                    [type(value) for value in (row_record or {}).values()] != \
+                    [type(value) for value in (columnar_record or {}).values()]:
+                differences.append((table, idx, row_record, columnar_record))
+    return differences
@@ -2,13 +2,321 @@
 This module defines the connectors required to interact with the API as well as
 the database. In particular, this file defines two classes -
 -  the SparkApiConnector for interacting with the API end points and fetch
-   relevant data
+   relevant data (using the ConcurrentPageFetcher engine to send the requests)
 - the MysqlDbConnector for interacting with the MySQL database within which
    all the data fetched from the API will be stored.
 """
+import hashlib
+import json
+import random
 import time
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from functools import partial
+from itertools import count, islice
+from urllib.parse import urlparse
 import requests
-import mysql.connector
+from mysql.connector import pooling
+import metrics
+from json_stream import JSON_BACKENDS, iter_json_array
+from records import RawRecord
+
+
+def iter_batches(records, batch_size):
+    """
+    Convenience function to split an iterable of records into lists of at most
+    batch_size records.
+
+    :param records: The iterable of records to split.
+    :param batch_size: The maximum number of records in each batch.
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _collect(chunks, collected):
+    """
+    Convenience generator passing chunks on while adding them to collected.
+    """
+    for chunk in chunks:
+        collected.append(chunk)
+        yield chunk
+
+
+USERS_END_POINT = 'https://619ca0ea68ebaa001753c9b0.mockapi.io/evaluation/dataengineer/jr/v1/users'
+MESSAGES_END_POINT = 'https://619ca0ea68ebaa001753c9b0.mockapi.io/evaluation/dataengineer/jr/v1/messages'
+
+# the field of the records of each end point which tells when they were last
+# changed, used for incremental extraction.
+API_TIMESTAMP_FIELDS = {'users': 'updatedAt', 'messages': 'createdAt'}
+
+ROW_HASH_EXCLUDED_FIELDS = ('last_updated_at', 'row_hash')
+
+# the maximum number of keys looked up by a single statement (see
+# MySqlDbConnector.iter_records)
+MAX_IN_LIST_KEYS = 1000
+
+
+# typed definition of the raw tables, used when the warehouse is created (or
+# migrated) with typed_schema. Each table lists its columns with their SQL
+# types, followed by its keys.
+TYPED_RAW_TABLES = {
+    'users_raw': {
+        'columns': [('row_id', 'BIGINT NOT NULL AUTO_INCREMENT'),
+                    ('user_id', 'INT'),
+                    ('created_at', 'DATETIME(3)'),
+                    ('updated_at', 'DATETIME(3)'),
+                    ('city_id', 'BIGINT'),
+                    ('country', 'VARCHAR(255)'),
+                    ('zipcode_id', 'BIGINT'),
+                    ('email', 'VARCHAR(255)'),
+                    ('birth_date', 'DATE'),
+                    ('gender', 'VARCHAR(10)'),
+                    ('is_smoking', 'BOOLEAN'),
+                    ('profession_id', 'BIGINT'),
+                    ('income', 'DECIMAL(12,2)'),
+                    ('last_updated_at', 'DATETIME(6)'),
+                    ('row_hash', 'CHAR(64)')],
+        'keys': ['PRIMARY KEY (row_id)',
+                 'UNIQUE KEY uq_row_hash (row_hash)',
+                 'KEY idx_user_id (user_id, updated_at)',
+                 'KEY idx_created_at (created_at)']},
+    'subscriptions_raw': {
+        'columns': [('row_id', 'BIGINT NOT NULL AUTO_INCREMENT'),
+                    ('user_id', 'INT'),
+                    ('created_at', 'DATETIME(3)'),
+                    ('start_date', 'DATETIME(3)'),
+                    ('end_date', 'DATETIME(3)'),
+                    ('status', 'VARCHAR(32)'),
+                    ('amount', 'DECIMAL(12,2)'),
+                    ('last_updated_at', 'DATETIME(6)'),
+                    ('row_hash', 'CHAR(64)')],
+        'keys': ['PRIMARY KEY (row_id)',
+                 'UNIQUE KEY uq_row_hash (row_hash)',
+                 'KEY idx_user_id (user_id, start_date, end_date)',
+                 'KEY idx_created_at (created_at)']},
+    'messages_raw': {
+        'columns': [('row_id', 'BIGINT NOT NULL AUTO_INCREMENT'),
+                    ('created_at', 'DATETIME(3)'),
+                    ('receiver_id', 'INT'),
+                    ('id', 'INT NOT NULL'),
+                    ('sender_id', 'INT'),
+                    ('last_updated_at', 'DATETIME(6)'),
+                    ('row_hash', 'CHAR(64)')],
+        'keys': ['PRIMARY KEY (row_id)',
+                 'UNIQUE KEY uq_row_hash (row_hash)',
+                 'KEY idx_id (id)',
+                 'KEY idx_sender_id (sender_id, created_at)',
+                 'KEY idx_receiver_id (receiver_id)',
+                 'KEY idx_created_at (created_at)']},
+}
+
+
+def _varchar_to_typed_expression(column, sql_type):
+    """
+    Get the SQL expression converting a column of a VARCHAR raw table to its
+    typed counterpart, as loaded so far by the VARCHAR loader (Python str of
+    the API values, 'None' for missing values).
+
+    :param column: The name of the column.
+    :param sql_type: The SQL type of the column in the typed table.
+    """
+    value = f"NULLIF({column}, 'None')"
+    if sql_type.startswith('DATETIME'):
+        return (f"CAST(REPLACE(REPLACE({value}, 'T', ' '), 'Z', '') "
+                f"AS {sql_type.split()[0]})")
+    if sql_type.startswith('DATE'):
+        return f'CAST(LEFT({value}, 10) AS DATE)'
+    if sql_type.startswith('BOOLEAN'):
+        return (f"CASE LOWER({column}) WHEN 'true' THEN 1 "
+                f"WHEN 'false' THEN 0 END")
+    if sql_type.startswith(('INT', 'BIGINT')):
+        return f'CAST({value} AS SIGNED)'
+    if sql_type.startswith('DECIMAL'):
+        return f'CAST({value} AS {sql_type})'
+    if column == 'row_hash':
+        return column
+    return value
+
+
+def parse_api_timestamp(value):
+    """
+    Parse a timestamp as found in the API records (for example
+    '2021-11-22T10:15:00.000Z') into a naive datetime in UTC. Returns None if
+    the value cannot be parsed.
+
+    :param value: The timestamp string to parse.
+    """
+    try:
+        timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def format_api_timestamp(timestamp):
+    """
+    Format a naive datetime in UTC the same way as the timestamps of the API
+    records.
+
+    :param timestamp: The datetime to format.
+    """
+    return (timestamp.strftime('%Y-%m-%dT%H:%M:%S.') +
+            f'{timestamp.microsecond // 1000:03d}Z')
+
+
+def record_position(record, timestamp_field):
+    """
+    Get the position of an API record in the order used for incremental
+    extraction: by timestamp, then by id (numerically if possible).
+
+    :param record: The API record (as dictionary).
+    :param timestamp_field: The field holding the timestamp of the record.
+    """
+    record_id = str(record.get('id'))
+    id_key = (0, int(record_id), '') if record_id.isdigit() else (1, 0, record_id)
+    timestamp = parse_api_timestamp(record.get(timestamp_field))
+    return timestamp or datetime.min, id_key
+
+
+def compute_row_hash(record):
+    """
+    Compute the fingerprint of a record, used to detect records that were
+    already loaded to a table. Its canonical form is the SHA-256 (lower case
+    hex) of the UTF-8 encoding of the values of all the fields of the record
+    except ROW_HASH_EXCLUDED_FIELDS, sorted by field name, as their str (None
+    giving 'None', an empty string being kept) and joined by the unit separator
+    character (U+001F). row_hash_sql computes the same value in SQL.
+
+    :param record: The record (as dictionary) to compute the fingerprint for.
+    """
+    if isinstance(record, RawRecord):
+        values = map(str, record.sorted_values())
+    else:
+        values = [str(record[field]) for field in sorted(record)
+                  if field not in ROW_HASH_EXCLUDED_FIELDS]
+    return hashlib.sha256('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+
+def row_hash_sql(columns):
+    """
+    Function to get the SQL expression computing the fingerprint of the rows of
+    a table of VARCHAR columns in the canonical form of compute_row_hash: the
+    NULL values are replaced by 'None' (rather than skipped by CONCAT_WS) and
+    all the values are converted to utf8mb4, so that the hashed bytes are their
+    UTF-8 encoding whatever the character set of the columns.
+
+    :param columns: The columns of the table.
+    """
+    values = ', '.join(f"CONVERT(COALESCE({column}, 'None') USING utf8mb4)"
+                       for column in sorted(columns)
+                       if column not in ROW_HASH_EXCLUDED_FIELDS)
+    return f'SHA2(CONCAT_WS(CHAR(31 USING utf8mb4), {values}), 256)'
+
+
+def _in_list_size(num_keys):
+    """
+    Convenience function to get the number of keys of the IN-list of a lookup
+    of num_keys keys: the next power of two, up to MAX_IN_LIST_KEYS. The
+    IN-list is padded to that size by repeating a key, so that the lookups of
+    any number of keys use a handful of statement shapes, each prepared once
+    per connection (see PreparedStatements).
+
+    :param num_keys: The number of keys to look up, at most MAX_IN_LIST_KEYS.
+    """
+    size = 1
+    while size < num_keys:
+        size *= 2
+    return min(size, MAX_IN_LIST_KEYS)
+
+
+class PreparedStatements:
+    """
+    This class holds the prepared statements executed on a connection checked
+    out from the pool, each in its own prepared cursor. A statement executed
+    again with the same query (see MySqlDbConnector._select_statement, which
+    gives the same query for the same statement shape) is only sent with its
+    parameters, without being parsed again by the server. The rows of a
+    prepared cursor are read from the server as they are fetched, rather than
+    buffered in the client.
+
+    The statements are deallocated on close, which must happen before the
+    connection is returned to the pool.
+    """
+    def __init__(self, db_connector, db_conn):
+        """
+        :param db_connector: The MySqlDbConnector executing the statements.
+        :param db_conn: The connection on which the statements are prepared.
+        """
+        self._db_connector = db_connector
+        self._db_conn = db_conn
+        self._cursors = {}
+        self._last_cursor = None
+
+    def execute(self, query, params=(), trace=True):
+        """
+        Method to execute a statement, prepared on first use.
+
+        :param query: The statement, with %s placeholders.
+        :param params: The parameters of the statement.
+        :param trace: Trace the statement when it is executed, see
+                      MySqlDbConnector._execute.
+        :return: The cursor of the statement, from which to fetch its rows.
+        """
+        cursor = self._cursors.get(query)
+        if cursor is None:
+            metrics.inc('db_prepared_statements_total')
+            cursor = self._cursors[query] = self._db_conn.cursor(prepared=True)
+        self._last_cursor = cursor
+        self._db_connector._execute(cursor, query, list(params), trace=trace)
+        return cursor
+
+    @property
+    def description(self):
+        """
+        The description of the columns of the last statement executed.
+        """
+        return self._last_cursor.description
+
+    def close(self):
+        """
+        Method to deallocate all the statements, once the rows left unread (if
+        the iteration over them was stopped early) are discarded.
+        """
+        if self._last_cursor is not None and self._db_conn.unread_result:
+            while self._last_cursor.fetchmany(MAX_IN_LIST_KEYS):
+                pass
+        for cursor in self._cursors.values():
+            cursor.close()
+        self._cursors = {}
+        self._last_cursor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _pooled_connection(db_conn):
+    """
+    Convenience function to get the connection wrapped by a connection checked
+    out from a pool: a new wrapper is returned by each checkout, while the
+    connection itself stays the same, also when it is reconnected (which
+    changes its connection_id).
+    """
+    return getattr(db_conn, '_cnx', db_conn)
 
 
 class MySqlDbConnector:
@@ -17,36 +325,68 @@ class MySqlDbConnector:
     interacting with the database. In particular, this class provides
     following functionalities via the its public methods:
     - Insert records to a table in the database
-    - Fetch records from a table in a database based on certain constraints
+    - Fetch records from a table in a database based on certain constraints,
+      or stream them with parameterised, prepared statements (iter_records)
     - Write sensitive PII information in the database within access restricted
       tables, and create masking IDs for the same.
       The masking IDs will be later made public to external users.
     - Create a view within the database based on a user specified query
 
+    All the database calls of a connector object share a size-bounded pool of
+    connections per database, so a single connector object should be created
+    and passed around rather than one per operation.
+
+    Bulk loading files with LOAD DATA LOCAL INFILE (see bulk_load_file) is only
+    allowed when a local_infile_dir is given, and only for the files within
+    that directory.
+
+    All the statements can be traced by passing a query_tracer (see
+    tracing.QueryTracer), called as query_tracer.record(query, duration,
+    rows=..., params_count=...) after each statement.
     """
+    # deadlock and lock wait timeout, after which a transaction can be retried
+    RETRY_ERROR_CODES = (1213, 1205)
+    # LOAD DATA LOCAL INFILE disabled by the server (1148, 3948) or rejected by
+    # the client (2068), after which the records can be inserted in batches
+    LOCAL_INFILE_ERROR_CODES = (1148, 3948, 2068)
+
     def __init__(self,
                  username,
                  password,
                  host='mysqldbprod',
                  port=3306,
-):
+                 pool_size=5,
+                 idle_check_seconds=30,
+                 local_infile_dir=None,
+                 query_tracer=None):
         self._host = host
         self._port = port
         self._username = username
         self._password = password
-        self._db_conn = None
+        self._pool_size = pool_size
+        self._idle_check_seconds = idle_check_seconds
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self._pool_slots = {}
+        # the time each connection was returned to its pool, dropped with the
+        # connection
+        self._last_used = weakref.WeakKeyDictionary()
+        self._table_columns = {}
+        self._statements = {}
+        self._local_infile_dir = local_infile_dir
+        self._query_tracer = query_tracer
 
-    def _initialise_db_connection(self, 
-                                  database=None,
-                                  max_retries=10, 
-                                  log_success=False,
-                                  exit_if_unavailable=False):
+    def _create_pool(self,
+                     database=None,
+                     max_retries=10,
+                     log_success=False,
+                     exit_if_unavailable=False):
         """
-        Convenience method to be set up a connection to the database.
+        Convenience method to set up a pool of connections to the database.
 
-        :param database: The name of the database to which the connection is to
-                         be set up. If not provided, a generic conenction to 
-                         server is created.
+        :param database: The name of the database to which the connections are
+                         to be set up. If not provided, generic connections to 
+                         the server are created.
         :param max_retries: The number of times to attempt to connect to the 
                             database before declaring failure
         :param log_sucess: Bool value to print a log message if the database
@@ -55,46 +395,131 @@ class MySqlDbConnector:
                                     calling program if database cannot be 
                                     connected to
         """
-        if self._db_conn:
-            return True
         tries = 0
 
         conn_args = {'host': self._host,
                     'port': self._port,
                     'user': self._username,
                     'password': self._password,
-                    'database': database}
+                    'database': database,
+                    'allow_local_infile_in_path': self._local_infile_dir}
         conn_args = {k: v for k, v in conn_args.items() if v}
+        pool_name = f'spark_{id(self)}_{database or "server"}'
 
+        db_pool = None
         while tries <= max_retries:
             try:
-                db_conn = mysql.connector.connect(**conn_args)
+                db_pool = pooling.MySQLConnectionPool(pool_name=pool_name,
+                                                      pool_size=self._pool_size,
+                                                      **conn_args)
             except Exception as error:
                 print(f'Cannot connect to database due to error {error}. Retrying...')
                 tries += 1
-                db_conn = None
+                db_pool = None
                 time.sleep(5)
                 continue
-            if db_conn:
-                if log_success:
-                    print('Successfully connected to database!')
-                break
+            if log_success:
+                print('Successfully connected to database!')
+            break
         
-        if not db_conn:
+        if not db_pool:
             print('Unable to connect to database after multiple attempts!')
             if exit_if_unavailable:
                 print('Exiting program!')
                 exit(1)
+            raise ConnectionError('Unable to connect to database!')
         
-        self._db_conn = db_conn
+        return db_pool
+
+    def _get_pool(self, database=None, **pool_args):
+        """
+        Convenience method to get the connection pool for a database, creating
+        it on first use. A single pool per database is shared by all the
+        methods of the connector.
+
+        :param database: The name of the database the pool connects to.
+        :param pool_args: Further arguments passed on to _create_pool.
+        """
+        with self._pools_lock:
+            if database not in self._pools:
+                self._pools[database] = self._create_pool(database=database,
+                                                          **pool_args)
+            return self._pools[database]
+
+    def _get_pool_slots(self, database=None):
+        """
+        Convenience method to get the semaphore bounding the connections
+        checked out from the pool of a database. Each database has its own
+        slots, so that a thread holding a connection to one database can
+        always check out a connection to another one (e.g. the masking tables
+        while writing a batch).
+
+        :param database: The name of the database the pool connects to.
+        """
+        with self._pools_lock:
+            if database not in self._pool_slots:
+                self._pool_slots[database] = threading.BoundedSemaphore(
+                    self._pool_size)
+            return self._pool_slots[database]
+
+    def _close_pool(self, database=None):
+        """
+        Convenience method to close all the idle connections of the pool for a
+        database and discard the pool.
+
+        :param database: The name of the database the pool connects to.
+        """
+        with self._pools_lock:
+            db_pool = self._pools.pop(database, None)
+        if db_pool:
+            db_pool._remove_connections()
+
+    def _check_connection_health(self, db_conn):
+        """
+        Convenience method to make sure a connection checked out from the pool
+        is still usable. Connections that were idle in the pool for longer than
+        idle_check_seconds are pinged and reconnected if the server has closed
+        them in the meantime.
+
+        :param db_conn: The pooled connection to check.
+        """
+        last_used = self._last_used.pop(_pooled_connection(db_conn), None)
+        if last_used is None or \
+                time.monotonic() - last_used > self._idle_check_seconds:
+            db_conn.ping(reconnect=True, attempts=3, delay=1)
 
-    def _close_db_connection(self):
+    @contextmanager
+    def connection(self, database='spark_dwh'):
         """
-        Convenience method to close the existing database connection.
+        Context manager to check out a connection from the pool of the given
+        database and return it to the pool when done. If the block raises an
+        error, the open transaction is rolled back before the connection is
+        returned. At most pool_size connections of each database are checked
+        out at once, any further callers wait until a connection of the
+        database is returned.
+
+        :param database: The name of the database to connect to. If None, a
+                         generic connection to the server is returned.
+        """
+        with self._get_pool_slots(database):
+            db_conn = self._get_pool(database).get_connection()
+            try:
+                self._check_connection_health(db_conn)
+                yield db_conn
+            except Exception:
+                db_conn.rollback()
+                raise
+            finally:
+                self._last_used[_pooled_connection(db_conn)] = \
+                    time.monotonic()
+                db_conn.close()
+
+    def close(self):
+        """
+        Method to close all the connections held by the connector pools.
         """
-        if self._db_conn:
-            self._db_conn.close()
-            self._db_conn = None
+        for database in list(self._pools):
+            self._close_pool(database)
 
     def check_db_availability(self, max_retries=20):
         """
@@ -104,79 +529,245 @@ class MySqlDbConnector:
         script does not wait for the service to be up before beginnig execution.
         """
         print('Attempting to connect to database server')
-        self._initialise_db_connection(max_retries=max_retries, 
-                                       log_success=True, 
-                                       exit_if_unavailable=True)
-        self._close_db_connection()
+        self._get_pool(database=None,
+                       max_retries=max_retries, 
+                       log_success=True, 
+                       exit_if_unavailable=True)
+
+    def _execute(self, cursor, query, params=None, fetch=False, trace=True):
+        """
+        Convenience method through which all the statements sent to the
+        database are executed, and traced by the query_tracer if any.
 
+        :param cursor: The cursor on which to execute the statement.
+        :param query: The statement to execute.
+        :param params: The parameters of the statement, if any.
+        :param fetch: Fetch and return all the rows of the result.
+        :param trace: Trace the statement here. The statements whose rows are
+                      fetched later are traced by the caller once the rows
+                      are read (see _iter_select).
+        """
+        statement = query.split(None, 1)[0].upper()
+        metrics.inc('db_statements_total', statement=statement)
+        results = None
+        start = time.perf_counter()
+        try:
+            with metrics.timer('db_statement_seconds', statement=statement):
+                cursor.execute(query, params)
+                if fetch:
+                    results = cursor.fetchall()
+        finally:
+            if trace and self._query_tracer is not None:
+                rows = len(results) if results is not None else cursor.rowcount
+                self._query_tracer.record(query, time.perf_counter() - start,
+                                          rows=rows,
+                                          params_count=len(params or ()))
+        return results
 
     @staticmethod
-    def _generate_insert_statement(record, table_name):
+    def _commit(db_conn):
+        """
+        Convenience method through which all the transactions are committed.
 
+        :param db_conn: The connection whose transaction is committed.
         """
-        Generate a SQL insert query for a given record and a table name
+        metrics.inc('db_commits_total')
+        db_conn.commit()
 
-        :param record: The record to be inserted to the table.
-        :param table_name: The name of the table to insert the record to.
+    def _insert_rows(self, cursor, table_name, fields, rows, ignore=False):
         """
+        Convenience method to insert many rows to a table with a single
+        parameterised multi-row INSERT statement. (mysql.connector only
+        rewrites executemany into a multi-row statement for plain INSERTs, not
+        for INSERT IGNORE.)
 
-        field_string = ', '.join([str(key) for key in record.keys()])
-        value_string = '", "'.join([value for _, value in record.items()])
-        insert_string = (f'INSERT INTO {table_name} (' + 
-                               field_string + ') VALUES ("' + 
-                               value_string + '");')
-        return insert_string
+        :param cursor: The cursor on which to run the statement.
+        :param table_name: The name of the table to insert the rows to.
+        :param fields: The columns of the table the values are inserted to.
+        :param rows: The list of rows to insert, as tuples of values in the
+                     order of the fields.
+        :param ignore: Use INSERT IGNORE, skipping rows that would violate a
+                       unique key.
+        :return: The number of rows actually inserted.
+        """
+        row_placeholder = '(' + ', '.join(['%s'] * len(fields)) + ')'
+        query = (f'INSERT {"IGNORE " if ignore else ""}INTO {table_name} '
+                 f'({", ".join(fields)}) VALUES ' +
+                 ', '.join([row_placeholder] * len(rows)))
+        self._execute(cursor, query, [value for row in rows for value in row])
+        return cursor.rowcount
 
-    @staticmethod
-    def _generate_constraint_statement(record):
+    def _run_transaction(self, work, database='spark_dwh', max_retries=3):
         """
-        Generate a 'WHERE' constraint clause for an SQL query based on values
-        specified in a dictionary. By default, all key-values in the dictionary
-        are combined using an 'AND' condition for creating the constraint
-        statement.
+        Convenience method to run the statements of a short transaction,
+        retried as a whole when it is rolled back by a deadlock or a lock wait
+        timeout (see RETRY_ERROR_CODES).
+
+        :param work: The function running the statements, called with a cursor.
+        :param database: The name of the database to connect to.
+        :param max_retries: The number of retries of the transaction.
+        :return: The value returned by work.
+        """
+        attempt = 0
+        with self.connection(database=database) as db_conn:
+            while True:
+                cursor = db_conn.cursor()
+                try:
+                    result = work(cursor)
+                    self._commit(db_conn)
+                    return result
+                except Exception as err:
+                    db_conn.rollback()
+                    if getattr(err, 'errno', None) not in \
+                            self.RETRY_ERROR_CODES or attempt >= max_retries:
+                        raise
+                    attempt += 1
+                    print(f'transaction retried after error: {err}')
+                    time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+                finally:
+                    cursor.close()
+
+    def _select_statement(self,
+                          table_name,
+                          fields=None,
+                          constraint_fields=(),
+                          key_fields=(),
+                          num_keys=0,
+                          order_by=None,
+                          limit=False):
+        """
+        Convenience method to get the parameterised SELECT statement of a given
+        shape. The statement of a shape is built once, the same query being
+        returned after, so that it is only prepared once per connection (see
+        PreparedStatements).
 
-        :param record: The dictionary of key-value pairs specifying the
-                       constraint condition.
+        :param table_name: The name of the table to select from.
+        :param fields: The columns to select, all of them if not provided.
+        :param constraint_fields: The columns compared to a value each, NULL
+                                  matching NULL.
+        :param key_fields: The columns matched against an IN-list of keys.
+        :param num_keys: The number of keys of the IN-list.
+        :param order_by: The ORDER BY clause, if any.
+        :param limit: Add a LIMIT clause, with the limit as last parameter.
         """
-        condition_list = []
-        for key, value in record.items():
-            if isinstance(value, str):
-                condition = str(key) + "='" + value + "'"
+        shape = (table_name, tuple(fields or ()), tuple(constraint_fields),
+                 tuple(key_fields), num_keys, order_by, limit)
+        query = self._statements.get(shape)
+        if query is not None:
+            return query
+        conditions = [f'{field} <=> %s' for field in constraint_fields]
+        if key_fields:
+            if len(key_fields) == 1:
+                key_columns, key_placeholder = key_fields[0], '%s'
             else:
-                condition = str(key) + "=" + str(value)
-            condition_list.append(condition)
-        
-        constraint_statement = 'WHERE ' + ' AND '.join(condition_list)
-        return constraint_statement
-   
+                key_columns = '(' + ', '.join(key_fields) + ')'
+                key_placeholder = ('(' + ', '.join(['%s'] * len(key_fields)) +
+                                   ')')
+            conditions.append(f'{key_columns} IN (' +
+                              ', '.join([key_placeholder] * num_keys) + ')')
+        query = (f'SELECT {", ".join(fields) if fields else "*"} '
+                 f'FROM {table_name}')
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        if order_by:
+            query += f' ORDER BY {order_by}'
+        if limit:
+            query += ' LIMIT %s'
+        return self._statements.setdefault(shape, query)
+
+    def _select_queries(self,
+                        table_name,
+                        fields=None,
+                        constraints_dict=None,
+                        key_fields=None,
+                        keys=None,
+                        order_by=None,
+                        limit=None):
+        """
+        Generator yielding the statements (and their parameters) selecting the
+        rows of a table, see iter_records for the arguments. The keys are
+        looked up MAX_IN_LIST_KEYS at a time, each statement being padded to
+        the size given by _in_list_size.
+        """
+        constraints = list((constraints_dict or {}).items())
+        constraint_fields = [field for field, _ in constraints]
+        params = [value for _, value in constraints]
+        if keys is None:
+            query = self._select_statement(table_name, fields,
+                                           constraint_fields,
+                                           order_by=order_by,
+                                           limit=limit is not None)
+            yield query, params + ([int(limit)] if limit is not None else [])
+            return
+        if order_by or limit is not None:
+            raise ValueError('The keys cannot be combined with order_by or '
+                             'limit, as they are looked up by several '
+                             'statements')
+        key_fields = list(key_fields)
+        keys = list(dict.fromkeys(keys))
+        for start in range(0, len(keys), MAX_IN_LIST_KEYS):
+            chunk = keys[start:start + MAX_IN_LIST_KEYS]
+            num_keys = _in_list_size(len(chunk))
+            chunk += [chunk[-1]] * (num_keys - len(chunk))
+            query = self._select_statement(table_name, fields,
+                                           constraint_fields, key_fields,
+                                           num_keys)
+            if len(key_fields) > 1:
+                chunk = [value for key in chunk for value in key]
+            yield query, params + chunk
+
+    def _iter_select(self, statements, queries, batch_size):
+        """
+        Generator yielding the rows of the given statements, fetched from the
+        server batch_size rows at a time.
+
+        :param statements: The PreparedStatements of the connection to use.
+        :param queries: An iterable of (query, params) tuples.
+        :param batch_size: The number of rows fetched at a time.
+        """
+        for query, params in queries:
+            # traced once its rows are read, with the time spent executing
+            # the statement and fetching its rows (not the time spent by the
+            # consumer of the rows) and the number of rows read
+            duration = 0.0
+            num_rows = 0
+            try:
+                start = time.perf_counter()
+                cursor = statements.execute(query, params, trace=False)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    duration += time.perf_counter() - start
+                    if not rows:
+                        break
+                    num_rows += len(rows)
+                    yield from rows
+                    start = time.perf_counter()
+            finally:
+                if self._query_tracer is not None:
+                    self._query_tracer.record(query, duration, rows=num_rows,
+                                              params_count=len(params))
+
     def _run_query(self,
                    query, 
-                   close_conn_after_exec=False, 
                    return_results=False, 
-                   database='spark_dwh'):
+                   database='spark_dwh',
+                   params=None):
         """
-        Method to execute and SQL query inside the database.
+        Method to execute and SQL query inside the database, using a connection
+        checked out from the pool.
 
         :param query: The query to execute.
-        :param close_conn_after_exec: Bool to specify if the database connection
-                                      should be closed after executing the 
-                                      query.
         :param return_results: Bool to specify if a resulting set of records
                                are expected after running the query.
         :param database: The name of the database on which to execute the query.
+        :param params: The parameters of the query, if it has placeholders.
         """
-        self._initialise_db_connection(database=database)
-        cursor = self._db_conn.cursor()
-        cursor.execute(query)
-        if return_results:
-            results = cursor.fetchall()
+        with self.connection(database=database) as db_conn:
+            cursor = db_conn.cursor()
+            results = self._execute(cursor, query, params,
+                                    fetch=return_results)
             cursor.close()
-        else:
-            results = None
-        self._db_conn.commit()
-        
-        if close_conn_after_exec:
-            self._close_db_connection()
+            self._commit(db_conn)
         
         return results
 
@@ -195,56 +786,459 @@ class MySqlDbConnector:
                                  used when fetching the records.
         :param database: The name of the database where the table is located.
         """
-        self._initialise_db_connection(database=database)
-        cursor = self._db_conn.cursor()
-        if fields:
-            fields_statement = ', '.join(fields)
-            query = f'SELECT ' + fields_statement + f' FROM {table_name} '
-        else:
-            query = f'SELECT * FROM {table_name} '
-        
-        if constraints_dict:
-            constraint_statement = self._generate_constraint_statement(constraints_dict)
-            query += constraint_statement
-        cursor.execute(query)
+        with self.connection(database=database) as db_conn, \
+                PreparedStatements(self, db_conn) as statements:
+            values = list(self._iter_select(
+                statements,
+                self._select_queries(table_name, fields, constraints_dict),
+                MAX_IN_LIST_KEYS))
+            fields = [desc[0] for desc in statements.description]
+        return fields, values
 
-        values = cursor.fetchall()
-        fields = [desc[0] for desc in cursor.description]
-        cursor.close()
+    def iter_records(self,
+                     table_name,
+                     fields=None,
+                     constraints_dict=None,
+                     key_fields=None,
+                     keys=None,
+                     order_by=None,
+                     limit=None,
+                     batch_size=1000,
+                     database='spark_dwh'):
+        """
+        Generator yielding the rows of a database table, as tuples of the
+        values of the fields, without loading them all in memory: the rows
+        are read from the server batch_size rows at a time, through
+        parameterised statements prepared once per statement shape. A pooled
+        connection is held until the iteration is over.
 
-        return fields, values
+        Many rows can be looked up by key with a few round trips: the keys
+        are matched with IN-lists of up to MAX_IN_LIST_KEYS keys per
+        statement.
+
+        :param table_name: The name of the table from which to read the rows.
+        :param fields: The columns to read, all of them if not provided.
+        :param constraints_dict: A dictionary of values the columns must be
+                                 equal to (NULL matching NULL).
+        :param key_fields: The columns the keys are matched against.
+        :param keys: The keys of the rows to read: the values of the key
+                     field, or tuples of values of the key_fields if there
+                     are several. All the rows are read if not provided.
+        :param order_by: The ORDER BY clause of the rows, e.g. 'id DESC'. Not
+                         supported with keys.
+        :param limit: The maximum number of rows to read. Not supported with
+                      keys.
+        :param batch_size: The number of rows fetched from the server at a
+                           time.
+        :param database: The name of the database where the table is located.
+        """
+        queries = self._select_queries(table_name, fields, constraints_dict,
+                                       key_fields, keys, order_by, limit)
+        with self.connection(database=database) as db_conn, \
+                PreparedStatements(self, db_conn) as statements:
+            yield from self._iter_select(statements, queries, batch_size)
     
-    def get_or_create_mask_id(self, table_name, record, database='spark_dwh'):
+    def fetch_mask_ids(self, table_name, field, limit=None,
+                       database='spark_dwh'):
+        """
+        This method fetches the existing value to masking id mapping stored in
+        one of the tables storing the masking ids, most recently created ids
+        first. The rows are streamed into the mapping (see iter_records), so
+        that the whole result is never held twice.
+
+        :param table_name: The name of the table storing the masking ids.
+        :param field: The name of the column holding the masked values.
+        :param limit: The maximum number of mappings to fetch. All are fetched
+                      if not provided.
+        :param database: The name of the database where the table is located.
+        """
+        if self._username != 'root':
+            print("""Warning: This method requires permissions to access to
+                     tables only root / service users! """)
+            return {}
+
+        return dict(self.iter_records(table_name, [field, 'id'],
+                                      order_by='id DESC',
+                                      limit=int(limit) if limit else None,
+                                      batch_size=10000,
+                                      database=database))
+
+    def get_or_create_mask_ids(self, table_name, field, values,
+                               database='spark_dwh'):
+        """
+        Method to get the masking ids of values of a sensitive field from the
+        table storing them. Masking ids are created for all the values that do
+        not have one yet using a single multi-row INSERT IGNORE (relying on
+        the unique key on the value column), and the ids of all the values are
+        then read back with a single query. The values are inserted in sorted
+        order, so that concurrent workers lock the keys in the same order, and
+        the transaction is retried if it is still chosen as a deadlock victim.
+
+        :param table_name: The name of the table storing the masking ids.
+        :param field: The name of the column holding the masked values.
+        :param values: The values for which to get the masking ids.
+        :param database: The name of the database where the table is located.
+        :return: A dictionary mapping each of the values to its masking id.
+        """
+        if self._username != 'root':
+            print("""Warning: This method requires permissions to access to
+                     tables only root / service users! """)
+            return {}
+
+        values = set(values)
+        if not values:
+            return {}
+        str_values = sorted({str(value) for value in values})
+        last_updated_at = str(datetime.now())
+        # the values are looked up through a derived table so that they are
+        # matched using the same collation as the unique key on the column.
+        lookup_table = ' UNION ALL '.join(['SELECT %s AS value'] *
+                                          len(str_values))
+
+        def insert_and_select(cursor):
+            self._insert_rows(cursor, table_name, [field, 'last_updated_at'],
+                              [(value, last_updated_at)
+                               for value in str_values],
+                              ignore=True)
+            return dict(self._execute(
+                cursor,
+                f'SELECT v.value, t.id FROM ({lookup_table}) v '
+                f'JOIN {table_name} t ON t.{field} = v.value',
+                str_values, fetch=True))
+
+        mask_ids = self._run_transaction(insert_and_select, database=database)
+        return {value: mask_ids[str(value)] for value in values}
+
+    def store_mask_tokens(self, table_name, field, tokens,
+                          database='spark_dwh'):
         """
-        This method fetches a 'masking' id corresponding to record 
-        (specified as a dictionary) from the table storing all the
-        masking ids. If the record is a new entry and does not have a
-        corresponding masking ID in the table, a new masking ID will be 
-        created. At the backend, this is achieved using a table that has an 
-        auto-increment 'id' field, which creates a new ID for every new record 
-        inserted.
+        This method stores token to value mappings of the keyed hash masking
+        strategy in one of the access restricted token tables, in a single
+        multi-row INSERT IGNORE. Tokens already stored are left unchanged.
+        As in get_or_create_mask_ids, the rows are inserted in sorted order and
+        the statement is retried after a deadlock.
+
+        :param table_name: The name of the table storing the masking tokens.
+        :param field: The name of the column holding the masked values.
+        :param tokens: A list of (token, value) tuples.
+        :param database: The name of the database where the table is located.
         """
         if self._username != 'root':
             print("""Warning: This method requires permissions to access to
                      tables only root / service users! """)
             return None
 
-        _, result = self.fetch_records(table_name,
-                                      ['id'],
-                                       record,
-                                       database=database)
-        if not result:
-            self.insert_record(table_name, record)
-            _, result = self.fetch_records(table_name,
-                                           ['id'],
-                                           record,
-                                           database=database)
-        id = result[0][0]
+        last_updated_at = str(datetime.now())
+        rows = [(token, value, last_updated_at)
+                for token, value in sorted(tokens)]
+        self._run_transaction(
+            lambda cursor: self._insert_rows(
+                cursor, table_name, ['token', field, 'last_updated_at'], rows,
+                ignore=True),
+            database=database)
+
+    def get_watermark(self, end_point_name, database='spark_dwh'):
+        """
+        Method to get the high-water mark of an API end point, stored at the
+        end of the previous ETL run.
+
+        :param end_point_name: The name of the end point ('users', 'messages').
+        :param database: The name of the database where the table is located.
+        :return: A (max_timestamp, last_id) tuple, both None if no high-water
+                 mark is stored yet.
+        """
+        result = self._run_query(
+            query="""SELECT max_timestamp, last_id FROM etl_watermarks
+                     WHERE end_point = %s""",
+            params=(end_point_name,),
+            return_results=True,
+            database=database)
+        return result[0] if result else (None, None)
+
+    def set_watermark(self, end_point_name, max_timestamp, last_id,
+                      database='spark_dwh'):
+        """
+        Method to store the high-water mark of an API end point, that is the
+        timestamp and id of the latest record loaded from it.
+
+        :param end_point_name: The name of the end point ('users', 'messages').
+        :param max_timestamp: The timestamp of the latest record loaded.
+        :param last_id: The id of the latest record loaded.
+        :param database: The name of the database where the table is located.
+        """
+        self._run_query(
+            query="""INSERT INTO etl_watermarks
+                     (end_point, max_timestamp, last_id, last_updated_at)
+                     VALUES (%s, %s, %s, %s)
+                     ON DUPLICATE KEY UPDATE
+                     max_timestamp = VALUES(max_timestamp),
+                     last_id = VALUES(last_id),
+                     last_updated_at = VALUES(last_updated_at)""",
+            params=(end_point_name, max_timestamp, last_id,
+                    str(datetime.now())),
+            database=database)
+
+    def start_etl_run(self, resume=False, database='spark_dwh'):
+        """
+        Method to register the start of an ETL run in the etl_runs table. When
+        resuming, the latest run is continued (and its load checkpoints kept)
+        if it did not succeed, e.g. because the process died during the load.
+
+        :param resume: Continue the latest run if it did not succeed.
+        :param database: The name of the database where the table is located.
+        :return: The id of the run.
+        """
+        if resume:
+            result = self._run_query(
+                query="""SELECT run_id, status FROM etl_runs
+                         ORDER BY run_id DESC LIMIT 1""",
+                return_results=True,
+                database=database)
+            if result and result[0][1] != 'succeeded':
+                run_id, status = result[0]
+                self._run_query(
+                    query="""UPDATE etl_runs
+                             SET status = 'running', finished_at = NULL
+                             WHERE run_id = %s""",
+                    params=(run_id,),
+                    database=database)
+                print(f'resuming ETL run {run_id} ({status})')
+                return run_id
+            print('no unfinished ETL run to resume, starting a new run')
+
+        with self.connection(database=database) as db_conn:
+            cursor = db_conn.cursor()
+            self._execute(cursor,
+                          """INSERT INTO etl_runs (started_at, status)
+                             VALUES (%s, 'running')""",
+                          (str(datetime.now()),))
+            run_id = cursor.lastrowid
+            cursor.close()
+            self._commit(db_conn)
+        print(f'starting ETL run {run_id}')
+        return run_id
+
+    def finish_etl_run(self, run_id, succeeded, database='spark_dwh'):
+        """
+        Method to register the end of an ETL run. The load checkpoints of a run
+        that succeeded are deleted, as it will not be resumed.
+
+        :param run_id: The id of the run, see start_etl_run.
+        :param succeeded: Whether all the records of the run were loaded.
+        :param database: The name of the database where the table is located.
+        """
+        self._run_query(
+            query="""UPDATE etl_runs SET status = %s, finished_at = %s
+                     WHERE run_id = %s""",
+            params=('succeeded' if succeeded else 'failed',
+                    str(datetime.now()), run_id),
+            database=database)
+        if succeeded:
+            self._run_query(
+                query='DELETE FROM etl_load_checkpoints WHERE run_id = %s',
+                params=(run_id,),
+                database=database)
+
+    def get_load_checkpoints(self, run_id, streams=None, database='spark_dwh'):
+        """
+        Method to get the batches committed by an ETL run (see
+        load.LoadCheckpoint).
+
+        :param run_id: The id of the run.
+        :param streams: The load streams to get the batches of, all the
+                        streams of the run if not provided.
+        :param database: The name of the database where the table is located.
+        :return: A dictionary mapping each load stream to a dictionary mapping
+                 the offsets of its committed batches to their digest.
+        """
+        query = """SELECT stream, batch_offset, batch_digest
+                   FROM etl_load_checkpoints WHERE run_id = %s"""
+        params = [run_id]
+        if streams is not None:
+            streams = list(streams)
+            if not streams:
+                return {}
+            query += f' AND stream IN ({", ".join(["%s"] * len(streams))})'
+            params.extend(streams)
+        committed = {}
+        for stream, batch_offset, batch_digest in self._run_query(
+                query=query,
+                params=tuple(params),
+                return_results=True,
+                database=database):
+            committed.setdefault(stream, {})[batch_offset] = batch_digest
+        return committed
+
+    def _add_index_if_missing(self, table_name, index_name, index_definition,
+                              database='spark_dwh'):
+        """
+        Convenience method to add an index to an existing table, unless an index
+        by the same name is already present.
+
+        :param table_name: The name of the table to add the index to.
+        :param index_name: The name of the index.
+        :param index_definition: The definition of the index, for example
+                                 'UNIQUE KEY (city)'.
+        :param database: The name of the database where the table is located.
+        """
+        existing = self._run_query(
+            query="""SELECT 1 FROM information_schema.statistics
+                     WHERE table_schema = %s AND table_name = %s
+                     AND index_name = %s LIMIT 1""",
+            params=(database, table_name, index_name),
+            return_results=True,
+            database=database)
+        if not existing:
+            definition = index_definition.replace('KEY', f'KEY {index_name}', 1)
+            self._run_query(f'ALTER TABLE {table_name} ADD {definition}',
+                            database=database)
+
+    def get_table_columns(self, table_name, database='spark_dwh'):
+        """
+        Method to get the columns of a table, in table order, together with
+        their data types. The result is cached for each table.
+
+        :param table_name: The name of the table.
+        :param database: The name of the database where the table is located.
+        :return: A dictionary mapping column names to (lower case) data types.
+        """
+        key = (database, table_name)
+        if key not in self._table_columns:
+            columns = self._run_query(
+                query="""SELECT column_name, data_type
+                         FROM information_schema.columns
+                         WHERE table_schema = %s AND table_name = %s
+                         ORDER BY ordinal_position""",
+                params=(database, table_name),
+                return_results=True,
+                database=database)
+            if not columns:
+                # not cached, the table may be created later on
+                return {}
+            self._table_columns[key] = {name: data_type.lower()
+                                        for name, data_type in columns}
+        return self._table_columns[key]
+
+    def _add_row_hash_column(self, table_name, database='spark_dwh'):
+        """
+        Convenience method to migrate a table created before the row_hash
+        column was introduced. The table is rebuilt with the row_hash column
+        and its unique key, computing the fingerprint of the existing rows the
+        same way as compute_row_hash (see row_hash_sql). Duplicate rows are
+        dropped in the process, and the rebuilt table is swapped in with a
+        single RENAME.
+
+        :param table_name: The name of the table to migrate.
+        :param database: The name of the database where the table is located.
+        """
+        columns = self.get_table_columns(table_name, database=database)
+        if not columns or 'row_hash' in columns:
+            return
+        print(f'adding row_hash column to table {table_name}')
+        column_list = ', '.join(columns)
+        self._run_query(f'DROP TABLE IF EXISTS {table_name}_dedup',
+                        database=database)
+        self._run_query(f'CREATE TABLE {table_name}_dedup LIKE {table_name}',
+                        database=database)
+        self._run_query(f"""ALTER TABLE {table_name}_dedup
+                            ADD COLUMN row_hash CHAR(64),
+                            ADD UNIQUE KEY uq_row_hash (row_hash)""",
+                        database=database)
+        self._run_query(f"""INSERT IGNORE INTO {table_name}_dedup
+                            ({column_list}, row_hash)
+                            SELECT {column_list},
+                            {row_hash_sql(columns)}
+                            FROM {table_name}""",
+                        database=database)
+        self._run_query(f"""RENAME TABLE {table_name} TO {table_name}_old,
+                            {table_name}_dedup TO {table_name}""",
+                        database=database)
+        self._run_query(f'DROP TABLE {table_name}_old', database=database)
+        self._table_columns.pop((database, table_name), None)
+
+    def _create_typed_table(self, table_name, created_name=None,
+                            database='spark_dwh'):
+        """
+        Convenience method to create one of the raw tables with its typed
+        definition (see TYPED_RAW_TABLES), if it does not exist yet.
+
+        :param table_name: The name of the raw table.
+        :param created_name: The name of the table to create, if different from
+                             the name of the raw table.
+        :param database: The name of the database to create the table in.
+        """
+        definition = TYPED_RAW_TABLES[table_name]
+        lines = ([f'{column} {sql_type}'
+                  for column, sql_type in definition['columns']] +
+                 definition['keys'])
+        self._run_query(f'CREATE TABLE IF NOT EXISTS '
+                        f'{created_name or table_name} (' +
+                        ', '.join(lines) + ')',
+                        database=database)
+
+    def _add_row_id_key(self, table_name, database='spark_dwh'):
+        """
+        Convenience method to migrate a typed raw table created with a primary
+        key on its id (messages_raw) to the auto-increment row_id primary key
+        of TYPED_RAW_TABLES, so that a record sent again with the same id and
+        changed values is stored as a new row, as in the other raw tables,
+        instead of being ignored on the id.
+
+        :param table_name: The name of the raw table.
+        :param database: The name of the database where the table is located.
+        """
+        columns = self.get_table_columns(table_name, database=database)
+        if not columns or 'row_id' in columns or \
+                columns.get('created_at') == 'varchar':
+            return
+        print(f'replacing the primary key of table {table_name} by row_id')
+        self._run_query(f"""ALTER TABLE {table_name} DROP PRIMARY KEY,
+                            ADD COLUMN row_id BIGINT NOT NULL AUTO_INCREMENT
+                            PRIMARY KEY FIRST,
+                            ADD KEY idx_id (id)""",
+                        database=database)
+        self._table_columns.pop((database, table_name), None)
 
-        return id
+    def migrate_to_typed_schema(self, table_name, database='spark_dwh'):
+        """
+        Method to convert a raw table created with the VARCHAR schema to the
+        typed schema (see TYPED_RAW_TABLES), in place. A typed copy of the table
+        is created and filled converting every column in SQL, keeping the row
+        fingerprints, and is then swapped in with a single RENAME so that the
+        grants and views on the table name keep working. Values that cannot be
+        converted are stored as NULL. Tables already typed are left unchanged.
+
+        :param table_name: The name of the raw table to migrate.
+        :param database: The name of the database where the table is located.
+        """
+        columns = self.get_table_columns(table_name, database=database)
+        if not columns or columns.get('created_at') != 'varchar':
+            return
+        print(f'migrating table {table_name} to the typed schema')
+        self._add_row_hash_column(table_name, database=database)
+        self._run_query(f'DROP TABLE IF EXISTS {table_name}_typed',
+                        database=database)
+        self._create_typed_table(table_name, f'{table_name}_typed',
+                                 database=database)
+        typed_columns = [(column, sql_type) for column, sql_type
+                         in TYPED_RAW_TABLES[table_name]['columns']
+                         if column in columns or column == 'row_hash']
+        self._run_query(
+            f"""INSERT IGNORE INTO {table_name}_typed
+                ({', '.join(column for column, _ in typed_columns)})
+                SELECT {', '.join(_varchar_to_typed_expression(column, sql_type)
+                                  for column, sql_type in typed_columns)}
+                FROM {table_name}""",
+            database=database)
+        self._run_query(f"""RENAME TABLE {table_name} TO {table_name}_varchar,
+                            {table_name}_typed TO {table_name}""",
+                        database=database)
+        self._run_query(f'DROP TABLE {table_name}_varchar', database=database)
+        self._table_columns.pop((database, table_name), None)
 
     def initialise_db_and_create_tables(self,
-                                        drop_if_exists=False):
+                                        drop_if_exists=False,
+                                        typed_schema=False):
         """
         Method to initialise the database and create required tables at the 
         start of the ETL process. This method will be called in the main ETL
@@ -256,6 +1250,13 @@ class MySqlDbConnector:
         3) Create a new database user having access to only non-sensitive tables
            (non-PII related tables). This user account will be providded to the 
            analysts 
+
+        :param drop_if_exists: Drop the existing database, tables and users
+                               before creating them again.
+        :param typed_schema: Create the users, subscriptions and messages tables
+                             with typed columns and indexes (see
+                             TYPED_RAW_TABLES) instead of VARCHAR columns only.
+                             Existing VARCHAR tables are migrated in place.
         """
         if self._username != 'root':
             print('DB initialisation can be done only as root user!')
@@ -263,79 +1264,98 @@ class MySqlDbConnector:
         
         if drop_if_exists:
             print('dropping existing database and associated tables & users!')
-            self._run_query(query='DROP TABLE IF EXISTS users_raw',
-                            close_conn_after_exec=True)
-            self._run_query(query='DROP TABLE IF EXISTS subscriptions_raw',
-                            close_conn_after_exec=True)
-            self._run_query(query='DROP TABLE IF EXISTS messages_raw', 
-                            close_conn_after_exec=True)
-            self._run_query(query='DROP TABLE IF EXISTS sensitive_zipcode_ids', 
-                            close_conn_after_exec=True)
-            self._run_query(query='DROP TABLE IF EXISTS sensitive_city_ids', 
-                            close_conn_after_exec=True)
-            self._run_query(query='DROP TABLE IF EXISTS sensitive_profession_ids', 
-                            close_conn_after_exec=True)
-            self._run_query(query='DROP TABLE IF EXISTS spark_dwh', 
-                            close_conn_after_exec=True)
-            self._run_query(query='DROP USER IF EXISTS analyst', 
-                            close_conn_after_exec=True)
+            self._run_query(query='DROP TABLE IF EXISTS users_raw')
+            self._run_query(query='DROP TABLE IF EXISTS subscriptions_raw')
+            self._run_query(query='DROP TABLE IF EXISTS messages_raw')
+            self._run_query(query='DROP TABLE IF EXISTS sensitive_zipcode_ids')
+            self._run_query(query='DROP TABLE IF EXISTS sensitive_city_ids')
+            self._run_query(query='DROP TABLE IF EXISTS sensitive_profession_ids')
+            self._run_query(query='DROP TABLE IF EXISTS etl_watermarks')
+            self._run_query(query='DROP TABLE IF EXISTS etl_runs')
+            self._run_query(query='DROP TABLE IF EXISTS etl_load_checkpoints')
+            self._run_query(query='DROP TABLE IF EXISTS spark_dwh')
+            self._run_query(query='DROP USER IF EXISTS analyst')
             self._run_query(query='DROP DATABASE IF EXISTS spark_dwh', 
-                            database=None, 
-                            close_conn_after_exec=True)
+                            database=None)
+            # pooled connections still point to the dropped database
+            self._close_pool(database='spark_dwh')
+            self._table_columns.clear()
         
-        self._initialise_db_connection()
         self._run_query(query='CREATE DATABASE IF NOT EXISTS spark_dwh',
-                        close_conn_after_exec=True)
-
-        self._run_query(query="""CREATE TABLE IF NOT EXISTS users_raw
-                        (user_id VARCHAR(255), created_at VARCHAR(255),
-                         updated_at VARCHAR(255), city_id VARCHAR(255), 
-                         country VARCHAR(255), zipcode_id VARCHAR(255), 
-                         email VARCHAR(255), birth_date VARCHAR(255),
-                        gender VARCHAR(10), is_smoking VARCHAR(255), 
-                        profession_id VARCHAR(255), income VARCHAR(255), 
-                        last_updated_at VARCHAR(255))""", 
-                        database='spark_dwh', 
-                        close_conn_after_exec=True
-        )
-
-        self._run_query(query="""CREATE TABLE IF NOT EXISTS subscriptions_raw
-                        (user_id VARCHAR(255), created_at VARCHAR(255), 
-                         start_date VARCHAR(255), end_date VARCHAR(255),
-                         status VARCHAR(255), amount VARCHAR(255), 
-                         last_updated_at VARCHAR(255))""", 
-                        database='spark_dwh', 
-                        close_conn_after_exec=True
-        )
+                        database=None)
+
+        if typed_schema:
+            # typed tables, converting the VARCHAR tables of earlier runs
+            for table_name in TYPED_RAW_TABLES:
+                self.migrate_to_typed_schema(table_name)
+                self._add_row_id_key(table_name)
+                self._create_typed_table(table_name)
+        else:
+            self._run_query(query="""CREATE TABLE IF NOT EXISTS users_raw
+                            (user_id VARCHAR(255), created_at VARCHAR(255),
+                             updated_at VARCHAR(255), city_id VARCHAR(255), 
+                             country VARCHAR(255), zipcode_id VARCHAR(255), 
+                             email VARCHAR(255), birth_date VARCHAR(255),
+                            gender VARCHAR(10), is_smoking VARCHAR(255), 
+                            profession_id VARCHAR(255), income VARCHAR(255), 
+                            last_updated_at VARCHAR(255), row_hash CHAR(64),
+                            UNIQUE KEY uq_row_hash (row_hash))""", 
+                            database='spark_dwh')
+
+            self._run_query(query="""CREATE TABLE IF NOT EXISTS subscriptions_raw
+                            (user_id VARCHAR(255), created_at VARCHAR(255), 
+                             start_date VARCHAR(255), end_date VARCHAR(255),
+                             status VARCHAR(255), amount VARCHAR(255), 
+                             last_updated_at VARCHAR(255), row_hash CHAR(64),
+                             UNIQUE KEY uq_row_hash (row_hash))""", 
+                            database='spark_dwh')
         
-        self._run_query(query="""CREATE TABLE IF NOT EXISTS messages_raw
-                        (created_at VARCHAR(255), receiver_id VARCHAR(255), 
-                        id VARCHAR(255), sender_id VARCHAR(255), 
-                        last_updated_at VARCHAR(255))""",
-                        database='spark_dwh', 
-                        close_conn_after_exec=True
-        )
+            self._run_query(query="""CREATE TABLE IF NOT EXISTS messages_raw
+                            (created_at VARCHAR(255), receiver_id VARCHAR(255), 
+                            id VARCHAR(255), sender_id VARCHAR(255), 
+                            last_updated_at VARCHAR(255), row_hash CHAR(64),
+                            UNIQUE KEY uq_row_hash (row_hash))""",
+                            database='spark_dwh')
 
         self._run_query(query="""CREATE TABLE IF NOT EXISTS sensitive_zipcode_ids
                         (id INT AUTO_INCREMENT, zipcode VARCHAR(255),
                         last_updated_at VARCHAR(255), PRIMARY KEY (id))""",
-                        database='spark_dwh',
-                        close_conn_after_exec=True
-        )
+                        database='spark_dwh')
 
         self._run_query(query="""CREATE TABLE IF NOT EXISTS sensitive_city_ids
                         (id INT AUTO_INCREMENT, city VARCHAR(255), 
                          last_updated_at VARCHAR(255), PRIMARY KEY (id))""",
-                        database='spark_dwh',
-                        close_conn_after_exec=True
-        )
+                        database='spark_dwh')
 
         self._run_query(query="""CREATE TABLE IF NOT EXISTS sensitive_profession_ids
                         (id INT AUTO_INCREMENT, profession VARCHAR(255), 
                          last_updated_at VARCHAR(255), PRIMARY KEY (id))""", 
-                        database='spark_dwh',
-                        close_conn_after_exec=True
-        )
+                        database='spark_dwh')
+        
+        self._run_query(query="""CREATE TABLE IF NOT EXISTS etl_watermarks
+                        (end_point VARCHAR(64), max_timestamp VARCHAR(255),
+                         last_id VARCHAR(255), last_updated_at VARCHAR(255),
+                         PRIMARY KEY (end_point))""",
+                        database='spark_dwh')
+
+        self._run_query(query="""CREATE TABLE IF NOT EXISTS etl_runs
+                        (run_id INT AUTO_INCREMENT, started_at VARCHAR(255),
+                         finished_at VARCHAR(255), status VARCHAR(32),
+                         PRIMARY KEY (run_id))""",
+                        database='spark_dwh')
+
+        self._run_query(query="""CREATE TABLE IF NOT EXISTS etl_load_checkpoints
+                        (run_id INT, stream VARCHAR(255), batch_offset BIGINT,
+                         records INT, batch_digest CHAR(64),
+                         committed_at VARCHAR(255),
+                         PRIMARY KEY (run_id, stream, batch_offset))""",
+                        database='spark_dwh')
+
+        for field in ['zipcode', 'city', 'profession']:
+            self._run_query(query=f"""CREATE TABLE IF NOT EXISTS sensitive_{field}_tokens
+                            (token BIGINT, {field} VARCHAR(255),
+                             last_updated_at VARCHAR(255), PRIMARY KEY (token))""",
+                            database='spark_dwh')
         
         self._run_query(query="""CREATE USER IF NOT EXISTS 'analyst' 
                                  IDENTIFIED BY 'password'""")
@@ -346,7 +1366,18 @@ class MySqlDbConnector:
         self._run_query(query="""GRANT ALL PRIVILEGES ON
                                  spark_dwh.messages_raw to 'analyst'""")
 
-        self._close_db_connection()
+        # raw tables created before the row_hash column was introduced
+        for table_name in ['users_raw', 'subscriptions_raw', 'messages_raw']:
+            self._add_row_hash_column(table_name)
+
+        # unique keys on the masked values, required to create masking ids in
+        # bulk. Added separately so that tables created earlier get them too.
+        self._add_index_if_missing('sensitive_zipcode_ids', 'uq_zipcode',
+                                   'UNIQUE KEY (zipcode)')
+        self._add_index_if_missing('sensitive_city_ids', 'uq_city',
+                                   'UNIQUE KEY (city)')
+        self._add_index_if_missing('sensitive_profession_ids', 'uq_profession',
+                                   'UNIQUE KEY (profession)')
 
         print('database initialized!')
 
@@ -357,32 +1388,364 @@ class MySqlDbConnector:
                       fail_if_exists=True,
                       database='spark_dwh'):
         """
-        Method to insert a record to a database table. 
-        
+        Method to insert a record to a database table, with a parameterised
+        statement (see insert_records).
+
         :param table_name: The name of the table to insert the record to.
         :param record: The record to insert as a dictionary.
         :param fail_if_exits: Check if the record already exists in the table
                               and fail if found.
         :param database: The name of the database in which the table resides.
+        :return: True if the record was inserted, False otherwise.
         """
-        if fail_if_exists:
-            # check if record exists:
-            constraints_dict = {k: v for k,v in record.items() 
-                                if k != 'last_updated_at'}
-            _, result = self.fetch_records(table_name=table_name, 
-                                           fields=record.keys(), 
-                                           constraints_dict=constraints_dict,
-                                           database=database)
-            if result:
-                print('Record already exists in database! Skipping insert')
-                return False
-        sql_query = self._generate_insert_statement(record=record, 
-                                                    table_name=table_name)
-
-        self._run_query(sql_query, database=database)
-        self._db_conn.commit()
-        self._close_db_connection()
+        inserted, _, _ = self.insert_records(table_name, [record],
+                                             fail_if_exists=fail_if_exists,
+                                             database=database)
+        return inserted == 1
     
+    def _fetch_existing_rows(self, statements, table_name, fields, batch):
+        """
+        Fetch the rows of a batch that are already present in a table, using
+        IN-list lookups of up to MAX_IN_LIST_KEYS records per statement,
+        comparing all the given fields of the records in the batch. As the
+        batches of a load have the same size, their lookups share the same
+        prepared statement.
+
+        :param statements: The PreparedStatements of the connection of the
+                           transaction of the batch.
+        :param table_name: The name of the table to check.
+        :param fields: The fields used to compare the records.
+        :param batch: The list of records (as dictionaries) to check.
+        """
+        if len(fields) == 1:
+            keys = [record.get(fields[0]) for record in batch]
+        else:
+            keys = [tuple(record.get(field) for field in fields)
+                    for record in batch]
+        return set(self._iter_select(
+            statements,
+            self._select_queries(table_name, fields, key_fields=fields,
+                                 keys=keys),
+            MAX_IN_LIST_KEYS))
+
+    def _write_batch(self, cursor, statements, table_name, batch, use_row_hash,
+                     fail_if_exists, on_batch_inserted):
+        """
+        Convenience method writing one batch of insert_records, without
+        committing it.
+
+        :param cursor: The cursor of the transaction of the batch.
+        :param statements: The PreparedStatements of the same connection, with
+                           which the existing records are looked up.
+        :param table_name: The name of the table to insert the records to.
+        :param batch: The list of records (as dictionaries) to insert.
+        :param use_row_hash: Detect the existing records by their fingerprint.
+        :param fail_if_exists: Skip the records that already exist in the table.
+        :param on_batch_inserted: The function called with the inserted records,
+                                  if any.
+        :return: The number of records inserted.
+        """
+        fields = list(batch[0].keys())
+        batch_inserted = 0
+        if use_row_hash:
+            fields = [field for field in fields
+                      if field != 'row_hash'] + ['row_hash']
+            new_records = {}
+            for record in batch:
+                row_hash = record.get('row_hash')
+                if not row_hash:
+                    row_hash = compute_row_hash(record)
+                    record = dict(record, row_hash=row_hash)
+                new_records.setdefault(row_hash, record)
+            new_records = list(new_records.values())
+            if on_batch_inserted is not None and new_records:
+                existing = self._fetch_existing_rows(
+                    statements, table_name, ['row_hash'], new_records)
+                new_records = [record for record in new_records
+                               if (record['row_hash'],) not in existing]
+        elif fail_if_exists:
+            # check if records exist, also within the batch itself:
+            check_fields = [field for field in fields
+                            if field != 'last_updated_at']
+            seen = self._fetch_existing_rows(statements, table_name,
+                                             check_fields, batch)
+            new_records = []
+            for record in batch:
+                key = tuple(record.get(field) for field in check_fields)
+                if key in seen:
+                    continue
+                seen.add(key)
+                new_records.append(record)
+        else:
+            new_records = batch
+
+        if new_records:
+            batch_inserted = self._insert_rows(
+                cursor, table_name, fields,
+                [tuple(record.get(field) for field in fields)
+                 for record in new_records],
+                ignore=use_row_hash)
+        if on_batch_inserted is not None and new_records:
+            if use_row_hash and batch_inserted != len(new_records):
+                # only the records whose fingerprint is now in the table were
+                # inserted, by this batch or by a concurrent loader, the
+                # others were ignored on another unique key
+                present = self._fetch_existing_rows(
+                    statements, table_name, ['row_hash'], new_records)
+                new_records = [record for record in new_records
+                               if (record['row_hash'],) in present]
+            if batch_inserted != len(new_records):
+                raise RuntimeError(
+                    f'{len(new_records) - batch_inserted} records were '
+                    f'inserted concurrently, the batch is rolled back to keep '
+                    f'the rollups consistent')
+            on_batch_inserted(partial(self._execute, cursor), new_records)
+        return batch_inserted
+
+    def insert_records(self,
+                       table_name,
+                       records,
+                       batch_size=1000,
+                       fail_if_exists=True,
+                       database='spark_dwh',
+                       on_batch_inserted=None,
+                       max_retries=3,
+                       checkpoint=None,
+                       checkpoint_offset=0,
+                       on_batch_committed=None):
+        """
+        Method to insert many records to a database table in batches. Each batch
+        is written using a single parameterised multi-row INSERT statement and
+        committed once, rather than one statement and one commit per record as
+        done in insert_record. A batch that fails is rolled back and counted as
+        failed, the remaining batches are still attempted. A batch rolled back
+        by a deadlock is retried first.
+
+        If the table has a row_hash column, records that already exist are
+        detected through their fingerprint (see compute_row_hash, or the
+        row_hash already present in the records, if any): the batch is
+        written with INSERT IGNORE and the unique key on row_hash skips the
+        existing records, so no lookup of the table is needed. Otherwise, the
+        existing records are looked up comparing all their fields.
+
+        If on_batch_inserted is given, it is called with a function executing
+        statements and the records actually inserted, in the transaction of
+        each batch, e.g. to keep summary tables up to date (see rollups.py).
+        The existing row fingerprints of the batch are then looked up
+        beforehand, so that the inserted records are known.
+
+        If a checkpoint is given (see load.LoadCheckpoint), each batch is
+        committed together with its checkpoint row, and the batches already
+        committed by the run being resumed are skipped without any statement.
+
+        :param table_name: The name of the table to insert the records to.
+        :param records: An iterable of records (as dictionaries, or RawRecords,
+                        see records.py) to insert. All the records are
+                        expected to have the same keys.
+        :param batch_size: The maximum number of records written per batch.
+        :param fail_if_exists: Skip the records that already exist in the table.
+        :param database: The name of the database in which the table resides.
+        :param on_batch_inserted: A function called as
+                                  on_batch_inserted(execute, inserted_records)
+                                  before each batch is committed, where
+                                  execute(query, params=None) runs a statement
+                                  in the same transaction.
+        :param max_retries: The number of times a batch rolled back by a
+                            deadlock or lock wait timeout (e.g. with another
+                            loader writing to the same table) is retried.
+        :param checkpoint: The checkpoint of the load, called as
+                           checkpoint.is_committed(offset, batch) before each
+                           batch and checkpoint.record(execute, offset, batch)
+                           before it is committed, offset being the position
+                           of its first record in the records of the load.
+        :param checkpoint_offset: The position of the first of the records in
+                                  the records of the load.
+        :param on_batch_committed: A function called with the records of each
+                                   batch once it is committed (by this run,
+                                   or by the run being resumed), e.g. to
+                                   write them to another sink. It is not
+                                   called for the batches that failed.
+        :return: A tuple with the number of inserted, skipped (already existing)
+                 and failed records.
+        """
+        successful_inserts = 0
+        skipped_records = 0
+        failed_inserts = 0
+        use_row_hash = (fail_if_exists and
+                        'row_hash' in self.get_table_columns(table_name,
+                                                             database))
+        offset = checkpoint_offset
+        with self.connection(database=database) as db_conn, \
+                PreparedStatements(self, db_conn) as statements:
+            for batch_no, batch in enumerate(iter_batches(records,
+                                                           batch_size)):
+                batch_offset = offset
+                offset += len(batch)
+                if checkpoint is not None and \
+                        checkpoint.is_committed(batch_offset, batch):
+                    skipped_records += len(batch)
+                    print(f'batch no {batch_no}: already committed, skipped')
+                    if on_batch_committed is not None:
+                        on_batch_committed(batch)
+                    continue
+                attempt = 0
+                while True:
+                    cursor = db_conn.cursor()
+                    try:
+                        batch_inserted = self._write_batch(
+                            cursor, statements, table_name, batch,
+                            use_row_hash, fail_if_exists, on_batch_inserted)
+                        if checkpoint is not None:
+                            checkpoint.record(partial(self._execute, cursor),
+                                              batch_offset, batch)
+                        self._commit(db_conn)
+                    except Exception as err:
+                        db_conn.rollback()
+                        if getattr(err, 'errno', None) in \
+                                self.RETRY_ERROR_CODES and \
+                                attempt < max_retries:
+                            # deadlock with a concurrent loader, the whole
+                            # transaction was rolled back and can be retried
+                            attempt += 1
+                            print(f'batch no {batch_no} retried after error: '
+                                  f'{err}')
+                            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+                            continue
+                        print(f'batch no {batch_no} failed due to error: '
+                              f'{err}')
+                        batch_inserted = None
+                    finally:
+                        cursor.close()
+                    break
+
+                if batch_inserted is None:
+                    failed_inserts += len(batch)
+                    continue
+                if on_batch_committed is not None:
+                    on_batch_committed(batch)
+                batch_skipped = len(batch) - batch_inserted
+                successful_inserts += batch_inserted
+                skipped_records += batch_skipped
+                print(f'batch no {batch_no}: {batch_inserted} inserted, '
+                      f'{batch_skipped} already existing')
+
+        return successful_inserts, skipped_records, failed_inserts
+
+    def get_local_infile_dir(self):
+        """
+        Method to get the directory of the files that can be loaded with
+        bulk_load_file, None if the connector does not allow bulk loading.
+        """
+        return self._local_infile_dir
+
+    def bulk_load_file(self,
+                       table_name,
+                       file_path,
+                       fields,
+                       records,
+                       database='spark_dwh',
+                       on_batch_inserted=None,
+                       checkpoint=None,
+                       checkpoint_offset=0,
+                       on_batch_committed=None):
+        """
+        Method to load a chunk of records, written to a tab separated file (see
+        load.write_tsv), to a table having a row_hash column. The file is loaded
+        with LOAD DATA LOCAL INFILE to a temporary staging table without any
+        index, which is then merged into the table with a single INSERT IGNORE
+        ... SELECT, the unique key on row_hash skipping the records that already
+        exist. Everything is done in one transaction, as for a batch of
+        insert_records.
+
+        :param table_name: The name of the table to load the records to.
+        :param file_path: The path of the file, within the local_infile_dir.
+        :param fields: The columns of the table, in the order of the file.
+        :param records: The records (as dictionaries) written to the file,
+                        passed on to on_batch_inserted.
+        :param database: The name of the database in which the table resides.
+        :param on_batch_inserted: A function called as
+                                  on_batch_inserted(execute, inserted_records)
+                                  before the records are committed, where
+                                  execute(query, params=None) runs a statement
+                                  in the same transaction.
+        :param checkpoint: The checkpoint of the load, recorded for the chunk
+                           before it is committed (see insert_records).
+        :param checkpoint_offset: The position of the first record of the
+                                  chunk in the records of the load.
+        :param on_batch_committed: A function called with the records once
+                                   they are committed, see insert_records.
+        :return: A tuple with the number of inserted, skipped (already existing)
+                 and failed records.
+        :raises mysql.connector.Error: If LOAD DATA LOCAL INFILE is not allowed
+                                       (see LOCAL_INFILE_ERROR_CODES).
+        """
+        staging_table = f'{table_name}_staging'
+        field_string = ', '.join(fields)
+        with self.connection(database=database) as db_conn:
+            cursor = db_conn.cursor()
+            try:
+                self._execute(cursor, f'DROP TEMPORARY TABLE IF EXISTS '
+                                      f'{staging_table}')
+                self._execute(cursor,
+                              f"""CREATE TEMPORARY TABLE {staging_table} AS
+                                  SELECT {field_string} FROM {table_name}
+                                  LIMIT 0""")
+                self._execute(cursor,
+                              f"""LOAD DATA LOCAL INFILE %s
+                                  INTO TABLE {staging_table}
+                                  CHARACTER SET utf8mb4
+                                  FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'
+                                  LINES TERMINATED BY '\\n'
+                                  ({field_string})""",
+                              (file_path,))
+                new_records = None
+                if on_batch_inserted is not None:
+                    existing = {row_hash for row_hash, in self._execute(
+                        cursor,
+                        f"""SELECT DISTINCT s.row_hash
+                            FROM {staging_table} s
+                            JOIN {table_name} t
+                            ON t.row_hash = s.row_hash""",
+                        fetch=True)}
+                    new_records = {}
+                    for record in records:
+                        if record['row_hash'] not in existing:
+                            new_records.setdefault(record['row_hash'], record)
+                    new_records = list(new_records.values())
+
+                self._execute(cursor,
+                              f"""INSERT IGNORE INTO {table_name}
+                                  ({field_string})
+                                  SELECT {field_string} FROM {staging_table}""")
+                inserted = cursor.rowcount
+                if new_records:
+                    if inserted != len(new_records):
+                        raise RuntimeError(
+                            f'{len(new_records) - inserted} records were '
+                            f'inserted concurrently, the chunk is rolled back '
+                            f'to keep the rollups consistent')
+                    on_batch_inserted(partial(self._execute, cursor),
+                                      new_records)
+                if checkpoint is not None:
+                    checkpoint.record(partial(self._execute, cursor),
+                                      checkpoint_offset, records)
+                self._commit(db_conn)
+                self._execute(cursor, f'DROP TEMPORARY TABLE {staging_table}')
+            except Exception as err:
+                db_conn.rollback()
+                if getattr(err, 'errno', None) in \
+                        self.LOCAL_INFILE_ERROR_CODES:
+                    raise
+                print(f'bulk load of {len(records)} records to {table_name} '
+                      f'failed due to error: {err}')
+                return 0, 0, len(records)
+            finally:
+                cursor.close()
+
+        if on_batch_committed is not None:
+            on_batch_committed(records)
+        return inserted, len(records) - inserted, 0
+
     def create_view(self, view_name, sql_query):
         """
         Method to create a view by passing the SQL query for creating the same.
@@ -392,10 +1755,503 @@ class MySqlDbConnector:
         """
         query = f'CREATE OR REPLACE VIEW  {view_name} AS (' + sql_query + ');'
         self._run_query(query=query)
-        self._run_query(query=f"""GRANT ALL PRIVILEGES ON 
+        self._run_query(query=f"""GRANT ALL PRIVILEGES ON
                                  {view_name} to 'analyst'""")
 
-        
+    def refresh_materialized_view(self,
+                                  view_name,
+                                  sql_query,
+                                  loaded_since=None,
+                                  database='spark_dwh'):
+        """
+        Method to store the result of a monitoring query in a backing table
+        (the view name with the suffix '_mat'), and create the view with the
+        same name reading from the backing table, so that reading the view
+        does not run the query again.
+
+        If loaded_since is given and the backing table exists, the refresh is
+        incremental: only the result rows whose last_updated_at is not older
+        than loaded_since, i.e. the rows loaded by the current run, are added.
+        Otherwise, the backing table is rebuilt from the whole query result and
+        swapped in with a single RENAME. An incremental refresh does not
+        revisit the rows of earlier runs, so a full rebuild is needed from time
+        to time for conditions depending on the current date or on rows of
+        other tables loaded later.
+
+        :param view_name: The name of the view to be created.
+        :param sql_query: The monitoring query. Its result must have a
+                          last_updated_at column for incremental refreshes.
+        :param loaded_since: The start time of the current run, or None to
+                             rebuild the backing table.
+        :param database: The name of the database to create the table and view
+                         in.
+        :return: The number of rows added to the backing table.
+        """
+        start = time.perf_counter()
+        table_name = f'{view_name}_mat'
+        exists = bool(self.get_table_columns(table_name, database=database))
+        if loaded_since is not None and exists:
+            with self.connection(database=database) as db_conn:
+                cursor = db_conn.cursor()
+                self._execute(cursor,
+                              f"""INSERT IGNORE INTO {table_name}
+                                  SELECT * FROM ({sql_query}) q
+                                  WHERE q.last_updated_at >= %s""",
+                              (str(loaded_since),))
+                rows_added = cursor.rowcount
+                cursor.close()
+                self._commit(db_conn)
+            mode = 'incremental'
+        else:
+            self._run_query(f'DROP TABLE IF EXISTS {table_name}_new',
+                            database=database)
+            self._run_query(f"""CREATE TABLE {table_name}_new AS
+                                SELECT * FROM ({sql_query}) q""",
+                            database=database)
+            if 'row_hash' in self.get_table_columns(f'{table_name}_new',
+                                                    database=database):
+                # rows found again by later incremental refreshes are ignored
+                self._run_query(f"""ALTER TABLE {table_name}_new
+                                    ADD UNIQUE KEY uq_row_hash (row_hash)""",
+                                database=database)
+            if exists:
+                self._run_query(f"""RENAME TABLE {table_name} TO {table_name}_old,
+                                    {table_name}_new TO {table_name}""",
+                                database=database)
+                self._run_query(f'DROP TABLE {table_name}_old',
+                                database=database)
+            else:
+                self._run_query(f'RENAME TABLE {table_name}_new TO {table_name}',
+                                database=database)
+            for name in [table_name, f'{table_name}_new']:
+                self._table_columns.pop((database, name), None)
+            rows_added = self._run_query(f'SELECT COUNT(*) FROM {table_name}',
+                                         return_results=True,
+                                         database=database)[0][0]
+            mode = 'full'
+
+        self.create_view(view_name, f'SELECT * FROM {table_name}')
+        print(f'refreshed {view_name} ({mode}) in '
+              f'{time.perf_counter() - start:.2f}s: {rows_added} rows added')
+        return rows_added
+
+
+def parse_retry_after(value, now=None):
+    """
+    Function to get the wait (in seconds) asked by the Retry-After header of a
+    response, given either as a number of seconds or as an HTTP date.
+
+    :param value: The value of the header, None if absent.
+    :param now: The current time (an aware datetime), by default the time of
+                the call.
+    :return: The number of seconds to wait (0 for a date in the past), None if
+             the header is absent or invalid.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if retry_at is None:
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    now = now or datetime.now(timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+class ApiFetchError(Exception):
+    """
+    Raised when a request to the API still fails once its retries are
+    exhausted.
+    """
+
+
+class ConcurrentPageFetcher:
+    """
+    This class is the engine used by SparkApiConnector to send its requests.
+    Requests are run on a thread pool whose size is the global limit on the
+    number of concurrent requests, are rate limited per host, and are retried
+    with exponential backoff and random jitter when the API answers 429 or 5xx
+    (or the connection fails). Pages of an end point are fetched several at a
+    time, but are always returned in page order. A page still failing once its
+    retries are exhausted raises an ApiFetchError, which stops the iteration
+    over the pages of its end point.
+
+    With a response_cache (see response_cache.py), the requests of the pages
+    already cached are conditional, and the pages not modified since are read
+    from the cache. In replay mode, the pages are only read from the cache.
+
+    With stream_json, the bodies of the responses are read in chunks and their
+    records decoded one at a time as they are received (see json_stream.py),
+    instead of buffering the whole body before decoding it.
+    """
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    STREAM_CHUNK_SIZE = 65536
+
+    def __init__(self,
+                 session,
+                 max_concurrency=8,
+                 requests_per_second=10,
+                 max_retries=5,
+                 backoff_base=0.5,
+                 backoff_max=30,
+                 response_cache=None,
+                 replay=False,
+                 stream_json=False,
+                 json_backend='auto'):
+        """
+        :param session: The requests session used to send the requests.
+        :param max_concurrency: The maximum number of requests in flight at
+                                once, over all the end points.
+        :param requests_per_second: The maximum rate of requests sent to each
+                                    host. No limit if None.
+        :param max_retries: The number of times a request is retried.
+        :param backoff_base: The wait (in seconds) before the first retry,
+                             doubled for each further retry.
+        :param backoff_max: The maximum wait (in seconds) between retries.
+        :param response_cache: The ResponseCache storing the responses, if any.
+        :param replay: Read the pages from the response_cache only, without
+                       sending any request.
+        :param stream_json: Decode the records of the responses incrementally,
+                            as their body is received.
+        :param json_backend: The incremental JSON parser, one of
+                             json_stream.JSON_BACKENDS.
+        """
+        if replay and response_cache is None:
+            raise ValueError('The replay mode requires a response cache')
+        if json_backend not in JSON_BACKENDS:
+            raise ValueError(f'Unknown JSON backend {json_backend}, expected '
+                             f'one of {JSON_BACKENDS}')
+        self._session = session
+        self._response_cache = response_cache
+        self._replay = replay
+        self.stream_json = stream_json
+        self._json_backend = json_backend
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._min_interval = (1 / requests_per_second
+                              if requests_per_second else 0)
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._next_request_at = {}
+        self._rate_lock = threading.Lock()
+
+    def _wait_for_rate_limit(self, url):
+        """
+        Convenience method to wait until the next request to the host of url is
+        allowed by the per host rate limit.
+
+        :param url: The url about to be requested.
+        """
+        if not self._min_interval:
+            return
+        host = urlparse(url).netloc
+        with self._rate_lock:
+            now = time.monotonic()
+            request_at = max(now, self._next_request_at.get(host, now))
+            self._next_request_at[host] = request_at + self._min_interval
+        if request_at > now:
+            time.sleep(request_at - now)
+
+    def _backoff(self, attempt, response=None):
+        """
+        Convenience method to wait before retrying a request. The Retry-After
+        header of the response is used if present, otherwise the wait grows
+        exponentially with the attempt number, with random jitter.
+
+        :param attempt: The number of the attempt that failed, starting at 0.
+        :param response: The response of the failed attempt, if any.
+        """
+        # a 4xx / 5xx response is falsy, hence the comparison with None
+        retry_after = (parse_retry_after(response.headers.get('Retry-After'))
+                       if response is not None else None)
+        if retry_after is not None:
+            # the server asks for this wait, so it is never shortened
+            delay = min(retry_after, self._backoff_max)
+        else:
+            delay = min(self._backoff_base * 2 ** attempt,
+                        self._backoff_max) * random.uniform(0.5, 1.5)
+        time.sleep(delay)
+
+    def fetch(self, url, params=None):
+        """
+        Method to fetch the JSON body of a url, retrying on 429 / 5xx responses
+        and connection errors. A request still failing once the retries are
+        exhausted is printed and raises an ApiFetchError: an empty list is
+        only returned for an empty page, so that a failed page is never taken
+        for the end of the data (and the high-water marks never move past
+        records that were not fetched).
+
+        :param url: The url to fetch.
+        :param params: The query parameters to send with the request.
+        """
+        return list(self.iter_records(url, params=params))
+
+    def _decode_body(self, body):
+        """
+        Convenience method decoding a cached body, a JSON array of records.
+        """
+        if self.stream_json:
+            return iter_json_array([body], backend=self._json_backend)
+        return json.loads(body)
+
+    def _read_records(self, response, cached_chunks):
+        """
+        Generator decoding the records of a streamed response as its body is
+        received (see json_stream.py).
+
+        :param response: The response, requested with stream=True.
+        :param cached_chunks: A list to which the chunks of the body are added,
+                              to store the body in the response cache, or None.
+        """
+        chunks = response.iter_content(chunk_size=self.STREAM_CHUNK_SIZE)
+        if cached_chunks is not None:
+            chunks = _collect(chunks, cached_chunks)
+        return iter_json_array(chunks, backend=self._json_backend)
+
+    def iter_records(self, url, params=None):
+        """
+        Generator yielding the records of the JSON array returned by a url,
+        retrying as fetch does. With stream_json, the records are decoded and
+        yielded as the body is received, without holding the whole body. If
+        the response fails after records were yielded, the request is retried
+        and the records already yielded are skipped.
+
+        :raises ApiFetchError: If the request still fails once the retries are
+                               exhausted, or (in replay mode) if the response
+                               is not cached.
+
+        :param url: The url to fetch.
+        :param params: The query parameters to send with the request.
+        """
+        end_point = urlparse(url).path.rstrip('/').rsplit('/', 1)[-1]
+        if self._replay:
+            body = self._response_cache.load(url, params)
+            metrics.inc('api_cache_total', end_point=end_point,
+                        result='replayed' if body is not None else 'missing')
+            if body is None:
+                raise ApiFetchError(f'No cached response to replay for end '
+                                    f'point {url} with {params}')
+            yield from self._decode_body(body)
+            return
+
+        headers = (self._response_cache.conditional_headers(url, params)
+                   if self._response_cache is not None else None)
+        yielded = 0
+        for attempt in range(self._max_retries + 1):
+            self._wait_for_rate_limit(url)
+            metrics.inc('api_requests_total', end_point=end_point)
+            try:
+                with metrics.timer('api_request_seconds', end_point=end_point):
+                    response = self._session.get(url, params=params,
+                                                 headers=headers,
+                                                 stream=self.stream_json)
+                if response.status_code == 200 and self.stream_json:
+                    cached_chunks = ([] if self._response_cache is not None
+                                     else None)
+                    records = self._read_records(response, cached_chunks)
+                    position = 0
+                    try:
+                        for record in records:
+                            position += 1
+                            if position > yielded:
+                                yielded = position
+                                yield record
+                    finally:
+                        response.close()
+                    if position < yielded:
+                        raise ValueError(f'the response has {position} '
+                                         f'records, {yielded} were already '
+                                         f'received')
+            except Exception as err:
+                metrics.inc('api_errors_total', end_point=end_point)
+                if attempt < self._max_retries:
+                    self._backoff(attempt)
+                    continue
+                print(f'''Failed to fetch data from endpoint
+                      {url} due to reason below:''')
+                print(err)
+                raise ApiFetchError(f'Failed to fetch {url} with {params} '
+                                    f'after {yielded} records: {err}') from err
+            # bytes received, before decompression when the response was gzipped
+            streamed = response.status_code == 200 and self.stream_json
+            metrics.inc('api_bytes_total',
+                        int(response.headers.get('Content-Length') or
+                            (response.raw.tell() if streamed
+                             else len(response.content))),
+                        end_point=end_point)
+            metrics.inc('api_responses_total', end_point=end_point,
+                        status=response.status_code)
+            if response.status_code in self.RETRY_STATUS_CODES and \
+                    attempt < self._max_retries:
+                self._backoff(attempt, response)
+                continue
+            if response.status_code == 304 and headers:
+                body = self._response_cache.load(url, params)
+                if body is not None:
+                    metrics.inc('api_cache_total', end_point=end_point,
+                                result='not_modified')
+                    yield from islice(self._decode_body(body), yielded, None)
+                    return
+                # the cached body disappeared, fetch the page again in full
+                headers = None
+                if attempt < self._max_retries:
+                    continue
+            if not SparkApiConnector._check_api_reponse(
+                    response=response,
+                    error_log_message=f"""Failed to fetch data from
+                                      end point {url} with {params}"""):
+                raise ApiFetchError(f'Failed to fetch {url} with {params}, '
+                                    f'status code {response.status_code}')
+            if self._response_cache is not None:
+                self._response_cache.store(
+                    url, params, (b''.join(cached_chunks) if streamed
+                                  else response.content),
+                    etag=response.headers.get('ETag'),
+                    last_modified=response.headers.get('Last-Modified'))
+                metrics.inc('api_cache_total', end_point=end_point,
+                            result='stored')
+            if not streamed:
+                yield from response.json()
+            return
+
+    def iter_pages(self, url, page_size, window=4, params=None, first_page=1):
+        """
+        Method to iterate over the pages of an API end point (using the 'page'
+        and 'limit' query parameters), in page order. Up to window pages are
+        requested concurrently. Iteration stops at the first page with less
+        than page_size records, the requests for the following pages are then
+        cancelled (or their results discarded).
+
+        :param url: The end point to fetch the pages from.
+        :param page_size: The number of records requested per page.
+        :param window: The maximum number of pages of this end point being
+                       fetched at once.
+        :param params: Further query parameters to send with every request.
+        :param first_page: The number of the first page to fetch.
+        """
+        in_flight = deque()
+        next_page = first_page
+
+        def submit():
+            nonlocal next_page
+            in_flight.append(self._executor.submit(
+                self.fetch, url, dict(params or {}, page=next_page,
+                                      limit=page_size)))
+            next_page += 1
+
+        try:
+            for _ in range(max(window, 1)):
+                submit()
+            while in_flight:
+                records = in_flight.popleft().result()
+                yield records
+                if len(records) < page_size:
+                    return
+                submit()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def iter_streamed_pages(self, url, page_size, params=None, first_page=1):
+        """
+        Method to iterate over the pages of an API end point one at a time, as
+        iter_pages does with a window of one page, each page being an iterator
+        over its records as they are received (see iter_records). A page must
+        be consumed before the next one is requested.
+
+        :param url: The end point to fetch the pages from.
+        :param page_size: The number of records requested per page.
+        :param params: Further query parameters to send with every request.
+        :param first_page: The number of the first page to fetch.
+        """
+        for page in count(first_page):
+            received = 0
+
+            def page_records(page=page):
+                nonlocal received
+                for record in self.iter_records(
+                        url, dict(params or {}, page=page, limit=page_size)):
+                    received += 1
+                    yield record
+
+            yield page_records()
+            if received < page_size:
+                return
+
+    def fetch_page_range(self, url, first_page, last_page, page_size,
+                         params=None):
+        """
+        Method to fetch a range of pages of an API end point concurrently. If
+        last_page is None, pages are fetched until the first page with less
+        than page_size records, as in iter_pages.
+
+        :param url: The end point to fetch the pages from.
+        :param first_page: The number of the first page (starting at 1).
+        :param last_page: The number of the last page, included, or None.
+        :param page_size: The number of records requested per page.
+        :param params: Further query parameters to send with every request.
+        :return: The list of records of the pages, in page order.
+        :raises ApiFetchError: If a page fails to be fetched.
+        """
+        if last_page is None:
+            return [record for records in self.iter_pages(
+                        url, page_size, params=params, first_page=first_page)
+                    for record in records]
+        futures = [self._executor.submit(self.fetch, url,
+                                         dict(params or {}, page=page,
+                                              limit=page_size))
+                   for page in range(first_page, last_page + 1)]
+        return [record for future in futures for record in future.result()]
+
+    def count_records(self, url, params=None):
+        """
+        Method to count the records of an API end point without fetching them,
+        by requesting pages of a single record (i.e. the record at a given
+        position): the positions are doubled until one is past the end, and
+        the end is then found by bisection, in about 2 * log2(count) requests.
+
+        :param url: The end point to count the records of.
+        :param params: Further query parameters to send with every request.
+        """
+        def exists(position):
+            return bool(self.fetch(url, dict(params or {}, page=position,
+                                              limit=1)))
+
+        if not exists(1):
+            return 0
+        low, high = 1, 2
+        while exists(high):
+            low, high = high, high * 2
+        # the record at low exists, the one at high does not
+        while high - low > 1:
+            middle = (low + high) // 2
+            if exists(middle):
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def fetch_all(self, sources):
+        """
+        Method to collect several record iterators (typically built on
+        iter_pages) concurrently. The requests of all of them share the global
+        concurrency limit.
+
+        :param sources: A dictionary mapping names to iterables of records.
+        :return: A dictionary mapping the names to the list of records of each
+                 source, in iteration order.
+        """
+        with ThreadPoolExecutor(max_workers=len(sources)) as collectors:
+            futures = {name: collectors.submit(list, records)
+                       for name, records in sources.items()}
+            return {name: future.result() for name, future in futures.items()}
+
 
 class SparkApiConnector:
     """
@@ -404,9 +2260,71 @@ class SparkApiConnector:
     following functionalities via the its public methods:
     - Fetch user, messages and subscription data as JSON files from the
       corresponding API end point.
+    - Iterate over the user and messages records page by page, so that only a
+      bounded number of pages is held in memory at any point.
+    - Fetch all the pages of the users and messages end points concurrently.
+    All requests are sent through a single keep-alive session, negotiating
+    gzip compressed responses, by a ConcurrentPageFetcher that limits the
+    concurrency and rate of the requests and retries the failed ones.
     """
-    def __init__(self, headers=None):
+    def __init__(self,
+                 headers=None,
+                 page_size=100,
+                 prefetch=2,
+                 max_concurrency=8,
+                 requests_per_second=10,
+                 max_retries=5,
+                 users_end_point=None,
+                 messages_end_point=None,
+                 response_cache=None,
+                 replay=False,
+                 stream_json=False,
+                 json_backend='auto'):
+        """
+        :param headers: Additional headers to send with every request.
+        :param page_size: The default number of records requested per page
+                          when iterating over an end point.
+        :param prefetch: The default number of pages fetched ahead, while the
+                         current page is being processed.
+        :param max_concurrency: The maximum number of requests in flight at
+                                once.
+        :param requests_per_second: The maximum rate of requests per host.
+        :param max_retries: The number of times a request answered with 429 /
+                            5xx (or failing to connect) is retried.
+        :param users_end_point: The default users end point, instead of
+                                USERS_END_POINT.
+        :param messages_end_point: The default messages end point, instead of
+                                   MESSAGES_END_POINT.
+        :param response_cache: The ResponseCache in which the raw responses are
+                               stored, and with which the requests of the
+                               pages already stored are made conditional.
+        :param replay: Read the responses from the response_cache only,
+                       without any request to the API.
+        :param stream_json: Decode the records of the responses as their body
+                            is received (see json_stream.py). With a prefetch
+                            of 0, the records of each page are also passed on
+                            as they are decoded, before the end of the page.
+        :param json_backend: The incremental JSON parser used with
+                             stream_json, one of json_stream.JSON_BACKENDS.
+        """
         self._headers = headers
+        self._users_end_point = users_end_point or USERS_END_POINT
+        self._messages_end_point = messages_end_point or MESSAGES_END_POINT
+        self._page_size = page_size
+        self._prefetch = prefetch
+        self._session = requests.Session()
+        self._session.headers.update({'Accept-Encoding': 'gzip'})
+        if headers:
+            self._session.headers.update(headers)
+        self._fetcher = ConcurrentPageFetcher(
+            self._session,
+            max_concurrency=max_concurrency,
+            requests_per_second=requests_per_second,
+            max_retries=max_retries,
+            response_cache=response_cache,
+            replay=replay,
+            stream_json=stream_json,
+            json_backend=json_backend)
 
     @staticmethod
     def _check_api_reponse(response, error_log_message):
@@ -424,27 +2342,74 @@ class SparkApiConnector:
             return False
         return True
         
-    def _fetch_data(self, end_point):
+    def _fetch_data(self, end_point, params=None):
         """
         Convenience method to fetch data from an API end point.
 
         :param end_point: The end point from which to receive the API response.
+        :param params: The query parameters to send with the request.
         """
-        try:
-            response = requests.get(end_point, headers=self._headers)
-        except Exception as err:
-            print(f'''Failed to fetch data from endpoint
-                  {end_point} due to reason below:''')
-            print(err)
-            print(f'HTTP response status code is {response.status_code}')
-            return []
-  
-        if not self._check_api_reponse(response=response,
-                                       error_log_message="""Failed to fetch
-                                       data from specified end point"""):
-            return []
-
-        return response.json()
+        return self._fetcher.fetch(end_point, params=params)
+
+    def _iter_records(self,
+                      end_point,
+                      page_size=None,
+                      prefetch=None,
+                      timestamp_field=None,
+                      since=None):
+        """
+        Convenience method to iterate over the records of an API end point,
+        page by page.
+
+        If since is given, only the records changed since then are returned:
+        the pages are requested newest first (sorting on timestamp_field) and
+        iteration stops at the first page reaching older records.
+
+        With stream_json and a prefetch of 0, the records of a page are yielded
+        as they are decoded (see ConcurrentPageFetcher.iter_streamed_pages).
+
+        :param end_point: The end point to fetch the records from.
+        :param page_size: The number of records requested per page.
+        :param prefetch: The number of pages fetched ahead in the background.
+        :param timestamp_field: The field holding the timestamp of the records.
+        :param since: A (timestamp, last_id) tuple. The records with a later
+                      timestamp are returned, as well as those with the same
+                      timestamp and a higher id if last_id is not None.
+        """
+        page_size = page_size or self._page_size
+        prefetch = self._prefetch if prefetch is None else prefetch
+        params = None
+        if since:
+            params = {'sortBy': timestamp_field, 'order': 'desc'}
+            since_timestamp, since_id = since
+
+            def is_new(record):
+                position = record_position(record, timestamp_field)
+                if since_id is None:
+                    return position[0] >= since_timestamp
+                return position > (since_timestamp,
+                                   record_position({'id': since_id},
+                                                   timestamp_field)[1])
+
+        if self._fetcher.stream_json and not prefetch:
+            pages = self._fetcher.iter_streamed_pages(end_point, page_size,
+                                                      params=params)
+        else:
+            pages = self._fetcher.iter_pages(end_point, page_size,
+                                             window=prefetch + 1,
+                                             params=params)
+        for records in pages:
+            if not since:
+                yield from records
+                continue
+            reached_old_records = False
+            for record in records:
+                if is_new(record):
+                    yield record
+                else:
+                    reached_old_records = True
+            if reached_old_records:
+                return
 
     def fetch_user_data(self, end_point=None):
         """
@@ -454,7 +2419,7 @@ class SparkApiConnector:
                           endpoint.
         """
         if not end_point:
-            end_point = 'https://619ca0ea68ebaa001753c9b0.mockapi.io/evaluation/dataengineer/jr/v1/users'
+            end_point = self._users_end_point
         
         return self._fetch_data(end_point=end_point)
 
@@ -466,6 +2431,119 @@ class SparkApiConnector:
                           endpoint.
         """
         if not end_point:
-            end_point = 'https://619ca0ea68ebaa001753c9b0.mockapi.io/evaluation/dataengineer/jr/v1/messages'
+            end_point = self._messages_end_point
         
-        return self._fetch_data(end_point=end_point)
\ No newline at end of file
+        return self._fetch_data(end_point=end_point)
+
+    def _end_point(self, end_point_name):
+        """
+        Convenience method to get the url of an end point from its name.
+
+        :param end_point_name: The name of the end point ('users', 'messages').
+        """
+        return {'users': self._users_end_point,
+                'messages': self._messages_end_point}[end_point_name]
+
+    def count_end_point_records(self, end_point_name):
+        """
+        Method to count the records of an API end point, see
+        ConcurrentPageFetcher.count_records.
+
+        :param end_point_name: The name of the end point ('users', 'messages').
+        """
+        return self._fetcher.count_records(self._end_point(end_point_name))
+
+    def fetch_end_point_pages(self, end_point_name, first_page, last_page,
+                              page_size=None):
+        """
+        Method to fetch a range of pages of an API end point concurrently,
+        e.g. a shard of the sharded execution mode (see sharding.py).
+
+        :param end_point_name: The name of the end point ('users', 'messages').
+        :param first_page: The number of the first page (starting at 1).
+        :param last_page: The number of the last page, included, or None to
+                          fetch all the pages from first_page on.
+        :param page_size: The number of records requested per page.
+        :return: The list of records of the pages, in page order.
+        """
+        return self._fetcher.fetch_page_range(self._end_point(end_point_name),
+                                              first_page, last_page,
+                                              page_size or self._page_size)
+
+    def fetch_users_and_messages_data(self,
+                                      users_end_point=None,
+                                      messages_end_point=None,
+                                      page_size=None,
+                                      prefetch=None,
+                                      since=None):
+        """
+        Method to fetch all the pages of the users and messages API end points
+        concurrently.
+
+        :param users_end_point: Use this parameter if required to change the
+                                default users endpoint.
+        :param messages_end_point: Use this parameter if required to change the
+                                   default messages endpoint.
+        :param page_size: The number of records requested per page.
+        :param prefetch: The number of pages of each end point fetched ahead.
+        :param since: A dictionary with a (timestamp, last_id) tuple for 'users'
+                      and / or 'messages', to only fetch the records changed
+                      since then (see iter_user_data / iter_messages_data).
+        :return: A tuple with the list of users and the list of messages, each
+                 in page order.
+        """
+        since = since or {}
+        data = self._fetcher.fetch_all(
+            {'users': self.iter_user_data(users_end_point,
+                                          page_size=page_size,
+                                          prefetch=prefetch,
+                                          since=since.get('users')),
+             'messages': self.iter_messages_data(messages_end_point,
+                                                 page_size=page_size,
+                                                 prefetch=prefetch,
+                                                 since=since.get('messages'))})
+        return data['users'], data['messages']
+
+    def iter_user_data(self,
+                       end_point=None,
+                       page_size=None,
+                       prefetch=None,
+                       since=None):
+        """
+        Method to iterate over the records of the users API end point, fetching
+        them page by page.
+
+        :param end_point: Use this parameter if required to change the default 
+                          endpoint.
+        :param page_size: The number of records requested per page.
+        :param prefetch: The number of pages fetched ahead in the background.
+        :param since: A (timestamp, last_id) tuple to only get the users
+                      updated since then (newest first).
+        """
+        return self._iter_records(end_point or self._users_end_point,
+                                  page_size=page_size,
+                                  prefetch=prefetch,
+                                  timestamp_field=API_TIMESTAMP_FIELDS['users'],
+                                  since=since)
+
+    def iter_messages_data(self,
+                           end_point=None,
+                           page_size=None,
+                           prefetch=None,
+                           since=None):
+        """
+        Method to iterate over the records of the messages API end point,
+        fetching them page by page.
+
+        :param end_point: Use this parameter if required to change the default 
+                          endpoint.
+        :param page_size: The number of records requested per page.
+        :param prefetch: The number of pages fetched ahead in the background.
+        :param since: A (timestamp, last_id) tuple to only get the messages
+                      created since then (newest first).
+        """
+        return self._iter_records(end_point or self._messages_end_point,
+                                  page_size=page_size,
+                                  prefetch=prefetch,
+                                  timestamp_field=API_TIMESTAMP_FIELDS['messages'],
+                                  since=since)
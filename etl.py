@@ -4,11 +4,31 @@ cleaning, transforming the data to remove / mask PII information
 load the data to the MySQL database.
 """
 
-from connectors import  MySqlDbConnector, SparkApiConnector
-from load import insert_message_data, insert_subscription_data, insert_user_data
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+import metrics
+from connectors import  (MySqlDbConnector, SparkApiConnector,
+                         API_TIMESTAMP_FIELDS, parse_api_timestamp,
+                         record_position)
+from json_stream import JSON_BACKENDS
+from masking import MASKING_STRATEGIES, create_masker
+from parquet_sink import PARQUET_COMPRESSIONS, ParquetSink
+from columnar import iter_columnar_user_chunks, transform_users_columnar
+from records import MessageBatch
+from response_cache import ResponseCache
+from rollups import create_rollup_tables, warn_if_rollups_exist
+from tracing import QueryTracer
+from load import (LoadSummary, RunCheckpoints, insert_message_data,
+                  insert_subscription_data, insert_user_data, parallel_load,
+                  split_key_ranges)
 from transform import (get_subscription_data, 
                        sanitize_sensitive_data_users, 
-                       create_monitoring_views)
+                       create_monitoring_views,
+                       get_latest_record,
+                       iter_sanitized_user_chunks)
 
 
 def get_root_password():
@@ -18,45 +38,633 @@ def get_root_password():
     """
     return open('root_credentials.txt', 'r').read()
 
-def etl_main():
+def get_masking_secret():
+    """
+    Example method to get the secret key used by the 'hmac' masking strategy.
+    Like the root password, in real life this can be an API call to a secrets
+    manager application. The key must be the same on every node running the
+    ETL, otherwise the masking ids will not match.
+    """
+    return os.environ.get('MASKING_SECRET')
+
+def get_extraction_start(db_connector, full_refresh=False, lookback_hours=24):
+    """
+    Get the point from which the records of each API end point are to be
+    extracted, based on the high-water marks stored by the previous run. To
+    catch records that arrive late or are updated shortly after being loaded,
+    extraction starts lookback_hours before the high-water mark. Records
+    extracted twice are skipped when loading, thanks to the row fingerprints.
+
+    :param db_connector: The database connector to read the watermarks with.
+    :param full_refresh: If set, all the records are extracted.
+    :param lookback_hours: The number of hours before the high-water mark from
+                           which extraction starts.
+    :return: A dictionary with a (timestamp, last_id) tuple per end point, to
+             pass as 'since' to the API connector.
+    """
+    since = {}
+    if full_refresh:
+        return since
+    for end_point_name in API_TIMESTAMP_FIELDS:
+        max_timestamp, last_id = db_connector.get_watermark(end_point_name)
+        max_timestamp = parse_api_timestamp(max_timestamp)
+        if not max_timestamp:
+            continue
+        if lookback_hours:
+            since[end_point_name] = (max_timestamp -
+                                     timedelta(hours=lookback_hours), None)
+        else:
+            since[end_point_name] = (max_timestamp, last_id)
+        print(f'extracting {end_point_name} from {since[end_point_name][0]}')
+    return since
+
+def update_watermark(db_connector, end_point_name, latest):
+    """
+    Store the latest of the records loaded from an API end point as its new
+    high-water mark, unless the stored one is already later.
+
+    :param db_connector: The database connector to write the watermark with.
+    :param end_point_name: The name of the end point ('users', 'messages').
+    :param latest: The (timestamp, id) tuple of the latest record loaded from
+                   the end point in this run, None if no record was loaded.
+    """
+    if not latest:
+        return
+    timestamp_field = API_TIMESTAMP_FIELDS[end_point_name]
+    max_timestamp, last_id = latest
+    stored_timestamp, stored_id = db_connector.get_watermark(end_point_name)
+    if stored_timestamp and \
+            record_position({timestamp_field: stored_timestamp, 'id': stored_id},
+                            timestamp_field) >= \
+            record_position({timestamp_field: max_timestamp, 'id': last_id},
+                            timestamp_field):
+        return
+    db_connector.set_watermark(end_point_name, max_timestamp, last_id)
+
+def track_latest_record(records, end_point_name, latest):
+    """
+    Generator passing the records of an API end point through unchanged, while
+    keeping the (timestamp, id) tuple of the latest one in latest[end_point_name].
+
+    :param records: An iterable of records of the end point.
+    :param end_point_name: The name of the end point ('users', 'messages').
+    :param latest: The dictionary to keep the latest record in.
+    """
+    timestamp_field = API_TIMESTAMP_FIELDS[end_point_name]
+    latest_position = None
+    for record in records:
+        position = record_position(record, timestamp_field)
+        if latest_position is None or position > latest_position:
+            latest_position = position
+            latest[end_point_name] = (record.get(timestamp_field),
+                                      record.get('id'))
+        yield record
+
+def _checkpoint(checkpoints, stream):
+    """
+    Convenience function to get the LoadCheckpoint of a load stream, None if
+    the loads are not checkpointed.
+
+    :param checkpoints: The RunCheckpoints of the run, if any.
+    :param stream: The name of the load stream.
+    """
+    return checkpoints.stream(stream) if checkpoints is not None else None
+
+def run_batch_pipeline(api_connector, db_connector, masker, root_password,
+                       since, load_workers=1, shard_size=10000,
+                       columnar=False, checkpoints=None, sink=None,
+                       rollups=False):
+    """
+    Run the extract, transform and load steps one after the other, each on the
+    whole data set. With several load workers, the three tables are loaded at
+    the same time, messages_raw being split into id range shards of about
+    shard_size records loaded concurrently as well (see parallel_load).
+
+    :param api_connector: The API connector to extract the data with.
+    :param db_connector: The database connector to load the data with.
+    :param masker: The masker used to mask the sensitive user fields.
+    :param root_password: The root password of the database.
+    :param since: The extraction start of each end point, see
+                  get_extraction_start.
+    :param load_workers: The number of loads running at once. 1 to load the
+                         tables one after the other.
+    :param shard_size: The number of messages per shard with several load
+                       workers.
+    :param columnar: If set, the users are transformed with the columnar path
+                     (see columnar.py) instead of the row path.
+    :param checkpoints: The RunCheckpoints with which the loaded batches are
+                        committed, if any.
+    :param sink: The ParquetSink the loaded records are also written to, if
+                 any.
+    :param rollups: If set, the rollup tables (see rollups.py) are updated
+                    with the loaded records.
+    :return: A tuple with the LoadSummary of the run and a dictionary with the
+             latest record extracted from each end point.
+    """
+    summary = LoadSummary()
+    with metrics.stage_timer('extract'):
+        api_users_data, api_messages_data = \
+            api_connector.fetch_users_and_messages_data(since=since)
+    metrics.inc('stage_records_total', len(api_users_data), stage='extract',
+                direction='out', end_point='users')
+    metrics.inc('stage_records_total', len(api_messages_data),
+                stage='extract', direction='out', end_point='messages')
+    latest = {'users': get_latest_record(api_users_data,
+                                         API_TIMESTAMP_FIELDS['users']),
+              'messages': get_latest_record(api_messages_data,
+                                            API_TIMESTAMP_FIELDS['messages'])}
+    # only the columns of messages_raw are kept until the messages are loaded
+    api_messages_data = MessageBatch.from_api(api_messages_data)
+
+    metrics.inc('stage_records_total', len(api_users_data),
+                stage='transform', direction='in')
+    with metrics.stage_timer('transform'):
+        if columnar:
+            api_users_data, api_subscription_data = \
+                transform_users_columnar(api_users_data, masker)
+        else:
+            api_subscription_data = get_subscription_data(api_users_data)
+            api_users_data = sanitize_sensitive_data_users(
+                api_users_data,
+                root_password=root_password,
+                db_connector=db_connector,
+                masker=masker)
+    metrics.inc('stage_records_total', len(api_users_data),
+                stage='transform', direction='out')
+
+    with metrics.stage_timer('load'):
+        _load_batch(db_connector, root_password, summary, api_users_data,
+                    api_subscription_data, api_messages_data, load_workers,
+                    shard_size, prepared=columnar, checkpoints=checkpoints,
+                    sink=sink, rollups=rollups)
+    return summary, latest
+
+def _load_batch(db_connector, root_password, summary, api_users_data,
+                api_subscription_data, api_messages_data, load_workers,
+                shard_size, prepared=False, checkpoints=None, sink=None,
+                rollups=False):
+    """
+    Convenience function running the load step of run_batch_pipeline.
+
+    :param db_connector: The database connector to load the data with.
+    :param root_password: The root password of the database.
+    :param summary: The LoadSummary to add the counts to.
+    :param api_users_data: The list of sanitised users.
+    :param api_subscription_data: The list of subscriptions.
+    :param api_messages_data: The messages, as a MessageBatch.
+    :param load_workers: The number of loads running at once.
+    :param shard_size: The number of messages per shard with several load
+                       workers.
+    :param prepared: If set, the users and subscriptions are already records
+                     of the raw tables (see columnar.py).
+    :param checkpoints: The RunCheckpoints of the run, if any. Each table, and
+                        each shard of messages_raw, is a load stream.
+    :param sink: The ParquetSink the records are also written to, if any.
+    :param rollups: If set, the rollup tables are updated as well.
+    """
+    if load_workers > 1:
+        load_args = {'db_user': 'root', 'db_password': root_password,
+                     'db_connector': db_connector, 'sink': sink,
+                     'update_rollups': rollups}
+        num_shards = max(1, min(load_workers,
+                                len(api_messages_data) // shard_size))
+        load_tasks = ([('users_raw', insert_user_data, api_users_data,
+                        dict(load_args, prepared=prepared,
+                             checkpoint=_checkpoint(checkpoints,
+                                                    'users_raw'))),
+                       ('subscriptions_raw', insert_subscription_data,
+                        api_subscription_data,
+                        dict(load_args, prepared=prepared,
+                             checkpoint=_checkpoint(checkpoints,
+                                                    'subscriptions_raw')))] +
+                      [('messages_raw', insert_message_data, shard,
+                        dict(load_args, checkpoint=_checkpoint(
+                            checkpoints, f'messages_raw/shard-{shard_no}')))
+                       for shard_no, shard in enumerate(split_key_ranges(
+                           api_messages_data, 'id', num_shards))])
+        parallel_load(load_tasks, summary, max_workers=load_workers)
+        return
+
+    insert_user_data(api_users_data, 'root', root_password,
+                     db_connector=db_connector, summary=summary,
+                     prepared=prepared, sink=sink, update_rollups=rollups,
+                     checkpoint=_checkpoint(checkpoints, 'users_raw'))
+    insert_subscription_data(api_subscription_data, 'root', root_password,
+                             db_connector=db_connector, summary=summary,
+                             prepared=prepared, sink=sink,
+                             update_rollups=rollups,
+                             checkpoint=_checkpoint(checkpoints,
+                                                    'subscriptions_raw'))
+    insert_message_data(api_messages_data,  'root', root_password,
+                        db_connector=db_connector, summary=summary, sink=sink,
+                        update_rollups=rollups,
+                        checkpoint=_checkpoint(checkpoints, 'messages_raw'))
+
+def run_streaming_pipeline(api_connector, db_connector, masker, root_password,
+                           since, chunk_size=1000, columnar=False,
+                           checkpoints=None, sink=None, rollups=False):
+    """
+    Run the extract, transform and load steps as a chain of generator stages,
+    working on chunks of chunk_size records: each chunk of users is sanitised,
+    split from its subscriptions and loaded before the next chunk is fetched,
+    and the messages are loaded batch by batch as they are fetched. Memory
+    use therefore stays flat as the data grows.
+
+    :param api_connector: The API connector to extract the data with.
+    :param db_connector: The database connector to load the data with.
+    :param masker: The masker used to mask the sensitive user fields.
+    :param root_password: The root password of the database.
+    :param since: The extraction start of each end point, see
+                  get_extraction_start.
+    :param chunk_size: The number of users processed per chunk.
+    :param columnar: If set, the users are transformed with the columnar path
+                     (see columnar.py) instead of the row path.
+    :param checkpoints: The RunCheckpoints with which the loaded batches are
+                        committed, if any. Each chunk of users is a load
+                        stream.
+    :param sink: The ParquetSink the loaded records are also written to, if
+                 any.
+    :param rollups: If set, the rollup tables (see rollups.py) are updated
+                    with the loaded records.
+    :return: A tuple with the LoadSummary of the run and a dictionary with the
+             latest record extracted from each end point.
+    """
+    summary = LoadSummary()
+    latest = {}
+    api_users_data = metrics.count_records(
+        track_latest_record(
+            api_connector.iter_user_data(since=since.get('users')),
+            'users', latest),
+        stage='extract', direction='out')
+    iter_user_chunks = (iter_columnar_user_chunks if columnar
+                        else iter_sanitized_user_chunks)
+    for chunk_no, (users_chunk, subscriptions_chunk) in enumerate(
+            iter_user_chunks(api_users_data, masker, chunk_size)):
+        metrics.inc('stage_records_total', len(users_chunk),
+                    stage='transform', direction='out')
+        with metrics.stage_timer('load'):
+            insert_user_data(users_chunk, 'root', root_password,
+                             db_connector=db_connector, summary=summary,
+                             prepared=columnar, sink=sink,
+                             update_rollups=rollups,
+                             checkpoint=_checkpoint(
+                                 checkpoints, f'users_raw/chunk-{chunk_no}'))
+            insert_subscription_data(subscriptions_chunk, 'root',
+                                     root_password, db_connector=db_connector,
+                                     summary=summary, prepared=columnar,
+                                     sink=sink, update_rollups=rollups,
+                                     checkpoint=_checkpoint(
+                                         checkpoints,
+                                         f'subscriptions_raw/chunk-{chunk_no}'))
+
+    api_messages_data = metrics.count_records(
+        track_latest_record(
+            api_connector.iter_messages_data(since=since.get('messages')),
+            'messages', latest),
+        stage='extract', direction='out')
+    # fetching the messages is interleaved with loading them, both are timed
+    with metrics.stage_timer('extract_and_load_messages'):
+        insert_message_data(api_messages_data, 'root', root_password,
+                            db_connector=db_connector, summary=summary,
+                            sink=sink, update_rollups=rollups,
+                            checkpoint=_checkpoint(checkpoints, 'messages_raw'))
+    return summary, latest
+
+def etl_main(masking_strategy='auto_increment',
+             full_refresh=False,
+             lookback_hours=24,
+             streaming=False,
+             chunk_size=1000,
+             typed_schema=False,
+             materialized_monitoring=False,
+             bulk_load=True,
+             load_workers=1,
+             metrics_dir='run_metrics',
+             columnar=False,
+             resume=False,
+             response_cache_dir=None,
+             replay=False,
+             trace_queries=False,
+             slow_query_seconds=1.0,
+             trace_top_n=15,
+             parquet_dir=None,
+             parquet_compression='zstd',
+             stream_json=False,
+             json_backend='auto',
+             prefetch=2,
+             rollups=False):
     """
     Main function performing all the steps such as extracting the data from the 
     given API end points, sanitising the data to remove PII related information 
     and load the same to the database. In addition, some views are also created 
     in the database for data quality monitoring.
+
+    :param masking_strategy: The strategy used to mask the sensitive user
+                             fields, 'auto_increment' (ids of the sensitive
+                             tables) or 'hmac' (keyed hash of the values).
+    :param full_refresh: If set, all the records are extracted from the API,
+                         rather than only the ones newer than the high-water
+                         marks of the previous run.
+    :param lookback_hours: The number of hours before the high-water marks
+                           from which records are extracted again.
+    :param streaming: If set, run the pipeline in streaming mode (see
+                      run_streaming_pipeline), keeping memory use flat.
+    :param chunk_size: The number of records per chunk in streaming mode.
+    :param typed_schema: If set, the raw tables are created (or migrated) with
+                         typed columns and indexes instead of VARCHAR columns.
+    :param materialized_monitoring: If set, the monitoring views read from
+                                    backing tables refreshed with the rows
+                                    loaded by this run (rebuilt on a full
+                                    refresh), instead of running their query
+                                    on every read.
+    :param bulk_load: If set, large loads (see BULK_LOAD_THRESHOLD) use LOAD
+                      DATA LOCAL INFILE, or batched INSERTs if the server does
+                      not allow it.
+    :param load_workers: The number of loads running at once in batch mode,
+                         see run_batch_pipeline.
+    :param metrics_dir: The directory the metrics of the run are written to,
+                        as JSON and in the Prometheus text format. None to not
+                        write them.
+    :param columnar: If set, the users are transformed with the columnar path
+                     (see columnar.py), which requires pandas.
+    :param resume: If set, and the previous run did not succeed, that run is
+                   continued: the batches it already committed (see
+                   load.LoadCheckpoint) are skipped.
+    :param response_cache_dir: The directory in which the raw API responses
+                               are stored (see response_cache.py), and with
+                               which they are requested conditionally. None
+                               to not store them.
+    :param replay: If set, the API responses are read from response_cache_dir
+                   only, without any request to the API.
+    :param trace_queries: If set, all the database statements are traced (see
+                          tracing.QueryTracer) and the most expensive ones
+                          are reported at the end of the run.
+    :param slow_query_seconds: The latency above which a traced statement is
+                               logged in full.
+    :param trace_top_n: The number of statements in the end-of-run report.
+    :param parquet_dir: The directory to which the loaded records are also
+                        written as date partitioned Parquet files (see
+                        parquet_sink.py), which requires pyarrow. None to
+                        only load them to MySQL.
+    :param parquet_compression: The compression of the Parquet files, 'zstd'
+                                or 'snappy'.
+    :param stream_json: If set, the API responses are decoded record by record
+                        as they are received (see json_stream.py), instead of
+                        buffering whole bodies.
+    :param json_backend: The incremental JSON parser used with stream_json,
+                         one of JSON_BACKENDS.
+    :param prefetch: The number of pages of each end point fetched ahead. With
+                     stream_json and streaming, 0 passes the records of each
+                     page to the transform as they are decoded.
+    :param rollups: If set, the rollup tables (see rollups.py) are created,
+                    backfilled if new, and updated with the loaded records,
+                    at the cost of a lookup of the row fingerprints of each
+                    batch.
     """
-    api_connector = SparkApiConnector()
+    response_cache = (ResponseCache(response_cache_dir)
+                      if response_cache_dir else None)
+    api_connector = SparkApiConnector(response_cache=response_cache,
+                                      replay=replay,
+                                      prefetch=prefetch,
+                                      stream_json=stream_json,
+                                      json_backend=json_backend)
     root_password = get_root_password()
-    db_connector = MySqlDbConnector(username='root', password=root_password)
+    local_infile_dir = tempfile.gettempdir() if bulk_load else None
+    sink = (ParquetSink(parquet_dir, compression=parquet_compression)
+            if parquet_dir else None)
+    query_tracer = (QueryTracer(slow_query_seconds=slow_query_seconds)
+                    if trace_queries else None)
+    # a connection per load worker, plus one for the masking and watermarks
+    db_connector = MySqlDbConnector(username='root', password=root_password,
+                                    pool_size=max(5, load_workers + 1),
+                                    local_infile_dir=local_infile_dir,
+                                    query_tracer=query_tracer)
     
     print('Checking if database server is up!')
     db_connector.check_db_availability(max_retries=20)
 
-    db_connector.initialise_db_and_create_tables(drop_if_exists=False)
+    db_connector.initialise_db_and_create_tables(drop_if_exists=False,
+                                                 typed_schema=typed_schema)
+    if rollups:
+        create_rollup_tables(db_connector)
+    else:
+        warn_if_rollups_exist(db_connector)
+
+    since = get_extraction_start(db_connector,
+                                 full_refresh=full_refresh,
+                                 lookback_hours=lookback_hours)
+    masking_secret = get_masking_secret() if masking_strategy == 'hmac' else None
+    masker = create_masker(masking_strategy, db_connector, masking_secret)
+    run_id = db_connector.start_etl_run(resume=resume)
+    checkpoints = RunCheckpoints(db_connector, run_id)
+    run_start = datetime.now()
+    run_start_time = time.perf_counter()
+    if streaming:
+        summary, latest = run_streaming_pipeline(api_connector, db_connector,
+                                                 masker, root_password, since,
+                                                 chunk_size=chunk_size,
+                                                 columnar=columnar,
+                                                 checkpoints=checkpoints,
+                                                 sink=sink, rollups=rollups)
+    else:
+        summary, latest = run_batch_pipeline(api_connector, db_connector,
+                                             masker, root_password, since,
+                                             load_workers=load_workers,
+                                             columnar=columnar,
+                                             checkpoints=checkpoints,
+                                             sink=sink, rollups=rollups)
+    if sink is not None:
+        with metrics.stage_timer('parquet'):
+            sink.close()
+    summary.print_summary()
+    metrics.set_gauge('run_pipeline_seconds',
+                      time.perf_counter() - run_start_time,
+                      mode='streaming' if streaming else 'batch')
 
-    api_users_data = api_connector.fetch_user_data()
-    api_messages_data = api_connector.fetch_messages_data()
-    api_subscription_data = get_subscription_data(api_users_data)
+    raw_tables = ['users_raw', 'subscriptions_raw', 'messages_raw']
+    for table_name in raw_tables:
+        if not summary.all_inserted(table_name):
+            print(f'Error: One or more records could not be inserted \
+                   successully in {table_name} table!')
+    db_connector.finish_etl_run(run_id, all(summary.all_inserted(table_name)
+                                            for table_name in raw_tables))
 
-    api_users_data = sanitize_sensitive_data_users(api_users_data, 
-                                                   root_password=root_password)
-    if not insert_user_data(api_users_data, 'root', root_password):
-        print('Error: One or more records could not be inserted \
-               successully in users table!')
-    if not insert_subscription_data(api_subscription_data, 'root', root_password):
-        print('Error: One or more records could not be inserted \
-               successully in subscriptions table!')
-    if not insert_message_data(api_messages_data,  'root', root_password):
-        print('Error: One or more records could not be inserted \
-               successully in messages table!')
+    # the high-water marks only move forward if all the records were loaded
+    if summary.all_inserted('users_raw') and \
+            summary.all_inserted('subscriptions_raw'):
+        update_watermark(db_connector, 'users', latest.get('users'))
+    if summary.all_inserted('messages_raw'):
+        update_watermark(db_connector, 'messages', latest.get('messages'))
 
     print('creating monitoring views..')
-    create_monitoring_views('root', root_password)
+    with metrics.stage_timer('monitoring'):
+        create_monitoring_views('root', root_password,
+                                db_connector=db_connector,
+                                materialized=materialized_monitoring,
+                                loaded_since=None if full_refresh else run_start)
+    masker.close()
+    masker.report()
+    db_connector.close()
+
+    if query_tracer is not None:
+        print(f'top {trace_top_n} statements by total time:')
+        print(query_tracer.report(top_n=trace_top_n))
+        print(f'top {trace_top_n} statements by number of calls:')
+        print(query_tracer.report(top_n=trace_top_n, sort_by='calls'))
+
+    metrics.set_gauge('run_seconds', time.perf_counter() - run_start_time)
+    metrics.set_gauge('run_timestamp_seconds', time.time())
+    if metrics_dir:
+        json_path, prometheus_path = metrics.write_metrics(metrics_dir)
+        print(f'run metrics written to {json_path} and {prometheus_path}')
 
     print("""All data ingested. please login to the mysql server running at
              localhost:3306 for accessing the data
              within the schema 'spark_dwh'
     """)
 
+def parse_args():
+    """
+    Parse the command line arguments of the ETL script.
+    """
+    parser = argparse.ArgumentParser(description='Run the spark ETL process.')
+    parser.add_argument('--masking-strategy',
+                        choices=MASKING_STRATEGIES,
+                        default='auto_increment',
+                        help='Strategy used to mask city, zipcode and '
+                             'profession. hmac requires the secret key in '
+                             'the MASKING_SECRET environment variable.')
+    parser.add_argument('--full-refresh',
+                        action='store_true',
+                        help='Extract all the records from the API instead of '
+                             'only the ones newer than the stored high-water '
+                             'marks.')
+    parser.add_argument('--lookback-hours',
+                        type=float,
+                        default=24,
+                        help='Number of hours before the high-water marks '
+                             'from which records are extracted again, to '
+                             'catch late arriving updates.')
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        help='Process the records chunk by chunk as they are '
+                             'fetched, instead of extracting all of them '
+                             'before loading.')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=1000,
+                        help='Number of records per chunk in streaming mode.')
+    parser.add_argument('--typed-schema',
+                        action='store_true',
+                        help='Use typed and indexed raw tables, migrating the '
+                             'existing VARCHAR tables in place.')
+    parser.add_argument('--materialized-monitoring',
+                        action='store_true',
+                        help='Store the monitoring query results in tables '
+                             'refreshed incrementally at the end of each run, '
+                             'instead of plain views.')
+    parser.add_argument('--no-bulk-load',
+                        action='store_true',
+                        help='Always load the records with batched INSERTs, '
+                             'never with LOAD DATA LOCAL INFILE.')
+    parser.add_argument('--load-workers',
+                        type=int,
+                        default=1,
+                        help='Number of loads running at once in batch mode: '
+                             'the tables, and id range shards of the messages, '
+                             'are loaded concurrently.')
+    parser.add_argument('--metrics-dir',
+                        default='run_metrics',
+                        help='Directory the metrics of the run are written to '
+                             '(etl_run.json and etl_run.prom).')
+    parser.add_argument('--columnar',
+                        action='store_true',
+                        help='Transform the users column by column with '
+                             'pandas instead of one record at a time.')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Continue the previous run if it did not '
+                             'succeed, skipping the batches it already '
+                             'committed.')
+    parser.add_argument('--response-cache-dir',
+                        default=None,
+                        help='Directory in which the raw API responses are '
+                             'stored compressed, the pages not modified since '
+                             'being read from it.')
+    parser.add_argument('--replay',
+                        action='store_true',
+                        help='Read the API responses from the response cache '
+                             'only, without any request (requires '
+                             '--response-cache-dir).')
+    parser.add_argument('--trace-queries',
+                        action='store_true',
+                        help='Trace all the database statements and report '
+                             'the most expensive ones at the end of the run.')
+    parser.add_argument('--slow-query-seconds',
+                        type=float,
+                        default=1.0,
+                        help='Latency above which a traced statement is '
+                             'logged in full.')
+    parser.add_argument('--trace-top-n',
+                        type=int,
+                        default=15,
+                        help='Number of statements in the query trace report.')
+    parser.add_argument('--parquet-dir',
+                        default=None,
+                        help='Directory to which the loaded records are also '
+                             'written as Parquet files partitioned by the '
+                             'date of created_at (requires pyarrow).')
+    parser.add_argument('--parquet-compression',
+                        choices=PARQUET_COMPRESSIONS,
+                        default='zstd',
+                        help='Compression of the Parquet files.')
+    parser.add_argument('--stream-json',
+                        action='store_true',
+                        help='Decode the API responses record by record as '
+                             'they are received instead of buffering them.')
+    parser.add_argument('--json-backend',
+                        choices=JSON_BACKENDS,
+                        default='auto',
+                        help='Incremental JSON parser used with --stream-json '
+                             '(ijson if installed by default).')
+    parser.add_argument('--prefetch',
+                        type=int,
+                        default=2,
+                        help='Number of pages of each end point fetched '
+                             'ahead. With --stream-json and --streaming, 0 '
+                             'passes the records of each page on as they are '
+                             'decoded.')
+    parser.add_argument('--rollups',
+                        action='store_true',
+                        help='Maintain the rollup tables of '
+                             'sql_queries/sql_test_rollups.sql while loading.')
+    args = parser.parse_args()
+    if args.replay and not args.response_cache_dir:
+        parser.error('--replay requires --response-cache-dir')
+    return args
+
 if __name__ == '__main__':
-    etl_main()
+    args = parse_args()
+    etl_main(masking_strategy=args.masking_strategy,
+             full_refresh=args.full_refresh,
+             lookback_hours=args.lookback_hours,
+             streaming=args.streaming,
+             chunk_size=args.chunk_size,
+             typed_schema=args.typed_schema,
+             materialized_monitoring=args.materialized_monitoring,
+             bulk_load=not args.no_bulk_load,
+             load_workers=args.load_workers,
+             metrics_dir=args.metrics_dir,
+             columnar=args.columnar,
+             resume=args.resume,
+             response_cache_dir=args.response_cache_dir,
+             replay=args.replay,
+             trace_queries=args.trace_queries,
+             slow_query_seconds=args.slow_query_seconds,
+             trace_top_n=args.trace_top_n,
+             parquet_dir=args.parquet_dir,
+             parquet_compression=args.parquet_compression,
+             stream_json=args.stream_json,
+             json_backend=args.json_backend,
+             prefetch=args.prefetch,
+             rollups=args.rollups)
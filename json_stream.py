@@ -0,0 +1,208 @@
+"""
+This module contains the incremental parser of the API responses, used by the
+SparkApiConnector with stream_json: the body of a response, a JSON array of
+records, is read chunk by chunk as it is received and each record is decoded
+as soon as it is complete, instead of buffering the whole body and then
+building the whole tree of objects (as response.json() does).
+
+Two backends are available:
+- 'scanner': each element of the top-level array is decoded with the scanner
+  of the json module (JSONDecoder.raw_decode) from the text read so far, only
+  the undecoded end of the text being kept between chunks.
+- 'ijson': the ijson package parses the chunks incrementally (with its yajl2
+  C backend if available). The numbers are read as int / Decimal, as the C
+  backend overflows on integers beyond 64 bits when reading floats directly,
+  the Decimal values being then converted to float as the json module does.
+
+By default ('auto'), ijson is used if it is installed (it is an optional
+dependency), the scanner otherwise. Both give the same values as
+response.json(), apart from the NaN and Infinity constants, which are only
+accepted by the scanner.
+"""
+import codecs
+import json
+import re
+from decimal import Decimal
+from itertools import chain
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+JSON_BACKENDS = ['auto', 'scanner', 'ijson']
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# the types of the values read by ijson that are kept as they are
+_PLAIN_TYPES = {str, int, bool, type(None)}
+
+
+def default_backend():
+    """
+    Function to get the backend used by 'auto', see the module docstring.
+    """
+    return 'ijson' if ijson is not None else 'scanner'
+
+
+def _scan_array(chunks):
+    """
+    Generator yielding the elements of a top-level JSON array, decoded one at
+    a time from the chunks of the document with the scanner of the json module
+    (JSONDecoder.raw_decode). An element that fails to decode is decoded again
+    once the next chunk is read, as it may not be complete yet.
+
+    :param chunks: An iterable of the chunks (as bytes) of the document.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+    empty = True
+    chunks = iter(chunks)
+    last_chunk = False
+    while not last_chunk:
+        chunk = next(chunks, None)
+        if chunk is None:
+            last_chunk = True
+            chunk = b''
+        buffer = buffer[position:] + decoder.decode(chunk, final=last_chunk)
+        position = 0
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('The JSON document is not an array')
+                started = True
+                position += 1
+                continue
+            if empty and buffer[position] == ']':
+                # the ] of an empty array may come in a later chunk than the [
+                _check_end(buffer[position + 1:], chunks)
+                return
+            try:
+                element, end = _DECODER.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if last_chunk:
+                    raise
+                break
+            separator = _WHITESPACE.match(buffer, end).end()
+            if not buffer.startswith((',', ']'), separator):
+                if not last_chunk:
+                    # a number may continue in the next chunk, e.g. 2. of 2.5
+                    break
+                raise ValueError(f'Expected , or ] at position {separator} '
+                                 f'of the JSON array')
+            yield element
+            empty = False
+            position = separator + 1
+            if buffer[separator] == ']':
+                _check_end(buffer[position:], chunks)
+                return
+    raise ValueError('The JSON document ended before the end of the array')
+
+
+def _check_end(rest, chunks):
+    """
+    Convenience function checking that only whitespace follows the array.
+    """
+    for chunk in chain([rest.encode()], chunks):
+        if chunk.strip():
+            raise ValueError('Unexpected data after the end of the JSON array')
+
+
+class _ChunkReader:
+    """
+    File-like object reading from an iterable of chunks, as ijson expects.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        if size == 0:
+            # ijson reads 0 bytes first to check the type of the file
+            return b''
+        for chunk in self._chunks:
+            if chunk:
+                return chunk
+        return b''
+
+
+def _to_float(value):
+    """
+    Convenience function converting the Decimal values read by ijson to float,
+    within objects and arrays as well.
+    """
+    value_type = type(value)
+    if value_type is Decimal:
+        return float(value)
+    if value_type is dict:
+        return {key: _to_float(item) for key, item in value.items()}
+    if value_type is list:
+        return [_to_float(item) for item in value]
+    return value
+
+
+def _share_keys(elements, decimals=False):
+    """
+    Generator passing the elements of an array on, the keys of the elements
+    that are objects being shared between them: as json.loads does for a whole
+    document, a key is then held once rather than once per record.
+
+    :param elements: An iterable of the elements.
+    :param decimals: Convert the Decimal values of the elements to float.
+    """
+    keys = {}
+    for element in elements:
+        if type(element) is dict:
+            if decimals:
+                element = {keys.setdefault(key, key):
+                           value if type(value) in _PLAIN_TYPES
+                           else _to_float(value)
+                           for key, value in element.items()}
+            else:
+                element = {keys.setdefault(key, key): value
+                           for key, value in element.items()}
+        elif decimals:
+            element = _to_float(element)
+        yield element
+
+
+def iter_json_array(chunks, backend='auto'):
+    """
+    Generator yielding the elements of a top-level JSON array (typically the
+    records of a page of the API), decoded one at a time as the chunks of the
+    document are read.
+
+    :param chunks: An iterable of the chunks (as bytes) of the document, e.g.
+                   response.iter_content(chunk_size).
+    :param backend: The parser to use, one of JSON_BACKENDS.
+    :raises ValueError: If the document is not a JSON array, or is invalid.
+    """
+    if backend not in JSON_BACKENDS:
+        raise ValueError(f'Unknown JSON backend {backend}, expected one of '
+                         f'{JSON_BACKENDS}')
+    if backend == 'auto':
+        backend = default_backend()
+    if backend == 'ijson':
+        if ijson is None:
+            raise ImportError('The ijson backend requires the ijson package, '
+                              'install it with "pip install ijson".')
+        chunks = iter(chunks)
+        first_chunk = b''
+        for first_chunk in chunks:
+            if first_chunk.strip():
+                break
+        if not first_chunk.lstrip().startswith(b'['):
+            raise ValueError('The JSON document is not an array')
+        try:
+            yield from _share_keys(ijson.items(
+                _ChunkReader(chain([first_chunk], chunks)), 'item'),
+                decimals=True)
+        except ijson.JSONError as err:
+            raise ValueError(f'Invalid JSON document: {err}') from err
+        return
+    yield from _share_keys(_scan_array(chunks))
@@ -1,60 +1,480 @@
 """
-This module contains all functions associated with inserting data from the 
+This module contains all functions associated with inserting data from the
 API to the database, specifically the users, messages and subscription data.
 """
-from datetime import datetime
-from connectors import MySqlDbConnector
+import hashlib
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from itertools import chain, islice
+import metrics
+from connectors import (MySqlDbConnector, compute_row_hash, iter_batches,
+                        parse_api_timestamp)
+from records import (MessageRecord, SubscriptionRecord, UserRecord,
+                     map_record_values, str_record)
+from rollups import ROLLUP_HOOKS
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return int(value.strip().lower() in ('true', '1', 'yes'))
+    return int(bool(value))
+
+
+def _to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return parse_api_timestamp(str(value))
+
+
+def _to_date(value):
+    value = _to_datetime(value)
+    return value.date() if value is not None else None
+
+
+# converters of the API values to the Python types of the typed columns, keyed
+# by the data type of the columns (as in information_schema)
+TYPE_CONVERTERS = {'int': int,
+                   'bigint': int,
+                   'tinyint': _to_bool,
+                   'decimal': lambda value: Decimal(str(value)),
+                   'datetime': _to_datetime,
+                   'date': _to_date}
+
+
+def coerce_record(record, column_types):
+    """
+    Function to convert the values of a record to the types of the columns of
+    a typed table (see TYPED_RAW_TABLES). Missing values, and values that
+    cannot be converted, are written as NULL. Columns without a converter
+    (VARCHAR) are written as str, as in the VARCHAR tables.
+
+    :param record: The record (as a dictionary or a RawRecord) to convert.
+    :param column_types: A dictionary mapping the column names to their data
+                         types, as returned by get_table_columns.
+    :return: The converted record, of the same type as record.
+    """
+    def coerce_value(field, value):
+        if value is None or value == 'None':
+            return None
+        converter = TYPE_CONVERTERS.get(column_types.get(field))
+        if converter is None:
+            return str(value)
+        try:
+            return converter(value)
+        except (TypeError, ValueError, InvalidOperation):
+            print(f'invalid value {value!r} for column {field}, '
+                  f'inserting NULL')
+            return None
+
+    return map_record_values(record, coerce_value)
+
+
+class LoadSummary:
+    """
+    This class accumulates the number of records inserted, skipped (already
+    existing) and failed per table over several calls to the insert functions,
+    for example when the data is loaded chunk by chunk by the streaming
+    pipeline. It can be shared between threads.
+    """
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, table_name, total, inserted, skipped, failed):
+        """
+        Method to add the counts of one call to the insert functions.
+
+        :param table_name: The name of the table the records were inserted to.
+        :param total: The number of records to insert.
+        :param inserted: The number of records inserted.
+        :param skipped: The number of records skipped as already existing.
+        :param failed: The number of records that failed to be inserted.
+        """
+        with self._lock:
+            counts = self._counts.setdefault(table_name, [0, 0, 0, 0])
+            for idx, value in enumerate([total, inserted, skipped, failed]):
+                counts[idx] += value
+
+    def all_inserted(self, table_name):
+        """
+        Method to check that no record failed to be inserted in a table.
+
+        :param table_name: The name of the table.
+        """
+        return self._counts.get(table_name, [0, 0, 0, 0])[3] == 0
+
+    def print_summary(self):
+        """
+        Method to print the accumulated counts of each table.
+        """
+        for table_name, (total, inserted, skipped, failed) in \
+                self._counts.items():
+            print(f'table {table_name}:')
+            print(f'total records to insert: {total}')
+            print(f'total successful inserts: {inserted}')
+            print(f'total records already existing: {skipped}')
+            print(f'total failed records {failed}')
+
+
+class LoadCheckpoint:
+    """
+    This class holds the checkpoint of one load stream of an ETL run, e.g. the
+    messages_raw records or one shard of them. Each batch written by the
+    loader is committed together with a row of the etl_load_checkpoints table
+    holding its offset in the stream and the digest of its row fingerprints.
+    When the run is resumed, the batches found with the same offset and digest
+    are skipped, while a batch holding other records (e.g. if the API returned
+    the records in another order) is written again.
+    """
+    def __init__(self, run_id, stream, committed=None):
+        """
+        :param run_id: The id of the ETL run, see start_etl_run.
+        :param stream: The name of the load stream, unique within the run.
+        :param committed: A dictionary mapping the offsets of the batches
+                          already committed by the run to their digest.
+        """
+        self.run_id = run_id
+        self.stream = stream
+        self._committed = committed or {}
+
+    @staticmethod
+    def digest(batch):
+        """
+        Method to compute the digest of a batch of prepared records, from
+        their row fingerprints. The fingerprints are sorted first, so that the
+        digest does not depend on the order of the records within the batch.
+
+        :param batch: The list of records (as dictionaries).
+        """
+        row_hashes = sorted(record.get('row_hash') or compute_row_hash(record)
+                            for record in batch)
+        return hashlib.sha256('\n'.join(row_hashes).encode('utf-8')).hexdigest()
+
+    def is_committed(self, offset, batch):
+        """
+        Method to check if a batch was committed by the run being resumed.
+
+        :param offset: The position of the first record of the batch in the
+                       stream.
+        :param batch: The list of records of the batch.
+        """
+        committed_digest = self._committed.get(offset)
+        return committed_digest is not None and \
+            committed_digest == self.digest(batch)
+
+    def record(self, execute, offset, batch):
+        """
+        Method to write the checkpoint row of a batch, in the transaction
+        writing the batch.
+
+        :param execute: The function running a statement, as execute(query,
+                        params), in the transaction of the batch.
+        :param offset: The position of the first record of the batch in the
+                       stream.
+        :param batch: The list of records of the batch.
+        """
+        execute("""INSERT INTO etl_load_checkpoints
+                   (run_id, stream, batch_offset, records, batch_digest,
+                    committed_at)
+                   VALUES (%s, %s, %s, %s, %s, %s)
+                   ON DUPLICATE KEY UPDATE records = VALUES(records),
+                   batch_digest = VALUES(batch_digest),
+                   committed_at = VALUES(committed_at)""",
+                (self.run_id, self.stream, offset, len(batch),
+                 self.digest(batch), str(datetime.now())))
+
+
+class RunCheckpoints:
+    """
+    This class holds the load checkpoints of an ETL run, read once at the start
+    of the run, and creates the LoadCheckpoint of each of its load streams.
+    """
+    def __init__(self, db_connector, run_id, streams=None):
+        """
+        :param db_connector: The database connector (connected as root).
+        :param run_id: The id of the run, see start_etl_run.
+        :param streams: The load streams used, to only read their checkpoints
+                        (e.g. those of one shard of a sharded run), all the
+                        checkpoints of the run being read if not provided.
+        """
+        self.run_id = run_id
+        self._committed = db_connector.get_load_checkpoints(run_id,
+                                                            streams=streams)
+        if self._committed:
+            print(f'{sum(map(len, self._committed.values()))} batches already '
+                  f'committed by run {run_id}')
+
+    def stream(self, stream):
+        """
+        Method to get the checkpoint of a load stream of the run.
+
+        :param stream: The name of the load stream, e.g. 'users_raw'.
+        """
+        return LoadCheckpoint(self.run_id, stream,
+                              self._committed.get(stream))
+
+
+# the number of records from which _insert_data uses the bulk loader
+BULK_LOAD_THRESHOLD = 50000
+
+_TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n',
+                              '\r': '\\r', '\0': '\\0'})
+
+
+def _tsv_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value).translate(_TSV_ESCAPES)
+
+
+def write_tsv(records, fields, file):
+    """
+    Function to write records as the lines of a tab separated file, in the
+    format read by LOAD DATA with its default options: tabs, newlines and
+    backslashes within the values are escaped with a backslash, and missing
+    values (None) are written as \\N.
+
+    :param records: The records (as dictionaries) to write.
+    :param fields: The fields to write, in the order of the columns.
+    :param file: The text file to write to.
+    """
+    for record in records:
+        file.write('\t'.join(_tsv_value(record.get(field))
+                              for field in fields) + '\n')
+
+
+def _bulk_load_data(table_name, records, db_connector, chunk_size=100000,
+                    database='spark_dwh', on_batch_inserted=None,
+                    checkpoint=None, batch_size=1000, on_batch_committed=None):
+    """
+    Convenience function to load records with the bulk loader of the database
+    connector (see MySqlDbConnector.bulk_load_file), one temporary file per
+    chunk of records. If LOAD DATA LOCAL INFILE is not allowed by the server
+    or the client, the records not loaded yet are inserted in batches instead
+    (see MySqlDbConnector.insert_records).
+
+    :param table_name: The name of the table to load the data to.
+    :param records: The iterable of prepared records, with their row_hash.
+    :param db_connector: The database connector, created with a
+                         local_infile_dir.
+    :param chunk_size: The number of records per file.
+    :param database: The name of the database schema in which the table is in.
+    :param on_batch_inserted: The function called with the inserted records of
+                              each chunk, see insert_records.
+    :param checkpoint: The LoadCheckpoint of the load, if any. The chunks
+                       already committed by the run being resumed are skipped.
+    :param batch_size: The number of records written per batch if the records
+                       are inserted in batches.
+    :param on_batch_committed: The function called with the records of each
+                               chunk once committed, see insert_records.
+    :return: A tuple with the number of inserted, skipped (already existing)
+             and failed records.
+    """
+    totals = [0, 0, 0]
+    offset = 0
+    chunks = iter_batches(records, chunk_size)
+    for chunk_no, chunk in enumerate(chunks):
+        chunk_offset = offset
+        offset += len(chunk)
+        if checkpoint is not None and \
+                checkpoint.is_committed(chunk_offset, chunk):
+            print(f'chunk no {chunk_no}: already committed, skipped')
+            totals[1] += len(chunk)
+            if on_batch_committed is not None:
+                on_batch_committed(chunk)
+            continue
+        fields = list(chunk[0].keys())
+        with tempfile.NamedTemporaryFile(
+                'w', encoding='utf-8', newline='', suffix='.tsv', delete=False,
+                dir=db_connector.get_local_infile_dir()) as file:
+            write_tsv(chunk, fields, file)
+        try:
+            counts = db_connector.bulk_load_file(
+                table_name, file.name, fields, chunk, database=database,
+                on_batch_inserted=on_batch_inserted, checkpoint=checkpoint,
+                checkpoint_offset=chunk_offset,
+                on_batch_committed=on_batch_committed)
+        except Exception as err:
+            if getattr(err, 'errno', None) not in \
+                    db_connector.LOCAL_INFILE_ERROR_CODES:
+                raise
+            print(f'bulk loading to table {table_name} is not allowed ({err}), '
+                  f'inserting the records in batches instead')
+            counts = db_connector.insert_records(
+                table_name=table_name,
+                records=chain(chunk, chain.from_iterable(chunks)),
+                batch_size=batch_size, database=database,
+                on_batch_inserted=on_batch_inserted, checkpoint=checkpoint,
+                checkpoint_offset=chunk_offset,
+                on_batch_committed=on_batch_committed)
+            return tuple(total + count for total, count in zip(totals, counts))
+        finally:
+            os.remove(file.name)
+        print(f'chunk no {chunk_no}: {counts[0]} inserted, '
+              f'{counts[1]} already existing')
+        totals = [total + count for total, count in zip(totals, counts)]
+    return tuple(totals)
+
 
 def _insert_data(table_name,
                  data,
                  db_user,
                  db_password,
                  include_update_time=True,
-                 database='spark_dwh'):
+                 batch_size=1000,
+                 database='spark_dwh',
+                 db_connector=None,
+                 summary=None,
+                 update_rollups=False,
+                 bulk_load_threshold=BULK_LOAD_THRESHOLD,
+                 checkpoint=None,
+                 sink=None):
     """
-    Convenience function to import a list of data records in the form
-    of dictionaries to a table using the available database connector.
+    Convenience function to import data records in the form of dictionaries
+    to a table using the available database connector. The records are read
+    lazily, so data can be a generator.
+
+    If the table has typed columns (see TYPED_RAW_TABLES), the values are
+    converted to the column types with coerce_record, otherwise to str. The
+    row fingerprint is computed before the conversion, from the str of the
+    values, so that it matches the fingerprints of the rows loaded to, and
+    migrated from, the VARCHAR tables. The records keep their type (see
+    records.py) through the conversion.
+
+    The records are written with batched INSERTs (see insert_records), unless
+    there are at least bulk_load_threshold of them and the database connector
+    allows bulk loading, in which case these are loaded with LOAD DATA LOCAL
+    INFILE through a staging table (see _bulk_load_data), falling back to the
+    batched INSERTs if the server does not allow it.
 
     :param table_name: The name of the table to insert the data to.
-    :param data: The list of records (in the form of dictionaries) to insert.
+    :param data: The iterable of records (dictionaries or RawRecords) to
+                 insert.
     :param db_user: The username to use when connecting to database.
     :param db_password: The password to use when connecting to database.
     :param include_update_time: Flag to specify if update time is to be included
                                 while inserting the records.
+    :param batch_size: The number of records written to the table per batch.
     :param database: The name of the database schema in which the table is in.
+    :param db_connector: The database connector (and its connection pool) to
+                         use. If not provided, a new one is created using the
+                         given credentials.
+    :param summary: A LoadSummary to add the counts to. If not provided, the
+                    counts are printed.
+    :param update_rollups: Flag to specify if the rollup tables of the table
+                           (see ROLLUP_HOOKS), if any, are to be updated with
+                           the inserted records. This requires a lookup of
+                           the row fingerprints of each batch, to know which
+                           records are inserted.
+    :param bulk_load_threshold: The number of records from which the bulk
+                                loader is used. None to never use it.
+    :param checkpoint: The LoadCheckpoint with which each batch is committed,
+                       if any (see LoadCheckpoint).
+    :param sink: The ParquetSink the records are also written to, if any (see
+                 parquet_sink.py), once their batch is committed to the table.
     """
-    db_connector = MySqlDbConnector(username=db_user, password=db_password)
-    total_records = len(data)
-    successful_inserts = 0
-    failed_inserts = 0
+    if db_connector is None:
+        db_connector = MySqlDbConnector(username=db_user, password=db_password)
+    total_records = 0
     print(f'inserting records to table {table_name}')
-    for idx, record in enumerate(data):
+    column_types = db_connector.get_table_columns(table_name, database)
+    typed = any(data_type in TYPE_CONVERTERS
+                for data_type in column_types.values())
+
+    # the records waiting for their batch to be committed before being added
+    # to the sink, as (prepared record, record) in the order of the batches
+    uncommitted = deque()
+
+    def prepare_record(record):
+        nonlocal total_records
+        total_records += 1
         if include_update_time:
             record['last_updated_at'] = str(datetime.now())
-        record = {k: str(v) for k, v in record.items()}
-        try:
-            db_connector.insert_record(table_name=table_name, 
-                                       record=record, 
-                                       database=database)
-            successful_inserts += 1
-        except Exception as err:
-            print(f'failed for record no {idx} due to error: {err}')
-            failed_inserts += 1
-    print(f'total records to insert: {total_records}')
-    print(f'total successful inserts: {successful_inserts}')
-    print(f'total failed records {failed_inserts}')
+        if typed:
+            prepared = coerce_record(record, column_types)
+        else:
+            prepared = str_record(record)
+        if 'row_hash' in column_types:
+            # the same fingerprint as the one of the str values
+            prepared['row_hash'] = compute_row_hash(record)
+        if sink is not None:
+            uncommitted.append((prepared, record))
+        return prepared
+
+    def add_to_sink(batch):
+        # the records before the batch belong to batches that failed
+        while uncommitted[0][0] is not batch[0]:
+            uncommitted.popleft()
+        for _ in batch:
+            sink.add(table_name, uncommitted.popleft()[1])
+
+    on_batch_inserted = ROLLUP_HOOKS.get(table_name) if update_rollups else None
+    on_batch_committed = add_to_sink if sink is not None else None
+    records = map(prepare_record, data)
+    if bulk_load_threshold and db_connector.get_local_infile_dir() and \
+            'row_hash' in column_types:
+        # only the first records are read to choose the backend
+        head = list(islice(records, bulk_load_threshold))
+        records = chain(head, records)
+        use_bulk_load = len(head) >= bulk_load_threshold
+    else:
+        use_bulk_load = False
+
+    backend = 'bulk_load' if use_bulk_load else 'insert'
+    with metrics.timer('load_seconds', table=table_name, backend=backend):
+        if use_bulk_load:
+            print(f'using the bulk loader for table {table_name}')
+            successful_inserts, skipped_records, failed_inserts = \
+                _bulk_load_data(table_name, records, db_connector,
+                                database=database,
+                                on_batch_inserted=on_batch_inserted,
+                                checkpoint=checkpoint, batch_size=batch_size,
+                                on_batch_committed=on_batch_committed)
+        else:
+            successful_inserts, skipped_records, failed_inserts = \
+                db_connector.insert_records(table_name=table_name,
+                                            records=records,
+                                            batch_size=batch_size,
+                                            database=database,
+                                            on_batch_inserted=on_batch_inserted,
+                                            checkpoint=checkpoint,
+                                            on_batch_committed=on_batch_committed)
+    for outcome, count in [('inserted', successful_inserts),
+                           ('skipped', skipped_records),
+                           ('failed', failed_inserts)]:
+        metrics.inc('load_records_total', count, table=table_name,
+                    outcome=outcome)
+    if summary is not None:
+        summary.add(table_name, total_records, successful_inserts,
+                    skipped_records, failed_inserts)
+    else:
+        print(f'total records to insert: {total_records}')
+        print(f'total successful inserts: {successful_inserts}')
+        print(f'total records already existing: {skipped_records}')
+        print(f'total failed records {failed_inserts}')
     return failed_inserts == 0
 
-def insert_user_data(users_data, db_user, db_password):
+def prepare_user_records(users_data):
     """
-    Function to insert the users data coming from the API, after it has been
-    sanitized to remove PII related information.
+    Function to convert the sanitized users data into the records of the
+    users_raw table (UserRecords). Users whose PII fields were not masked are
+    skipped.
 
-    :param users_data: A list of dictionaries specifiying user data records.
-    :param db_user: The username to use when connecting to database.
-    :param db_password: The password to use when connecting to database.
+    :param users_data: An iterable of dictionaries specifiying sanitized user
+                       data records.
     """
-    
+
     def check_if_pii_data_present(data_record):
         for field in ['city', 'zipcode', 'profession']:
             value = data_record.get(field)
@@ -62,67 +482,191 @@ def insert_user_data(users_data, db_user, db_password):
                 return False
         return True
 
-    records_to_insert = []
     for record in users_data:
         if not check_if_pii_data_present(record):
             print('PII values not removed from data record! skipping insert!')
             continue
-        data_record = {'user_id': record.get('id'),
-                       'created_at': record.get('createdAt'),
-                       'updated_at': record.get('updatedAt'),
-                       'city_id': record.get('city'),
-                       'country': record.get('country'),
-                       'zipcode_id': record.get('zipcode'),
-                       'email': record.get('email'),
-                       'birth_date': record.get('birthDate'),
-                       'gender': record.get('profile', {}).get('gender'),
-                       'is_smoking': record.get('profile', {}).get('isSmoking'),
-                       'profession_id': record.get('profile', {}).get('profession'),
-                       'income': record.get('profile', {}).get('income')}
-        records_to_insert.append(data_record)
-    return _insert_data('users_raw', records_to_insert, db_user, db_password)
-    
-
-def insert_subscription_data(subscription_data,  db_user, db_password):
+        profile = record.get('profile', {})
+        yield UserRecord(record.get('id'),
+                         record.get('createdAt'),
+                         record.get('updatedAt'),
+                         record.get('city'),
+                         record.get('country'),
+                         record.get('zipcode'),
+                         record.get('email'),
+                         record.get('birthDate'),
+                         profile.get('gender'),
+                         profile.get('isSmoking'),
+                         profile.get('profession'),
+                         profile.get('income'))
+
+def prepare_subscription_records(subscription_data):
+    """
+    Function to convert the subscription data into the records of the
+    subscriptions_raw table (SubscriptionRecords).
+
+    :param subscription_data: An iterable of dictionaries specifying
+                              subscription data records.
+    """
+    for record in subscription_data:
+        yield SubscriptionRecord(record.get('user_id'),
+                                 record.get('createdAt'),
+                                 record.get('startDate'),
+                                 record.get('endDate'),
+                                 record.get('status'),
+                                 record.get('amount'))
+
+def prepare_message_records(message_data):
+    """
+    Function to convert the messages data into the records of the
+    messages_raw table (MessageRecords). The message text is dropped as this
+    is sensitive information.
+
+    :param message_data: An iterable of dictionaries specifying messages
+                         data records, or of MessageRecords (e.g. a
+                         MessageBatch), which are taken as they are.
+    """
+    for record in message_data:
+        if isinstance(record, MessageRecord):
+            yield record
+        else:
+            yield MessageRecord.from_api(record)
+
+def insert_user_data(users_data, db_user, db_password, db_connector=None,
+                     summary=None, prepared=False, checkpoint=None,
+                     sink=None, update_rollups=False):
+    """
+    Function to insert the users data coming from the API, after it has been
+    sanitized to remove PII related information.
+
+    :param users_data: An iterable of dictionaries specifiying user data
+                       records.
+    :param db_user: The username to use when connecting to database.
+    :param db_password: The password to use when connecting to database.
+    :param db_connector: The database connector to use, if already available.
+    :param summary: The LoadSummary to add the counts to, if any.
+    :param prepared: If set, users_data are already users_raw records, e.g.
+                     from the columnar transform path (see columnar.py).
+    :param checkpoint: The LoadCheckpoint of the load, if any.
+    :param sink: The ParquetSink the records are also written to, if any.
+    :param update_rollups: Update the rollup tables, see _insert_data.
+    """
+    if not prepared:
+        users_data = prepare_user_records(users_data)
+    return _insert_data('users_raw', users_data,
+                        db_user, db_password,
+                        db_connector=db_connector,
+                        summary=summary,
+                        checkpoint=checkpoint,
+                        sink=sink,
+                        update_rollups=update_rollups)
+
+
+def insert_subscription_data(subscription_data,  db_user, db_password,
+                             db_connector=None, summary=None, prepared=False,
+                             checkpoint=None, sink=None, update_rollups=False):
     """
     Function to insert the subscription data coming from the API.
 
-    :param users_data: A list of dictionaries specifying subscriptoin
+    :param users_data: An iterable of dictionaries specifying subscriptoin
                       data records.
     :param db_user: The username to use when connecting to database.
     :param db_password: The password to use when connecting to database.
+    :param db_connector: The database connector to use, if already available.
+    :param summary: The LoadSummary to add the counts to, if any.
+    :param prepared: If set, subscription_data are already subscriptions_raw
+                     records, e.g. from the columnar transform path.
+    :param checkpoint: The LoadCheckpoint of the load, if any.
+    :param sink: The ParquetSink the records are also written to, if any.
+    :param update_rollups: Update the rollup tables, see _insert_data.
     """
-    records_to_insert = []
-    for record in subscription_data:
-        data_record = {'user_id': record.get('user_id'),
-                       'created_at': record.get('createdAt'),
-                       'start_date': record.get('startDate'),
-                       'end_date': record.get('endDate'),
-                       'status': record.get('status'),
-                       'amount': record.get('amount')
-                       }
-        records_to_insert.append(data_record)
+    if not prepared:
+        subscription_data = prepare_subscription_records(subscription_data)
     return _insert_data('subscriptions_raw',
-                         records_to_insert,  
-                         db_user, 
-                         db_password)
+                         subscription_data,
+                         db_user,
+                         db_password,
+                         db_connector=db_connector,
+                         summary=summary,
+                         checkpoint=checkpoint,
+                         sink=sink,
+                         update_rollups=update_rollups)
 
-def insert_message_data(message_data, db_user, db_password):
+def insert_message_data(message_data, db_user, db_password, db_connector=None,
+                        summary=None, checkpoint=None, sink=None,
+                        update_rollups=False):
     """
     Function to insert the messages data coming from the API. The message
     text is ignored while insert as this is sensitive information.
 
-    :param message_data: A list of dictionaries specifying messages
-                         data records.
+    :param message_data: An iterable of dictionaries specifying messages
+                         data records, or a MessageBatch.
     :param db_user: The username to use when connecting to database.
     :param db_password: The password to use when connecting to database.
+    :param db_connector: The database connector to use, if already available.
+    :param summary: The LoadSummary to add the counts to, if any.
+    :param checkpoint: The LoadCheckpoint of the load, if any.
+    :param sink: The ParquetSink the records are also written to, if any.
+    :param update_rollups: Update the rollup tables, see _insert_data.
     """
-    records_to_insert = []
-    for record in message_data:
-        data_record = {'id': record.get('id'),
-                       'created_at': record.get('createdAt'),
-                       'receiver_id': record.get('receiverId'),
-                       'sender_id': record.get('senderId')
-                       }
-        records_to_insert.append(data_record)
-    return _insert_data('messages_raw', records_to_insert, db_user, db_password)
+    return _insert_data('messages_raw', prepare_message_records(message_data),
+                        db_user, db_password,
+                        db_connector=db_connector,
+                        summary=summary,
+                        checkpoint=checkpoint,
+                        sink=sink,
+                        update_rollups=update_rollups)
+
+
+def split_key_ranges(records, key, num_shards):
+    """
+    Function to split a list of records into at most num_shards shards of
+    contiguous key ranges, so that concurrent loaders of the same table write
+    to different parts of its indexes. Records whose key is not numeric are
+    put in the last shard.
+
+    :param records: The list of records (as dictionaries) to split.
+    :param key: The field holding the key of the records, e.g. 'id'.
+    :param num_shards: The maximum number of shards.
+    :return: A list of lists of records.
+    """
+    def sort_key(record):
+        value = str(record.get(key))
+        return (0, int(value)) if value.isdigit() else (1, 0)
+
+    records = sorted(records, key=sort_key)
+    shard_size = -(-len(records) // max(num_shards, 1))
+    return [records[start:start + shard_size]
+            for start in range(0, len(records), shard_size)]
+
+
+def parallel_load(load_tasks, summary, max_workers=4):
+    """
+    Function to run several loads at the same time on a bounded thread pool,
+    e.g. of different tables, or of key range shards of a table (see
+    split_key_ranges). Each load checks out its own connection from the pool
+    of the database connector and adds its counts to the summary. A load that
+    fails altogether is counted as failed for all its records in the summary,
+    without stopping the others.
+
+    :param load_tasks: A list of (table_name, insert_function, records,
+                       kwargs) tuples, the insert function (such as
+                       insert_message_data) being called as
+                       insert_function(records, summary=summary, **kwargs).
+    :param summary: The LoadSummary to add the counts to.
+    :param max_workers: The maximum number of loads running at once. It should
+                        not exceed the pool size of the database connector.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(insert_function, records, summary=summary,
+                                   **kwargs): (table_name, len(records))
+                   for table_name, insert_function, records, kwargs
+                   in load_tasks}
+        for future in as_completed(futures):
+            table_name, total_records = futures[future]
+            try:
+                future.result()
+            except Exception as err:
+                print(f'load of {total_records} records to {table_name} '
+                      f'failed due to error: {err}')
+                summary.add(table_name, total_records, 0, 0, total_records)
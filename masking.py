@@ -0,0 +1,359 @@
+"""
+This module contains the classes used to obtain the masking ids for the
+sensitive PII fields (city, zipcode and profession) of the user data. Two
+masking strategies are available:
+- 'auto_increment' (MaskIdCache): the masking ids are the AUTO_INCREMENT ids
+  of the access restricted 'sensitive_*_ids' tables of the database, cached in
+  process to avoid looking them up one value at a time.
+- 'hmac' (HmacMasker): the masking ids are keyed hashes of the values computed
+  from a secret, which requires no database lookups. The token to value
+  mappings are written in the background to the 'sensitive_*_tokens' tables,
+  only so that they can be reversed by the root user.
+Both classes provide the same get_ids / report / close methods.
+"""
+import hashlib
+import hmac
+import queue
+import threading
+import time
+from collections import OrderedDict
+import metrics
+
+
+MASK_ID_TABLES = {'city': 'sensitive_city_ids',
+                  'zipcode': 'sensitive_zipcode_ids',
+                  'profession': 'sensitive_profession_ids'}
+
+MASK_TOKEN_TABLES = {'city': 'sensitive_city_tokens',
+                     'zipcode': 'sensitive_zipcode_tokens',
+                     'profession': 'sensitive_profession_tokens'}
+
+MASKING_STRATEGIES = ['auto_increment', 'hmac']
+
+
+def mask_token(key, field, value):
+    """
+    Function computing the keyed hash masking id of a value of a sensitive
+    field. The id is the first 63 bits of the HMAC-SHA256 of the field name and
+    value, so that it is a positive integer fitting a signed BIGINT column. The
+    field name is part of the hashed message so that the same value gets
+    different ids in different fields. This function is pure and can be mapped
+    over values in parallel, for example with a multiprocessing pool.
+
+    :param key: The secret key, as bytes.
+    :param field: The sensitive field the value belongs to.
+    :param value: The value to mask.
+    """
+    message = f'{field}\x1f{value}'.encode('utf-8')
+    digest = hmac.new(key, message, hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], 'big') >> 1
+
+
+def create_masker(strategy, db_connector, masking_secret=None):
+    """
+    Function to create the masker object for one of the masking strategies.
+
+    :param strategy: The masking strategy, one of MASKING_STRATEGIES.
+    :param db_connector: The database connector (connected as root) used to
+                         read / write the sensitive tables.
+    :param masking_secret: The secret key, required by the 'hmac' strategy.
+    """
+    if strategy == 'auto_increment':
+        return MaskIdCache(db_connector)
+    if strategy == 'hmac':
+        if not masking_secret:
+            raise ValueError('The hmac masking strategy requires a secret!')
+        return HmacMasker(masking_secret, db_connector)
+    raise ValueError(f'Unknown masking strategy {strategy}, expected one of '
+                     f'{MASKING_STRATEGIES}')
+
+
+class MaskIdCache:
+    """
+    This class keeps an in-process cache of the value to masking id mapping of
+    each sensitive field. On creation, the mapping tables are preloaded once,
+    after which values are only looked up in the database when they are not
+    present in the cache. The missing values of a whole batch are resolved
+    together, with the masking ids for new values being created in bulk.
+
+    Low cardinality fields (city, profession) are cached entirely, whereas a
+    maximum size can be configured for high cardinality fields (zipcode), in
+    which case the least recently used values are evicted first.
+    """
+    def __init__(self,
+                 db_connector,
+                 max_sizes=None,
+                 preload=True,
+                 database='spark_dwh'):
+        """
+        :param db_connector: The database connector (connected as root) used
+                             to read and create the masking ids.
+        :param max_sizes: A dictionary with the maximum number of values cached
+                          per field. Fields not in the dictionary are not
+                          limited. By default, only zipcode is limited.
+        :param preload: Flag to specify if the mapping tables are to be loaded
+                        into the cache on creation.
+        :param database: The name of the database where the tables are located.
+        """
+        if max_sizes is None:
+            max_sizes = {'zipcode': 100000}
+        self._db_connector = db_connector
+        self._max_sizes = max_sizes
+        self._database = database
+        self._caches = {field: OrderedDict() for field in MASK_ID_TABLES}
+        self.hits = {field: 0 for field in MASK_ID_TABLES}
+        self.misses = {field: 0 for field in MASK_ID_TABLES}
+        if preload:
+            self.preload()
+
+    def preload(self):
+        """
+        Method to load the existing masking ids of all the sensitive fields
+        into the cache, up to the maximum size configured for each field.
+        """
+        for field, table_name in MASK_ID_TABLES.items():
+            mask_ids = self._db_connector.fetch_mask_ids(
+                table_name, field,
+                limit=self._max_sizes.get(field),
+                database=self._database)
+            self._add_to_cache(field, mask_ids)
+            print(f'preloaded {len(mask_ids)} masking ids from {table_name}')
+
+    def _add_to_cache(self, field, mask_ids):
+        """
+        Convenience method to add value to masking id mappings to the cache of
+        a field, evicting the least recently used values if the cache grows
+        above its maximum size.
+
+        :param field: The sensitive field the mappings belong to.
+        :param mask_ids: A dictionary mapping values to masking ids.
+        """
+        cache = self._caches[field]
+        cache.update(mask_ids)
+        max_size = self._max_sizes.get(field)
+        if max_size:
+            while len(cache) > max_size:
+                cache.popitem(last=False)
+
+    def get_ids(self, field, values):
+        """
+        Method to get the masking ids for a batch of values of a sensitive
+        field. Values found in the cache are counted as hits, the remaining
+        ones as misses, and all misses are resolved in a single bulk lookup
+        which also creates the masking ids for values seen for the first time.
+
+        :param field: The sensitive field, one of 'city', 'zipcode' or
+                      'profession'.
+        :param values: The values (duplicates allowed) to get the ids for.
+        :return: A dictionary mapping each distinct value to its masking id.
+        """
+        cache = self._caches[field]
+        mask_ids = {}
+        missing = []
+        for value in set(values):
+            if value in cache:
+                cache.move_to_end(value)
+                mask_ids[value] = cache[value]
+            else:
+                missing.append(value)
+        self.hits[field] += len(mask_ids)
+        self.misses[field] += len(missing)
+        metrics.inc('mask_lookups_total', len(mask_ids), field=field,
+                    result='hit')
+        metrics.inc('mask_lookups_total', len(missing), field=field,
+                    result='miss')
+
+        if missing:
+            new_ids = self._db_connector.get_or_create_mask_ids(
+                MASK_ID_TABLES[field], field, missing,
+                database=self._database)
+            self._add_to_cache(field, new_ids)
+            mask_ids.update(new_ids)
+
+        return mask_ids
+
+    def report(self):
+        """
+        Method to print the hit / miss counters and the size of the cache of
+        each sensitive field.
+        """
+        for field in MASK_ID_TABLES:
+            lookups = self.hits[field] + self.misses[field]
+            hit_rate = self.hits[field] / lookups if lookups else 0
+            print(f'mask id cache for {field}: {self.hits[field]} hits, '
+                  f'{self.misses[field]} misses ({hit_rate:.1%} hit rate), '
+                  f'{len(self._caches[field])} values cached')
+
+    def close(self):
+        """
+        Method provided for compatibility with HmacMasker, nothing is pending
+        as the masking ids are written to the database as they are created.
+        """
+
+
+class HmacMasker:
+    """
+    This class masks the values of the sensitive fields using keyed hash
+    tokens (see mask_token). As no database lookup is required, masking is
+    pure CPU work and gives the same ids on every node that uses the same
+    secret, without any coordination between parallel workers.
+
+    The token to value mappings are only needed for the root user to be able
+    to reverse the masking. These are queued and written in bulk to the
+    'sensitive_*_tokens' tables by a background thread, each mapping being
+    sent once per masker object. A write that fails is retried, and mappings
+    still not written are sent again when their value is masked again. Call
+    close at the end to flush them, which raises if some were never written.
+    """
+    def __init__(self,
+                 masking_secret,
+                 db_connector=None,
+                 flush_size=1000,
+                 flush_interval=1.0,
+                 database='spark_dwh',
+                 max_write_retries=3,
+                 retry_backoff=0.5):
+        """
+        :param masking_secret: The secret key used for the keyed hash.
+        :param db_connector: The database connector (connected as root) used
+                             to write the mappings. If not provided, the
+                             mappings are not stored.
+        :param flush_size: The maximum number of mappings written at once.
+        :param flush_interval: The maximum number of seconds mappings wait in
+                               the queue before being written.
+        :param database: The name of the database where the tables are located.
+        :param max_write_retries: The number of times a failed write of
+                                  mappings is retried.
+        :param retry_backoff: The wait (in seconds) before the first retry of
+                              a write, doubled for each further retry.
+        """
+        if isinstance(masking_secret, str):
+            masking_secret = masking_secret.encode('utf-8')
+        self._key = masking_secret
+        self._db_connector = db_connector
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._database = database
+        self._max_write_retries = max_write_retries
+        self._retry_backoff = retry_backoff
+        # the tokens queued or written, and the ones whose write failed
+        self._seen = {field: set() for field in MASK_TOKEN_TABLES}
+        self._unwritten = {field: set() for field in MASK_TOKEN_TABLES}
+        self.tokens_computed = {field: 0 for field in MASK_TOKEN_TABLES}
+        self.mappings_written = {field: 0 for field in MASK_TOKEN_TABLES}
+        self._pending = queue.Queue()
+        self._writer = None
+        if db_connector is not None:
+            self._writer = threading.Thread(target=self._write_mappings,
+                                            daemon=True)
+            self._writer.start()
+
+    def get_ids(self, field, values):
+        """
+        Method to get the masking ids for a batch of values of a sensitive
+        field. The mappings not seen before by this masker are queued to be
+        stored in the database.
+
+        :param field: The sensitive field, one of 'city', 'zipcode' or
+                      'profession'.
+        :param values: The values (duplicates allowed) to get the ids for.
+        :return: A dictionary mapping each distinct value to its masking id.
+        """
+        mask_ids = {value: mask_token(self._key, field, value)
+                    for value in set(values)}
+        self.tokens_computed[field] += len(mask_ids)
+        metrics.inc('mask_lookups_total', len(mask_ids), field=field,
+                    result='computed')
+        if self._writer is not None:
+            seen = self._seen[field]
+            new_mappings = [(token, str(value))
+                            for value, token in mask_ids.items()
+                            if token not in seen]
+            if new_mappings:
+                seen.update(token for token, _ in new_mappings)
+                self._pending.put((field, new_mappings))
+        return mask_ids
+
+    def _write_mappings(self):
+        """
+        Background thread writing the queued token to value mappings to the
+        database in bulk, until a None sentinel is received.
+        """
+        stop = False
+        while not stop:
+            batches = {field: [] for field in MASK_TOKEN_TABLES}
+            size = 0
+            while size < self._flush_size:
+                try:
+                    item = self._pending.get(timeout=self._flush_interval)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                field, mappings = item
+                batches[field].extend(mappings)
+                size += len(mappings)
+
+            for field, mappings in batches.items():
+                if mappings:
+                    self._store_mappings(field, mappings)
+
+    def _store_mappings(self, field, mappings):
+        """
+        Convenience method writing a batch of mappings of a field, retried
+        with an exponential backoff. The tokens of a batch that still fails
+        are forgotten, so that they are queued again if their value is masked
+        again, and reported by close otherwise.
+
+        :param field: The sensitive field of the mappings.
+        :param mappings: The list of (token, value) tuples to write.
+        """
+        tokens = {token for token, _ in mappings}
+        for attempt in range(self._max_write_retries + 1):
+            try:
+                self._db_connector.store_mask_tokens(
+                    MASK_TOKEN_TABLES[field], field, mappings,
+                    database=self._database)
+            except Exception as err:
+                print(f'failed to store {len(mappings)} masking tokens for '
+                      f'{field} due to error: {err}')
+                if attempt < self._max_write_retries:
+                    time.sleep(self._retry_backoff * 2 ** attempt)
+                continue
+            self._unwritten[field].difference_update(tokens)
+            self.mappings_written[field] += len(mappings)
+            metrics.inc('mask_mappings_written_total', len(mappings),
+                        field=field)
+            return
+        self._seen[field].difference_update(tokens)
+        self._unwritten[field].update(tokens)
+        metrics.inc('mask_mappings_failed_total', len(mappings), field=field)
+
+    def report(self):
+        """
+        Method to print the number of tokens computed and mappings stored for
+        each sensitive field.
+        """
+        for field in MASK_TOKEN_TABLES:
+            print(f'hmac masking for {field}: {self.tokens_computed[field]} '
+                  f'tokens computed, {self.mappings_written[field]} new '
+                  f'mappings stored')
+
+    def close(self):
+        """
+        Method to flush the pending mappings to the database and stop the
+        background writer.
+
+        :raises RuntimeError: If some mappings could not be written, as the
+                              masking of their values could not be reversed.
+        """
+        if self._writer is not None:
+            self._pending.put(None)
+            self._writer.join()
+            self._writer = None
+        unwritten = {field: len(tokens)
+                     for field, tokens in self._unwritten.items() if tokens}
+        if unwritten:
+            raise RuntimeError(f'the masking token mappings {unwritten} could '
+                               f'not be written to the database')
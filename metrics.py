@@ -0,0 +1,290 @@
+"""
+This module contains the metrics recorded during an ETL run: counters (e.g.
+records loaded, database round trips, bytes fetched), gauges and histograms
+(e.g. latency of the API requests and database statements). All the modules
+record their metrics in the default registry through the functions inc,
+set_gauge, observe and timer, each metric being identified by its name and
+labels. At the end of the run, the registry is written as JSON and in the
+Prometheus text format (e.g. for the node exporter textfile collector), see
+write_metrics.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# upper bounds (in seconds) of the buckets of the latency histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+
+METRICS_PREFIX = 'spark_etl'
+
+
+class MetricsRegistry:
+    """
+    This class holds the values of the metrics of a run. It can be shared
+    between threads.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: The upper bounds of the buckets of the histograms.
+        """
+        self._buckets = tuple(buckets)
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Method to increase a counter.
+
+        :param name: The name of the counter.
+        :param value: The amount to increase the counter by.
+        :param labels: The labels of the counter, e.g. table='users_raw'.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Method to set the value of a gauge.
+
+        :param name: The name of the gauge.
+        :param value: The value of the gauge.
+        :param labels: The labels of the gauge.
+        """
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Method to add an observation (e.g. a duration in seconds) to a
+        histogram.
+
+        :param name: The name of the histogram.
+        :param value: The observed value.
+        :param labels: The labels of the histogram.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * len(self._buckets), 'sum': 0, 'count': 0}
+            for idx, upper_bound in enumerate(self._buckets):
+                if value <= upper_bound:
+                    histogram['buckets'][idx] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Context manager adding the duration (in seconds) of its block to a
+        histogram, whether the block succeeds or not.
+
+        :param name: The name of the histogram.
+        :param labels: The labels of the histogram.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def total(self, name):
+        """
+        Method to get the sum of a counter over all its labels.
+
+        :param name: The name of the counter.
+        """
+        with self._lock:
+            return sum(value for (counter_name, _), value
+                       in self._counters.items() if counter_name == name)
+
+    def to_dict(self):
+        """
+        Method to get the metrics as a dictionary that can be serialised as
+        JSON, with a list of {'name', 'labels', ...} entries per metric type.
+        """
+        with self._lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels),
+                              'value': value}
+                             for (name, labels), value
+                             in sorted(self._counters.items())],
+                'gauges': [{'name': name, 'labels': dict(labels),
+                            'value': value}
+                           for (name, labels), value
+                           in sorted(self._gauges.items())],
+                'histograms': [{'name': name, 'labels': dict(labels),
+                                'buckets': dict(zip(self._buckets,
+                                                    histogram['buckets'])),
+                                'sum': histogram['sum'],
+                                'count': histogram['count']}
+                               for (name, labels), histogram
+                               in sorted(self._histograms.items())]}
+
+    def to_prometheus(self, prefix=METRICS_PREFIX):
+        """
+        Method to get the metrics in the Prometheus text exposition format.
+
+        :param prefix: The prefix added to the name of every metric.
+        """
+        def label_string(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join(
+                '{}="{}"'.format(k, v.replace('\\', '\\\\')
+                                 .replace('"', '\\"').replace('\n', '\\n'))
+                for k, v in labels) + '}'
+
+        lines = []
+        with self._lock:
+            for metric_type, metrics in [('counter', self._counters),
+                                         ('gauge', self._gauges)]:
+                declared = set()
+                for (name, labels), value in sorted(metrics.items()):
+                    full_name = f'{prefix}_{name}'
+                    if metric_type == 'counter' and \
+                            not full_name.endswith('_total'):
+                        # the name of a counter ends with _total in Prometheus
+                        full_name += '_total'
+                    if full_name not in declared:
+                        lines.append(f'# TYPE {full_name} {metric_type}')
+                        declared.add(full_name)
+                    lines.append(f'{full_name}{label_string(labels)} {value}')
+
+            declared = set()
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                full_name = f'{prefix}_{name}'
+                if full_name not in declared:
+                    lines.append(f'# TYPE {full_name} histogram')
+                    declared.add(full_name)
+                # the buckets are already cumulative, see observe
+                for upper_bound, count in zip(self._buckets,
+                                              histogram['buckets']):
+                    lines.append(f'{full_name}_bucket'
+                                 f'{label_string(labels, [("le", str(upper_bound))])}'
+                                 f' {count}')
+                lines.append(f'{full_name}_bucket'
+                             f'{label_string(labels, [("le", "+Inf")])}'
+                             f' {histogram["count"]}')
+                lines.append(f'{full_name}_sum{label_string(labels)} '
+                             f'{histogram["sum"]}')
+                lines.append(f'{full_name}_count{label_string(labels)} '
+                             f'{histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """
+        Method to clear all the metrics, e.g. between two runs.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+REGISTRY = MetricsRegistry()
+
+
+def inc(name, value=1, **labels):
+    """
+    Function to increase a counter of the default registry, see
+    MetricsRegistry.inc.
+    """
+    REGISTRY.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    """
+    Function to set a gauge of the default registry, see
+    MetricsRegistry.set_gauge.
+    """
+    REGISTRY.set_gauge(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    """
+    Function to add an observation to a histogram of the default registry, see
+    MetricsRegistry.observe.
+    """
+    REGISTRY.observe(name, value, **labels)
+
+
+def timer(name, **labels):
+    """
+    Context manager timing its block in a histogram of the default registry,
+    see MetricsRegistry.timer.
+    """
+    return REGISTRY.timer(name, **labels)
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Context manager adding the duration (in seconds) of its block to the
+    stage_seconds_total counter of a stage. A stage run in several parts, e.g.
+    chunk by chunk, accumulates the duration of all its parts.
+
+    :param stage: The name of the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        inc('stage_seconds_total', time.perf_counter() - start, stage=stage)
+
+
+def count_records(records, stage, direction):
+    """
+    Generator counting the records passing through it in the
+    stage_records_total counter of a stage, e.g. for the lazily consumed
+    stages of the streaming pipeline.
+
+    :param records: The iterable of records.
+    :param stage: The name of the stage.
+    :param direction: 'in' for the records read by the stage, 'out' for the
+                      records produced by the stage.
+    """
+    count = 0
+    try:
+        for record in records:
+            count += 1
+            yield record
+    finally:
+        inc('stage_records_total', count, stage=stage, direction=direction)
+
+
+def write_metrics(output_dir, name='etl_run', registry=REGISTRY):
+    """
+    Function to write the metrics of a registry to the files <name>.json and
+    <name>.prom in a directory. Each file is written to a temporary file first
+    and then renamed, so that a collector never reads a partial file.
+
+    :param output_dir: The directory to write the files to, created if needed.
+    :param name: The name of the files, without extension.
+    :param registry: The registry to write.
+    :return: The paths of the JSON and Prometheus files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for extension, content in [
+            ('json', json.dumps(registry.to_dict(), indent=2, default=str)),
+            ('prom', registry.to_prometheus())]:
+        path = os.path.join(output_dir, f'{name}.{extension}')
+        with open(path + '.tmp', 'w') as file:
+            file.write(content)
+        os.replace(path + '.tmp', path)
+        paths.append(path)
+    return tuple(paths)
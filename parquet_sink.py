@@ -0,0 +1,371 @@
+"""
+This module contains the ParquetSink, a second sink of the load stage writing
+the records of the raw tables (users_raw, subscriptions_raw and messages_raw,
+already sanitised) as Parquet files, for the analysts' wide scans. The files
+of a table are partitioned by the date of created_at, in Hive style:
+
+    <output dir>/<table>/created_date=2023-01-31/part-<time>-<id>.parquet
+
+with typed columns (see parquet_schema) and snappy or zstd compression.
+
+Each flush writes one new file per partition, through a temporary file renamed
+once complete, and then lists the new files in the manifest of the table
+(<output dir>/<table>/_manifest.json), itself replaced atomically. The files
+of a table are the ones listed in its manifest (see manifest_files), so that
+the files of a flush that did not complete are never read, and later runs
+append new files to the partitions. The records already written to a
+partition (by their row fingerprint, see compute_row_hash) are skipped, so
+that the records extracted again by the lookback window or a resumed run are
+only written once.
+
+Only the raw tables can be written to the sink, never the sensitive_* tables
+holding the masked values. A sink is meant to be written by one process at a
+time.
+
+pyarrow is an optional dependency, only required when this sink is used.
+"""
+import json
+import os
+import re
+import threading
+import uuid
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+import metrics
+from connectors import TYPED_RAW_TABLES, compute_row_hash
+from load import coerce_record
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+PARQUET_TABLES = ('users_raw', 'subscriptions_raw', 'messages_raw')
+PARQUET_COMPRESSIONS = ['zstd', 'snappy']
+MANIFEST_NAME = '_manifest.json'
+PARTITION_COLUMN = 'created_date'
+# the partition of the records without a (valid) created_at, read as null by
+# the Hive partitioning of pyarrow
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# the columns of the typed tables that are specific to MySQL
+_EXCLUDED_COLUMNS = ('row_id',)
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('The Parquet sink requires pyarrow, install it with '
+                          '"pip install pyarrow".')
+
+
+def _column_types(sql_type):
+    """
+    Convenience function to get the data type (as in information_schema, see
+    load.TYPE_CONVERTERS) and the Arrow type of a column of TYPED_RAW_TABLES.
+
+    :param sql_type: The SQL type of the column, e.g. 'DECIMAL(12,2)'.
+    """
+    name, _, args = sql_type.partition('(')
+    name = name.split()[0].lower()
+    args = [int(arg) for arg in re.findall(r'\d+', args)]
+    if name == 'int':
+        return 'int', pa.int32()
+    if name == 'bigint':
+        return 'bigint', pa.int64()
+    if name == 'boolean':
+        return 'tinyint', pa.bool_()
+    if name == 'decimal':
+        return 'decimal', pa.decimal128(*args)
+    if name == 'datetime':
+        return 'datetime', pa.timestamp('us' if args and args[0] > 3
+                                        else 'ms')
+    if name == 'date':
+        return 'date', pa.date32()
+    return 'varchar', pa.string()
+
+
+def parquet_schema(table_name):
+    """
+    Function to get the column data types and the Arrow schema of the Parquet
+    files of a raw table, from its typed definition in TYPED_RAW_TABLES.
+
+    :param table_name: The name of the raw table.
+    :return: A tuple with the dictionary of the data types of the columns (to
+             convert the records with coerce_record) and the Arrow schema.
+    """
+    _require_pyarrow()
+    data_types = {}
+    fields = []
+    for column, sql_type in TYPED_RAW_TABLES[table_name]['columns']:
+        if column in _EXCLUDED_COLUMNS:
+            continue
+        data_types[column], arrow_type = _column_types(sql_type)
+        fields.append(pa.field(column, arrow_type))
+    return data_types, pa.schema(fields)
+
+
+def _write_atomically(path, write):
+    """
+    Convenience function writing a file through a temporary file renamed once
+    complete, so that a reader never sees a partial file.
+
+    :param path: The path of the file.
+    :param write: The function writing the file, called with the temporary
+                  path.
+    """
+    tmp_path = path + '.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_manifest(output_dir, table_name):
+    """
+    Function to read the manifest of a table of the sink.
+
+    :param output_dir: The directory of the sink.
+    :param table_name: The name of the table.
+    :return: The manifest, as a dictionary with the list of 'files' of the
+             table (path relative to the table directory, partition, number
+             of rows and time of writing of each file).
+    """
+    path = os.path.join(output_dir, table_name, MANIFEST_NAME)
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {'table': table_name, 'files': []}
+
+
+def manifest_files(output_dir, table_name, partitions=None):
+    """
+    Function to get the paths of the Parquet files of a table, as listed in
+    its manifest, e.g. to read them with pyarrow.parquet.ParquetDataset.
+
+    :param output_dir: The directory of the sink.
+    :param table_name: The name of the table.
+    :param partitions: The partitions (dates as 'YYYY-MM-DD') to get the files
+                       of. By default the files of all the partitions.
+    """
+    return [os.path.join(output_dir, table_name, entry['path'])
+            for entry in read_manifest(output_dir, table_name)['files']
+            if partitions is None or entry['partition'] in partitions]
+
+
+class ParquetSink:
+    """
+    This class writes the records of the raw tables to partitioned Parquet
+    files. The records are added while they are loaded to MySQL (see the sink
+    argument of load._insert_data) and buffered, and written once rows_per_flush
+    records of a table are buffered, and on close. It can be shared between
+    threads.
+    """
+    def __init__(self, output_dir, compression='zstd', rows_per_flush=500000):
+        """
+        :param output_dir: The directory of the sink, created if needed.
+        :param compression: The compression of the Parquet files, 'zstd' or
+                            'snappy'.
+        :param rows_per_flush: The number of buffered records of a table from
+                               which they are written.
+        """
+        _require_pyarrow()
+        if compression not in PARQUET_COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression}, expected '
+                             f'one of {PARQUET_COMPRESSIONS}')
+        self._output_dir = output_dir
+        self._compression = compression
+        self._rows_per_flush = rows_per_flush
+        self._buffers = {}
+        self._row_hashes = {}
+        # the row fingerprints of the files being written, by partition
+        self._writing = {}
+        # the buffers and the row fingerprints are guarded by _lock, the
+        # manifests by _manifest_lock, the files being written without a lock
+        self._lock = threading.Lock()
+        self._manifest_lock = threading.Lock()
+
+    def add(self, table_name, record):
+        """
+        Method to add a record of a raw table to the sink.
+
+        :param table_name: The name of the raw table.
+        :param record: The prepared record (a dictionary or a RawRecord, with
+                       str or API values).
+        """
+        if table_name not in PARQUET_TABLES:
+            # never let the masked values of the sensitive tables out
+            raise ValueError(f'The table {table_name} cannot be written to '
+                             f'the Parquet sink, only {PARQUET_TABLES}')
+        with self._lock:
+            buffer = self._buffers.setdefault(table_name, [])
+            buffer.append(record)
+            if len(buffer) < self._rows_per_flush:
+                return
+            self._buffers[table_name] = []
+        self._write(table_name, buffer)
+
+    def flush(self):
+        """
+        Method to write all the buffered records.
+        """
+        with self._lock:
+            buffers, self._buffers = self._buffers, {}
+        for table_name, records in buffers.items():
+            if records:
+                self._write(table_name, records)
+
+    def close(self):
+        """
+        Method to write all the buffered records, once the load is done.
+        """
+        self.flush()
+
+    def _existing_row_hashes(self, table_name, partition):
+        """
+        Convenience method to get the row fingerprints of the records already
+        written to a partition, read once from the row_hash column of its
+        files.
+        """
+        key = (table_name, partition)
+        if key not in self._row_hashes:
+            row_hashes = set()
+            for path in manifest_files(self._output_dir, table_name,
+                                       partitions=[partition]):
+                row_hashes.update(pq.read_table(
+                    path, columns=['row_hash']).column('row_hash').to_pylist())
+            self._row_hashes[key] = row_hashes
+        return self._row_hashes[key]
+
+    def _to_columns(self, records, data_types, schema):
+        """
+        Convenience method converting records to the columns of an Arrow
+        table of the given schema.
+        """
+        columns = {field.name: [] for field in schema}
+        for record in records:
+            coerced = coerce_record(record, data_types)
+            for field in schema:
+                value = coerced.get(field.name)
+                if value is not None:
+                    if pa.types.is_boolean(field.type):
+                        value = bool(value)
+                    elif pa.types.is_decimal(field.type):
+                        value = value.quantize(Decimal(1).scaleb(
+                            -field.type.scale), rounding=ROUND_HALF_UP)
+                columns[field.name].append(value)
+        return pa.table(columns, schema=schema)
+
+    def _write(self, table_name, records):
+        """
+        Method to write records of a table: the records not yet written are
+        grouped by partition, each partition is written to a new file, and the
+        files are then added to the manifest. Only the skipping of the records
+        already written and the update of the manifest hold a lock, so that
+        threads flushing at the same time encode and write their files
+        concurrently. The records only count as written once listed in the
+        manifest, so that the records of a write that failed are written again
+        when added again.
+        """
+        data_types, schema = parquet_schema(table_name)
+        partitions = {}
+        skipped = 0
+        with self._lock:
+            for record in records:
+                record = {column: record.get(column) for column in data_types}
+                record['row_hash'] = compute_row_hash(record)
+                created_at = coerce_record(
+                    {'created_at': record.get('created_at')},
+                    {'created_at': 'datetime'})['created_at']
+                partition = (created_at.date().isoformat() if created_at
+                             else NULL_PARTITION)
+                row_hashes = self._existing_row_hashes(table_name, partition)
+                writing = self._writing.setdefault((table_name, partition),
+                                                   set())
+                if record['row_hash'] in row_hashes or \
+                        record['row_hash'] in writing:
+                    skipped += 1
+                    continue
+                writing.add(record['row_hash'])
+                partitions.setdefault(partition, []).append(record)
+
+        try:
+            new_files = self._write_files(table_name, partitions, data_types,
+                                          schema)
+        except Exception:
+            self._release(table_name, partitions, written=False)
+            raise
+        self._release(table_name, partitions, written=True)
+        written = sum(entry['rows'] for entry in new_files)
+        metrics.inc('parquet_records_total', written, table=table_name,
+                    outcome='written')
+        metrics.inc('parquet_records_total', skipped, table=table_name,
+                    outcome='skipped')
+        print(f'{written} records of table {table_name} written to '
+              f'{len(new_files)} Parquet partitions, {skipped} already '
+              f'written')
+
+    def _release(self, table_name, partitions, written):
+        """
+        Convenience method moving the row fingerprints of the records of a
+        write out of the ones being written, to the ones written if the write
+        succeeded.
+        """
+        with self._lock:
+            for partition, partition_records in partitions.items():
+                key = (table_name, partition)
+                row_hashes = {record['row_hash']
+                              for record in partition_records}
+                self._writing[key].difference_update(row_hashes)
+                if written:
+                    self._row_hashes[key].update(row_hashes)
+
+    def _write_files(self, table_name, partitions, data_types, schema):
+        """
+        Convenience method writing the records of each partition to a new
+        file and adding the files to the manifest of the table.
+
+        :return: The manifest entries of the new files.
+        """
+        table_dir = os.path.join(self._output_dir, table_name)
+        new_files = []
+        with metrics.timer('parquet_write_seconds', table=table_name):
+            for partition, partition_records in sorted(partitions.items()):
+                directory = os.path.join(table_dir,
+                                         f'{PARTITION_COLUMN}={partition}')
+                os.makedirs(directory, exist_ok=True)
+                name = (f'part-{datetime.now():%Y%m%d%H%M%S}-'
+                        f'{uuid.uuid4().hex[:12]}.parquet')
+                arrow_table = self._to_columns(partition_records,
+                                               data_types, schema)
+                _write_atomically(
+                    os.path.join(directory, name),
+                    lambda path: pq.write_table(
+                        arrow_table, path, compression=self._compression))
+                new_files.append(
+                    {'path': f'{PARTITION_COLUMN}={partition}/{name}',
+                     'partition': partition,
+                     'rows': len(partition_records),
+                     'written_at': datetime.now().isoformat()})
+        if new_files:
+            # the new files are only visible once listed in the manifest
+            with self._manifest_lock:
+                manifest = read_manifest(self._output_dir, table_name)
+                manifest.update({'compression': self._compression,
+                                 'partition_column': PARTITION_COLUMN,
+                                 'schema': [[field.name, str(field.type)]
+                                            for field in schema]})
+                manifest['files'].extend(new_files)
+                _write_atomically(
+                    os.path.join(table_dir, MANIFEST_NAME),
+                    lambda path: _dump_json(manifest, path))
+        return new_files
+
+
+def _dump_json(data, path):
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=1)
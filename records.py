@@ -0,0 +1,277 @@
+"""
+This module contains the compact record types of the raw tables, used instead
+of dictionaries from the API records to the loader: UserRecord, for the
+sanitised users, SubscriptionRecord and MessageRecord. Their fields are held
+in __slots__, which takes a fraction of the memory of a dictionary per record,
+and they can be read as mappings (keys, get, items, record[field]), so that
+the loader, the rollup hooks and the load checkpoints take them as they take
+dictionaries.
+
+The messages extracted in batch mode are also held in a MessageBatch, which
+stores the integer ids of the messages in arrays rather than as one object per
+value, and drops the other fields of the API records (such as the message
+text) as soon as they are extracted.
+"""
+from array import array
+from operator import attrgetter
+
+
+# the fields added to the records by the loader (see load._insert_data)
+LOAD_FIELDS = ('last_updated_at', 'row_hash')
+_UNSET = object()
+
+
+class RawRecord:
+    """
+    Base class of the records of the raw tables. The fields of a record type
+    are listed in FIELDS, in the order of the columns, and set by its
+    __init__. The LOAD_FIELDS are only part of a record once set.
+    """
+    __slots__ = LOAD_FIELDS
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._FIELD_SET = frozenset(cls.FIELDS + LOAD_FIELDS)
+        cls._get_values = attrgetter(*cls.FIELDS)
+        cls._get_sorted_values = attrgetter(*sorted(cls.FIELDS))
+
+    def keys(self):
+        return self.FIELDS + tuple(field for field in LOAD_FIELDS
+                                   if getattr(self, field, _UNSET)
+                                   is not _UNSET)
+
+    def __getitem__(self, field):
+        if field not in self._FIELD_SET:
+            raise KeyError(field)
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field) from None
+
+    def __setitem__(self, field, value):
+        if field not in self._FIELD_SET:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def get(self, field, default=None):
+        if field not in self._FIELD_SET:
+            return default
+        return getattr(self, field, default)
+
+    def __contains__(self, field):
+        return (field in self._FIELD_SET and
+                getattr(self, field, _UNSET) is not _UNSET)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [getattr(self, field) for field in self.keys()]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.keys()]
+
+    def map_values(self, function):
+        """
+        Method to get a record of the same type with the values converted by
+        function, called as function(field, value).
+        """
+        record = self.__class__(*map(function, self.FIELDS,
+                                     self._get_values(self)))
+        for field in LOAD_FIELDS:
+            value = getattr(self, field, _UNSET)
+            if value is not _UNSET:
+                setattr(record, field, function(field, value))
+        return record
+
+    def str_values(self):
+        """
+        Method to get a record of the same type with the str of the values, as
+        written to the VARCHAR tables.
+        """
+        record = self.__class__(*map(str, self._get_values(self)))
+        for field in LOAD_FIELDS:
+            value = getattr(self, field, _UNSET)
+            if value is not _UNSET:
+                setattr(record, field, str(value))
+        return record
+
+    def sorted_values(self):
+        """
+        Method to get the values of the FIELDS of the record, sorted by field
+        name, e.g. to compute its fingerprint (see compute_row_hash).
+        """
+        return self._get_sorted_values(self)
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            # as a mapping, a record equals the dictionary of its items
+            return dict(self.items()) == other
+        return (type(self) is type(other) and
+                self.items() == other.items())
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(' +
+                ', '.join(f'{field}={value!r}'
+                          for field, value in self.items()) + ')')
+
+
+class UserRecord(RawRecord):
+    """
+    A record of the users_raw table, i.e. a sanitised user.
+    """
+    FIELDS = ('user_id', 'created_at', 'updated_at', 'city_id', 'country',
+              'zipcode_id', 'email', 'birth_date', 'gender', 'is_smoking',
+              'profession_id', 'income')
+    __slots__ = FIELDS
+
+    def __init__(self, user_id, created_at, updated_at, city_id, country,
+                 zipcode_id, email, birth_date, gender, is_smoking,
+                 profession_id, income):
+        self.user_id = user_id
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.city_id = city_id
+        self.country = country
+        self.zipcode_id = zipcode_id
+        self.email = email
+        self.birth_date = birth_date
+        self.gender = gender
+        self.is_smoking = is_smoking
+        self.profession_id = profession_id
+        self.income = income
+
+
+class SubscriptionRecord(RawRecord):
+    """
+    A record of the subscriptions_raw table.
+    """
+    FIELDS = ('user_id', 'created_at', 'start_date', 'end_date', 'status',
+              'amount')
+    __slots__ = FIELDS
+
+    def __init__(self, user_id, created_at, start_date, end_date, status,
+                 amount):
+        self.user_id = user_id
+        self.created_at = created_at
+        self.start_date = start_date
+        self.end_date = end_date
+        self.status = status
+        self.amount = amount
+
+
+class MessageRecord(RawRecord):
+    """
+    A record of the messages_raw table, i.e. a message without its text.
+    """
+    FIELDS = ('id', 'created_at', 'receiver_id', 'sender_id')
+    __slots__ = FIELDS
+
+    def __init__(self, id, created_at, receiver_id, sender_id):
+        self.id = id
+        self.created_at = created_at
+        self.receiver_id = receiver_id
+        self.sender_id = sender_id
+
+    @classmethod
+    def from_api(cls, record):
+        """
+        Method to create the record of a message coming from the API.
+
+        :param record: The message, as a dictionary from the API.
+        """
+        get = record.get
+        return cls(get('id'), get('createdAt'), get('receiverId'),
+                   get('senderId'))
+
+
+def map_record_values(record, function):
+    """
+    Function to convert the values of a record, a dictionary or a RawRecord,
+    giving a record of the same type.
+
+    :param record: The record to convert.
+    :param function: The function converting the values, called as
+                     function(field, value).
+    """
+    if isinstance(record, RawRecord):
+        return record.map_values(function)
+    return {field: function(field, value) for field, value in record.items()}
+
+
+def str_record(record):
+    """
+    Function to get the str of the values of a record, a dictionary or a
+    RawRecord, giving a record of the same type.
+
+    :param record: The record to convert.
+    """
+    if isinstance(record, RawRecord):
+        return record.str_values()
+    return {field: str(value) for field, value in record.items()}
+
+
+def _int_column(values):
+    """
+    Convenience function storing a column of ids in an array of 64-bit
+    integers, if all of them are integers or their canonical string (as the
+    ids of the API). The ids are then read back as int, which the loader
+    writes, fingerprints and converts as it does their string.
+
+    :return: The array, or the list of the values if they are not all ids.
+    """
+    try:
+        column = array('q', [int(value) for value in values])
+    except (TypeError, ValueError, OverflowError):
+        return list(values)
+    for value, int_value in zip(values, column):
+        if isinstance(value, bool) or str(value) != str(int_value):
+            return list(values)
+    return column
+
+
+class MessageBatch:
+    """
+    This class holds a batch of messages column by column: the ids, receiver
+    ids and sender ids in arrays (see _int_column) and the creation times in a
+    list. Iterating over it gives the MessageRecord of each message.
+    """
+    def __init__(self, ids, created_at, receiver_ids, sender_ids):
+        """
+        :param ids: The ids of the messages.
+        :param created_at: The creation times of the messages.
+        :param receiver_ids: The ids of the receivers of the messages.
+        :param sender_ids: The ids of the senders of the messages.
+        """
+        self._columns = (_int_column(ids), list(created_at),
+                         _int_column(receiver_ids), _int_column(sender_ids))
+
+    @classmethod
+    def from_api(cls, messages_data):
+        """
+        Method to create the batch of the messages coming from the API.
+
+        :param messages_data: An iterable of dictionaries specifying messages
+                              data records, as obtained from the API.
+        """
+        columns = ([], [], [], [])
+        appends = [column.append for column in columns]
+        fields = ('id', 'createdAt', 'receiverId', 'senderId')
+        for record in messages_data:
+            get = record.get
+            for append, field in zip(appends, fields):
+                append(get(field))
+        return cls(*columns)
+
+    def __len__(self):
+        return len(self._columns[1])
+
+    def __iter__(self):
+        return map(MessageRecord, *self._columns)
+
+    def __getitem__(self, idx):
+        return MessageRecord(*[column[idx] for column in self._columns])
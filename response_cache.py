@@ -0,0 +1,158 @@
+"""
+This module contains the ResponseCache, the local landing area of the raw API
+responses. Each page fetched from an end point is stored compressed (zstd if
+the zstandard package is installed, gzip otherwise), with the ETag and
+Last-Modified headers it was served with. The SparkApiConnector then sends
+these back as If-None-Match / If-Modified-Since on the next fetch of the page,
+and reads the page from the cache when the API answers 304 Not Modified.
+
+The cache can also be replayed (see the replay argument of SparkApiConnector):
+the pages are then only read from the cache, without any request, e.g. to
+reprocess or benchmark the transform and load stages. A replay requests the
+same pages as the run that filled the cache, so it should be run with the same
+page size and extraction options (e.g. --full-refresh for both).
+"""
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime
+from urllib.parse import urlparse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSIONS = ['zstd', 'gzip']
+
+
+def _compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _decompress(data, compression):
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('The zstandard package is required to read the '
+                              'zstd compressed responses of the cache.')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def _write_atomically(path, data):
+    """
+    Convenience function writing a file through a temporary file renamed once
+    complete, so that a concurrent reader never sees a partial file.
+    """
+    with open(path + '.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(path + '.tmp', path)
+
+
+class ResponseCache:
+    """
+    This class stores the raw responses of the API, one body file and one
+    metadata file per url and query parameters, in a directory per end point.
+    It can be shared between threads, as the files of a page are only written
+    by the request of that page.
+    """
+    def __init__(self, cache_dir, compression=None):
+        """
+        :param cache_dir: The directory of the cache, created if needed.
+        :param compression: The compression of the stored bodies, 'zstd' or
+                            'gzip'. By default zstd if the zstandard package
+                            is installed, gzip otherwise.
+        """
+        if compression is None:
+            compression = 'zstd' if zstandard is not None else 'gzip'
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression}, expected '
+                             f'one of {COMPRESSIONS}')
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('The zstandard package is required for the zstd '
+                              'compression, install it with '
+                              '"pip install zstandard".')
+        self._cache_dir = cache_dir
+        self._compression = compression
+
+    def _paths(self, url, params):
+        """
+        Convenience method to get the paths of the body and metadata files of
+        a url and its query parameters.
+        """
+        end_point = urlparse(url).path.rstrip('/').rsplit('/', 1)[-1] or 'root'
+        key = json.dumps([url, sorted((params or {}).items())], default=str)
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+        directory = os.path.join(self._cache_dir, end_point)
+        return (os.path.join(directory, name + '.body'),
+                os.path.join(directory, name + '.meta.json'))
+
+    def _read_metadata(self, url, params):
+        _, metadata_path = self._paths(url, params)
+        try:
+            with open(metadata_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def conditional_headers(self, url, params=None):
+        """
+        Method to get the headers making the request of a cached page
+        conditional, empty if the page is not cached (or was served without
+        validators).
+
+        :param url: The url of the page.
+        :param params: The query parameters of the page.
+        """
+        metadata = self._read_metadata(url, params)
+        headers = {}
+        if metadata:
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+        return headers
+
+    def load(self, url, params=None):
+        """
+        Method to read the body of a cached page.
+
+        :param url: The url of the page.
+        :param params: The query parameters of the page.
+        :return: The (decompressed) body, None if the page is not cached.
+        """
+        metadata = self._read_metadata(url, params)
+        if metadata is None:
+            return None
+        body_path, _ = self._paths(url, params)
+        try:
+            with open(body_path, 'rb') as file:
+                return _decompress(file.read(), metadata['compression'])
+        except FileNotFoundError:
+            return None
+
+    def store(self, url, params, body, etag=None, last_modified=None):
+        """
+        Method to store the body of a page with its validators. The body is
+        written before the metadata, so that the metadata of a page always
+        describes a complete body.
+
+        :param url: The url of the page.
+        :param params: The query parameters of the page.
+        :param body: The (decompressed) body of the response, as bytes.
+        :param etag: The ETag header of the response, if any.
+        :param last_modified: The Last-Modified header of the response, if any.
+        """
+        body_path, metadata_path = self._paths(url, params)
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        _write_atomically(body_path, _compress(body, self._compression))
+        _write_atomically(metadata_path, json.dumps(
+            {'url': url, 'params': params, 'etag': etag,
+             'last_modified': last_modified,
+             'compression': self._compression, 'size': len(body),
+             'fetched_at': datetime.now().isoformat()},
+            default=str).encode('utf-8'))
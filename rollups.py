@@ -0,0 +1,241 @@
+"""
+This module contains the rollup tables summarising the raw tables for the
+analytics queries of sql_queries/sql_test_rollups.sql, and the functions
+keeping them up to date. The rollups are updated by the loader in the same
+transaction as the raw rows they summarise (see the on_batch_inserted argument
+of MySqlDbConnector.insert_records), only for the rows actually inserted, so
+that loading the same record again does not count it twice.
+- daily_message_counts: the number of messages sent per day and sender.
+- user_message_summary: the number of messages sent and received per user,
+  with the first and last time.
+- user_subscription_intervals: the subscription intervals of each user.
+"""
+from collections import Counter
+from datetime import datetime
+from connectors import parse_api_timestamp
+
+
+ROLLUP_TABLES = {
+    'daily_message_counts':
+        """CREATE TABLE IF NOT EXISTS daily_message_counts
+           (calendar_date DATE NOT NULL, sender_id INT NOT NULL,
+            total_messages BIGINT NOT NULL,
+            PRIMARY KEY (calendar_date, sender_id),
+            KEY idx_sender_id (sender_id))""",
+    'user_message_summary':
+        """CREATE TABLE IF NOT EXISTS user_message_summary
+           (user_id INT NOT NULL PRIMARY KEY,
+            messages_sent BIGINT NOT NULL DEFAULT 0,
+            first_sent_at DATETIME(3), last_sent_at DATETIME(3),
+            messages_received BIGINT NOT NULL DEFAULT 0,
+            first_received_at DATETIME(3), last_received_at DATETIME(3))""",
+    'user_subscription_intervals':
+        """CREATE TABLE IF NOT EXISTS user_subscription_intervals
+           (user_id INT NOT NULL, start_date DATETIME(3) NOT NULL,
+            end_date DATETIME(3), status VARCHAR(32),
+            PRIMARY KEY (user_id, start_date),
+            KEY idx_status_end_date (status, end_date))"""
+}
+
+# the conversion of the raw columns, which can be VARCHAR or typed (see
+# TYPED_RAW_TABLES), used to backfill the rollups from the raw tables
+_RAW_INT = "CAST(NULLIF({0}, 'None') AS SIGNED)"
+_RAW_DATETIME = ("CAST(REPLACE(REPLACE(NULLIF({0}, 'None'), 'T', ' '), 'Z', '') "
+                 "AS DATETIME(3))")
+
+BACKFILL_QUERIES = {
+    'daily_message_counts':
+        f"""INSERT INTO daily_message_counts
+            (calendar_date, sender_id, total_messages)
+            SELECT DATE({_RAW_DATETIME.format('created_at')}) AS calendar_date,
+                   {_RAW_INT.format('sender_id')} AS sender, COUNT(*)
+            FROM messages_raw
+            GROUP BY calendar_date, sender
+            HAVING calendar_date IS NOT NULL AND sender IS NOT NULL""",
+    'user_message_summary':
+        f"""INSERT INTO user_message_summary
+            SELECT user_id, SUM(sent), MIN(sent_at), MAX(sent_at),
+                   SUM(received), MIN(received_at), MAX(received_at)
+            FROM (SELECT {_RAW_INT.format('sender_id')} AS user_id,
+                         1 AS sent,
+                         {_RAW_DATETIME.format('created_at')} AS sent_at,
+                         0 AS received, NULL AS received_at
+                  FROM messages_raw
+                  UNION ALL
+                  SELECT {_RAW_INT.format('receiver_id')}, 0, NULL, 1,
+                         {_RAW_DATETIME.format('created_at')}
+                  FROM messages_raw) m
+            WHERE user_id IS NOT NULL
+            GROUP BY user_id""",
+    'user_subscription_intervals':
+        f"""INSERT INTO user_subscription_intervals
+            SELECT user_id, start_date, end_date, status
+            FROM (SELECT user_id, start_date, end_date, status,
+                         ROW_NUMBER() OVER (
+                             PARTITION BY user_id, start_date
+                             ORDER BY last_updated_at DESC) AS version
+                  FROM (SELECT {_RAW_INT.format('user_id')} AS user_id,
+                               {_RAW_DATETIME.format('start_date')}
+                                   AS start_date,
+                               {_RAW_DATETIME.format('end_date')} AS end_date,
+                               status,
+                               {_RAW_DATETIME.format('last_updated_at')}
+                                   AS last_updated_at
+                        FROM subscriptions_raw) r) s
+            WHERE version = 1
+            AND user_id IS NOT NULL AND start_date IS NOT NULL"""
+}
+
+
+def create_rollup_tables(db_connector, database='spark_dwh'):
+    """
+    Function to create the rollup tables, if these do not exist yet, and
+    grant the analyst user access to them. A rollup table created while the
+    raw tables already have rows is backfilled from them.
+
+    :param db_connector: The database connector (connected as root).
+    :param database: The name of the database where the tables are located.
+    """
+    for table_name, query in ROLLUP_TABLES.items():
+        exists = bool(db_connector.get_table_columns(table_name,
+                                                     database=database))
+        db_connector._run_query(query=query, database=database)
+        if not exists:
+            print(f'backfilling rollup table {table_name}')
+            db_connector._run_query(query=BACKFILL_QUERIES[table_name],
+                                    database=database)
+        db_connector._run_query(query=f"""GRANT SELECT ON
+                                {database}.{table_name} to 'analyst'""",
+                                database=database)
+
+
+def warn_if_rollups_exist(db_connector, database='spark_dwh'):
+    """
+    Function to warn that the rollup tables of earlier runs, if any, are not
+    updated by a run loading without them.
+
+    :param db_connector: The database connector (connected as root).
+    :param database: The name of the database where the tables are located.
+    """
+    existing = [table_name for table_name in ROLLUP_TABLES
+                if db_connector.get_table_columns(table_name,
+                                                  database=database)]
+    if existing:
+        print(f'Warning: the rollup tables {", ".join(existing)} are not '
+              f'updated by this run and will be out of date, load with the '
+              f'rollups enabled to keep them up to date.')
+
+
+def _to_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return parse_api_timestamp(str(value))
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def update_message_rollups(execute, records):
+    """
+    Function to add a batch of newly inserted messages_raw records to the
+    daily_message_counts and user_message_summary rollups. It is run in the
+    transaction of the batch insert, so that the rollups are committed together
+    with the records. The rollup rows are written in key order, so that concurrent
+    loaders lock them in the same order.
+
+    :param execute: The function running a statement, as execute(query,
+                    params), in the transaction inserting the records.
+    :param records: The records inserted (as dictionaries of str or typed
+                    values).
+    """
+    daily_counts = Counter()
+    summaries = {}
+    for record in records:
+        created_at = _to_datetime(record.get('created_at'))
+        for user_id, role in [(_to_int(record.get('sender_id')), 'sent'),
+                              (_to_int(record.get('receiver_id')), 'received')]:
+            if user_id is None:
+                continue
+            summary = summaries.setdefault(user_id, {'sent': [0, None, None],
+                                                     'received': [0, None,
+                                                                  None]})
+            count_first_last = summary[role]
+            count_first_last[0] += 1
+            if created_at is not None:
+                if count_first_last[1] is None or \
+                        created_at < count_first_last[1]:
+                    count_first_last[1] = created_at
+                if count_first_last[2] is None or \
+                        created_at > count_first_last[2]:
+                    count_first_last[2] = created_at
+            if role == 'sent' and created_at is not None:
+                daily_counts[(created_at.date(), user_id)] += 1
+
+    if daily_counts:
+        query = ('INSERT INTO daily_message_counts '
+                 '(calendar_date, sender_id, total_messages) VALUES ' +
+                 ', '.join(['(%s, %s, %s)'] * len(daily_counts)) +
+                 ' ON DUPLICATE KEY UPDATE total_messages = '
+                 'total_messages + VALUES(total_messages)')
+        execute(query, [value for (calendar_date, sender_id), count
+                        in sorted(daily_counts.items())
+                        for value in (calendar_date, sender_id, count)])
+    if summaries:
+        query = ('INSERT INTO user_message_summary (user_id, messages_sent, '
+                 'first_sent_at, last_sent_at, messages_received, '
+                 'first_received_at, last_received_at) VALUES ' +
+                 ', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(summaries)) +
+                 ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                     [f'messages_{role} = messages_{role} + '
+                      f'VALUES(messages_{role}), '
+                      f'first_{role}_at = COALESCE(LEAST(first_{role}_at, '
+                      f'VALUES(first_{role}_at)), first_{role}_at, '
+                      f'VALUES(first_{role}_at)), '
+                      f'last_{role}_at = COALESCE(GREATEST(last_{role}_at, '
+                      f'VALUES(last_{role}_at)), last_{role}_at, '
+                      f'VALUES(last_{role}_at))'
+                      for role in ['sent', 'received']]))
+        execute(query, [value for user_id, summary
+                        in sorted(summaries.items())
+                        for value in [user_id] + summary['sent'] +
+                        summary['received']])
+
+
+def update_subscription_rollups(execute, records):
+    """
+    Function to add a batch of newly inserted subscriptions_raw records to the
+    user_subscription_intervals rollup. A subscription loaded again with a new
+    end date or status replaces the interval with the same start date.
+
+    :param execute: The function running a statement, as execute(query,
+                    params), in the transaction inserting the records.
+    :param records: The records inserted (as dictionaries of str or typed
+                    values).
+    """
+    intervals = {}
+    for record in records:
+        user_id = _to_int(record.get('user_id'))
+        start_date = _to_datetime(record.get('start_date'))
+        if user_id is None or start_date is None:
+            continue
+        status = record.get('status')
+        intervals[(user_id, start_date)] = (
+            _to_datetime(record.get('end_date')),
+            None if status in (None, 'None') else str(status))
+    if not intervals:
+        return
+    query = ('INSERT INTO user_subscription_intervals '
+             '(user_id, start_date, end_date, status) VALUES ' +
+             ', '.join(['(%s, %s, %s, %s)'] * len(intervals)) +
+             ' ON DUPLICATE KEY UPDATE end_date = VALUES(end_date), '
+             'status = VALUES(status)')
+    execute(query, [value for key, interval in sorted(intervals.items())
+                    for value in key + interval])
+
+
+ROLLUP_HOOKS = {'messages_raw': update_message_rollups,
+                'subscriptions_raw': update_subscription_rollups}
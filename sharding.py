@@ -0,0 +1,663 @@
+"""
+This script runs the ETL process in sharded mode, spread over several worker
+processes on one or many nodes, coordinated through a work queue table of the
+database (etl_work_queue):
+- the coordinator counts the records of the users and messages end points,
+  splits them into shards of pages_per_shard pages, queues the shards, waits
+  for the workers to process them and then finishes the run (high-water marks,
+  monitoring views and run metrics), as etl.py does.
+- each worker claims one shard at a time with a lease, renewed by a heartbeat
+  while the shard is processed, and runs the extract, transform and load steps
+  on the pages of the shard. The shards whose lease expired (e.g. because
+  their worker died) are queued again, up to max_attempts times.
+
+The leases are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so that the
+workers never wait for each other, and all the lease times are computed by the
+database server, so that the clocks of the nodes do not matter. A shard
+processed twice (e.g. by a worker that lost its lease) is loaded only once, as
+the loader skips the existing rows by their fingerprint, and the masking ids
+are created with INSERT IGNORE on the unique values of the sensitive tables,
+so concurrent workers get the same ids for the same values.
+
+The sharded mode always extracts all the records (as with --full-refresh),
+the last shard of each end point being open ended to include the records
+added since the count.
+
+Example:
+    python sharding.py coordinator --pages-per-shard 20
+    python sharding.py worker --processes 4     (on each node)
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+import metrics
+from connectors import (MySqlDbConnector, SparkApiConnector,
+                        API_TIMESTAMP_FIELDS, record_position)
+from etl import get_masking_secret, get_root_password, update_watermark
+from load import (LoadSummary, RunCheckpoints, insert_message_data,
+                  insert_subscription_data, insert_user_data)
+from masking import MASKING_STRATEGIES, create_masker
+from rollups import create_rollup_tables, warn_if_rollups_exist
+from transform import (create_monitoring_views, get_latest_record,
+                       get_subscription_data, sanitize_sensitive_data_users)
+
+
+WORK_QUEUE_TABLE = """CREATE TABLE IF NOT EXISTS etl_work_queue
+                      (shard_id INT AUTO_INCREMENT, run_id INT NOT NULL,
+                       end_point VARCHAR(64) NOT NULL,
+                       first_page INT NOT NULL, last_page INT,
+                       page_size INT NOT NULL,
+                       status VARCHAR(16) NOT NULL DEFAULT 'queued',
+                       worker_id VARCHAR(255),
+                       attempts INT NOT NULL DEFAULT 0,
+                       lease_expires_at DATETIME(3), heartbeat_at DATETIME(3),
+                       records INT, latest_timestamp VARCHAR(255),
+                       latest_id VARCHAR(255), error TEXT,
+                       PRIMARY KEY (shard_id),
+                       KEY idx_status_lease (status, lease_expires_at),
+                       KEY idx_run_id (run_id))"""
+
+SHARD_FIELDS = ['shard_id', 'run_id', 'end_point', 'first_page', 'last_page',
+                'page_size', 'attempts']
+
+
+class WorkQueue:
+    """
+    This class provides the operations of the coordinator and the workers on
+    the etl_work_queue table.
+    """
+    def __init__(self, db_connector, lease_seconds=60, max_attempts=3):
+        """
+        :param db_connector: The database connector (connected as root).
+        :param lease_seconds: The duration of a lease, renewed by the
+                              heartbeat of the worker holding it.
+        :param max_attempts: The number of times a shard is claimed before it
+                             is marked as failed.
+        """
+        self._db_connector = db_connector
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+
+    def create_table(self):
+        """
+        Method to create the work queue table, if it does not exist yet.
+        """
+        self._db_connector._run_query(query=WORK_QUEUE_TABLE)
+
+    def enqueue(self, run_id, shards):
+        """
+        Method to queue the shards of a run.
+
+        :param run_id: The id of the run, see start_etl_run.
+        :param shards: A list of (end_point, first_page, last_page, page_size)
+                       tuples, last_page being None for an open ended shard.
+        """
+        self._db_connector._run_query(
+            query='INSERT INTO etl_work_queue (run_id, end_point, first_page, '
+                  'last_page, page_size) VALUES ' +
+                  ', '.join(['(%s, %s, %s, %s, %s)'] * len(shards)),
+            params=[value for shard in shards
+                    for value in (run_id,) + tuple(shard)])
+
+    def requeue_expired(self):
+        """
+        Method to queue again the shards whose lease expired, or to mark them
+        as failed once claimed max_attempts times.
+
+        :return: The number of shards queued again or failed.
+        """
+        with self._db_connector.connection() as db_conn:
+            cursor = db_conn.cursor()
+            self._db_connector._execute(
+                cursor,
+                """UPDATE etl_work_queue
+                   SET status = IF(attempts < %s, 'queued', 'failed'),
+                       worker_id = NULL, lease_expires_at = NULL,
+                       error = 'lease expired'
+                   WHERE status = 'leased' AND lease_expires_at < NOW(3)""",
+                (self._max_attempts,))
+            expired = cursor.rowcount
+            cursor.close()
+            self._db_connector._commit(db_conn)
+        if expired:
+            print(f'{expired} shards with an expired lease queued again')
+        return expired
+
+    def claim(self, worker_id):
+        """
+        Method to claim the next queued shard, skipping the shards being
+        claimed by other workers at the same time.
+
+        :param worker_id: The id of the worker claiming the shard.
+        :return: The shard, as a dictionary with the SHARD_FIELDS, or None if
+                 no shard is queued.
+        """
+        self.requeue_expired()
+        with self._db_connector.connection() as db_conn:
+            cursor = db_conn.cursor()
+            try:
+                rows = self._db_connector._execute(
+                    cursor,
+                    f"""SELECT {', '.join(SHARD_FIELDS)} FROM etl_work_queue
+                        WHERE status = 'queued' ORDER BY shard_id LIMIT 1
+                        FOR UPDATE SKIP LOCKED""",
+                    fetch=True)
+                if not rows:
+                    db_conn.rollback()
+                    return None
+                shard = dict(zip(SHARD_FIELDS, rows[0]))
+                self._db_connector._execute(
+                    cursor,
+                    """UPDATE etl_work_queue
+                       SET status = 'leased', worker_id = %s,
+                           attempts = attempts + 1, heartbeat_at = NOW(3),
+                           lease_expires_at = NOW(3) + INTERVAL %s SECOND
+                       WHERE shard_id = %s""",
+                    (worker_id, self._lease_seconds, shard['shard_id']))
+                self._db_connector._commit(db_conn)
+            finally:
+                cursor.close()
+        shard['attempts'] += 1
+        return shard
+
+    def _update_lease(self, shard_id, worker_id, assignments, params=()):
+        """
+        Convenience method to update a shard leased by a worker.
+
+        :return: False if the worker does not hold the lease anymore.
+        """
+        with self._db_connector.connection() as db_conn:
+            cursor = db_conn.cursor()
+            self._db_connector._execute(
+                cursor,
+                f"""UPDATE etl_work_queue SET {assignments}
+                    WHERE shard_id = %s AND worker_id = %s
+                    AND status = 'leased'""",
+                tuple(params) + (shard_id, worker_id))
+            updated = cursor.rowcount
+            cursor.close()
+            self._db_connector._commit(db_conn)
+        return updated == 1
+
+    def heartbeat(self, shard_id, worker_id):
+        """
+        Method to extend the lease of a shard.
+
+        :param shard_id: The id of the shard.
+        :param worker_id: The id of the worker holding the lease.
+        :return: False if the worker does not hold the lease anymore.
+        """
+        return self._update_lease(
+            shard_id, worker_id,
+            """heartbeat_at = NOW(3),
+               lease_expires_at = NOW(3) + INTERVAL %s SECOND""",
+            (self._lease_seconds,))
+
+    def complete(self, shard_id, worker_id, records, latest):
+        """
+        Method to mark a shard as done.
+
+        :param shard_id: The id of the shard.
+        :param worker_id: The id of the worker holding the lease.
+        :param records: The number of records of the shard.
+        :param latest: The (timestamp, id) tuple of the latest record of the
+                       shard, None if the shard has no records.
+        :return: False if the worker does not hold the lease anymore.
+        """
+        latest_timestamp, latest_id = latest or (None, None)
+        return self._update_lease(
+            shard_id, worker_id,
+            """status = 'done', lease_expires_at = NULL, records = %s,
+               latest_timestamp = %s, latest_id = %s, error = NULL""",
+            (records, latest_timestamp,
+             None if latest_id is None else str(latest_id)))
+
+    def fail(self, shard_id, worker_id, attempts, error):
+        """
+        Method to release a shard that could not be processed: it is queued
+        again, or marked as failed once claimed max_attempts times.
+
+        :param shard_id: The id of the shard.
+        :param worker_id: The id of the worker holding the lease.
+        :param attempts: The number of times the shard was claimed.
+        :param error: The error message.
+        """
+        status = 'queued' if attempts < self._max_attempts else 'failed'
+        return self._update_lease(
+            shard_id, worker_id,
+            """status = %s, worker_id = NULL, lease_expires_at = NULL,
+               error = %s""",
+            (status, str(error)[:1000]))
+
+    def pending_shards(self, run_id=None):
+        """
+        Method to count the shards that are queued or leased.
+
+        :param run_id: Only count the shards of this run, if given.
+        """
+        query = """SELECT COUNT(*) FROM etl_work_queue
+                   WHERE status IN ('queued', 'leased')"""
+        params = None
+        if run_id is not None:
+            query += ' AND run_id = %s'
+            params = (run_id,)
+        return self._db_connector._run_query(query=query, params=params,
+                                             return_results=True)[0][0]
+
+    def run_status(self, run_id):
+        """
+        Method to get the number of shards of a run per status.
+
+        :param run_id: The id of the run.
+        """
+        return dict(self._db_connector._run_query(
+            query="""SELECT status, COUNT(*) FROM etl_work_queue
+                     WHERE run_id = %s GROUP BY status""",
+            params=(run_id,), return_results=True))
+
+    def latest_records(self, run_id):
+        """
+        Method to get, per end point, the latest record of the done shards of
+        a run, and whether all the shards of the end point are done.
+
+        :param run_id: The id of the run.
+        :return: A dictionary mapping the end points to a tuple with the
+                 (timestamp, id) tuple of their latest record (or None) and a
+                 flag set if all their shards are done.
+        """
+        latest = {}
+        for end_point, status, latest_timestamp, latest_id in \
+                self._db_connector._run_query(
+                    query="""SELECT end_point, status, latest_timestamp,
+                             latest_id FROM etl_work_queue
+                             WHERE run_id = %s""",
+                    params=(run_id,), return_results=True):
+            timestamp_field = API_TIMESTAMP_FIELDS[end_point]
+            current, all_done = latest.get(end_point, (None, True))
+            if latest_timestamp is not None and (
+                    current is None or
+                    record_position({timestamp_field: latest_timestamp,
+                                     'id': latest_id}, timestamp_field) >
+                    record_position({timestamp_field: current[0],
+                                     'id': current[1]}, timestamp_field)):
+                current = (latest_timestamp, latest_id)
+            latest[end_point] = (current, all_done and status == 'done')
+        return latest
+
+
+def plan_shards(api_connector, pages_per_shard, page_size):
+    """
+    Function to split the pages of the users and messages end points into
+    shards of pages_per_shard pages. The last shard of each end point is open
+    ended.
+
+    :param api_connector: The API connector to count the records with.
+    :param pages_per_shard: The number of pages per shard.
+    :param page_size: The number of records per page.
+    :return: A list of (end_point, first_page, last_page, page_size) tuples.
+    """
+    shards = []
+    for end_point in API_TIMESTAMP_FIELDS:
+        count = api_connector.count_end_point_records(end_point)
+        num_pages = -(-count // page_size)
+        print(f'{count} {end_point} records in {num_pages} pages')
+        first_pages = list(range(1, num_pages + 1, pages_per_shard)) or [1]
+        for idx, first_page in enumerate(first_pages):
+            last_page = (None if idx == len(first_pages) - 1
+                         else first_page + pages_per_shard - 1)
+            shards.append((end_point, first_page, last_page, page_size))
+    return shards
+
+
+class _LeaseHeartbeat:
+    """
+    Context manager renewing the lease of a shard in a background thread while
+    the shard is processed. The lost attribute is set if the lease was taken
+    over by another worker.
+    """
+    def __init__(self, work_queue, shard_id, worker_id, interval):
+        self._work_queue = work_queue
+        self._shard_id = shard_id
+        self._worker_id = worker_id
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.lost = False
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                if not self._work_queue.heartbeat(self._shard_id,
+                                                  self._worker_id):
+                    print(f'lease of shard {self._shard_id} lost')
+                    self.lost = True
+                    return
+            except Exception as err:
+                # the lease can still be renewed by the next heartbeat
+                print(f'heartbeat of shard {self._shard_id} failed: {err}')
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def process_shard(shard, api_connector, db_connector, masker, root_password,
+                  rollups=False):
+    """
+    Function to run the extract, transform and load steps on the pages of a
+    shard. Each batch is committed with its checkpoint (see
+    load.LoadCheckpoint), so that a shard claimed again skips the batches
+    already loaded.
+
+    :param shard: The shard, as returned by WorkQueue.claim.
+    :param api_connector: The API connector to extract the data with.
+    :param db_connector: The database connector to load the data with.
+    :param masker: The masker used to mask the sensitive user fields.
+    :param root_password: The root password of the database.
+    :param rollups: If set, the rollup tables are updated with the loaded
+                    records.
+    :return: A tuple with the number of records of the shard, the
+             (timestamp, id) tuple of its latest record and a flag set if all
+             the records were loaded.
+    :raises RuntimeError: If a shard that is not the last of its end point
+                          does not get full pages, so that it is failed (and
+                          queued again) rather than done with records missing.
+                          A page failing to be fetched raises ApiFetchError.
+    """
+    end_point = shard['end_point']
+    with metrics.stage_timer('extract'):
+        records = api_connector.fetch_end_point_pages(
+            end_point, shard['first_page'], shard['last_page'],
+            page_size=shard['page_size'])
+    if shard['last_page'] is not None:
+        expected = ((shard['last_page'] - shard['first_page'] + 1) *
+                    shard['page_size'])
+        if len(records) != expected:
+            raise RuntimeError(f'shard {shard["shard_id"]} got {len(records)} '
+                               f'records instead of {expected}, pages are '
+                               f'missing')
+    metrics.inc('stage_records_total', len(records), stage='extract',
+                direction='out', end_point=end_point)
+    latest = get_latest_record(records, API_TIMESTAMP_FIELDS[end_point])
+    summary = LoadSummary()
+    stream_suffix = f'/shard-{shard["shard_id"]}'
+    tables = (['users_raw', 'subscriptions_raw'] if end_point == 'users'
+              else ['messages_raw'])
+    checkpoints = RunCheckpoints(
+        db_connector, shard['run_id'],
+        streams=[table + stream_suffix for table in tables])
+
+    if end_point == 'users':
+        with metrics.stage_timer('transform'):
+            subscriptions = get_subscription_data(records)
+            users = sanitize_sensitive_data_users(records,
+                                                  root_password=root_password,
+                                                  db_connector=db_connector,
+                                                  masker=masker)
+        with metrics.stage_timer('load'):
+            insert_user_data(users, 'root', root_password,
+                             db_connector=db_connector, summary=summary,
+                             update_rollups=rollups,
+                             checkpoint=checkpoints.stream(
+                                 'users_raw' + stream_suffix))
+            insert_subscription_data(subscriptions, 'root', root_password,
+                                     db_connector=db_connector,
+                                     summary=summary,
+                                     update_rollups=rollups,
+                                     checkpoint=checkpoints.stream(
+                                         'subscriptions_raw' + stream_suffix))
+    else:
+        with metrics.stage_timer('load'):
+            insert_message_data(records, 'root', root_password,
+                                db_connector=db_connector, summary=summary,
+                                update_rollups=rollups,
+                                checkpoint=checkpoints.stream(
+                                    'messages_raw' + stream_suffix))
+    summary.print_summary()
+    return (len(records), latest,
+            all(summary.all_inserted(table_name) for table_name in tables))
+
+
+def run_worker(worker_id=None,
+               masking_strategy='auto_increment',
+               lease_seconds=60,
+               max_attempts=3,
+               poll_seconds=5,
+               idle_exit_seconds=60,
+               bulk_load=True,
+               metrics_dir='run_metrics',
+               rollups=False):
+    """
+    Function running a worker: shards are claimed and processed one at a time,
+    until no shard has been queued or leased for idle_exit_seconds.
+
+    :param worker_id: The id of the worker, unique over all the nodes. By
+                      default the host name and the process id.
+    :param masking_strategy: The strategy used to mask the sensitive user
+                             fields, see etl_main.
+    :param lease_seconds: The duration of the leases.
+    :param max_attempts: The number of times a shard is claimed before it is
+                         marked as failed.
+    :param poll_seconds: The wait between two claims when no shard is queued.
+    :param idle_exit_seconds: The time after which the worker stops when no
+                              shard is queued or leased.
+    :param bulk_load: Allow the bulk loader, see etl_main.
+    :param metrics_dir: The directory the metrics of the worker are written
+                        to, None to not write them.
+    :param rollups: Update the rollup tables, which the coordinator must have
+                    created (see run_coordinator).
+    """
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+    root_password = get_root_password()
+    db_connector = MySqlDbConnector(
+        username='root', password=root_password,
+        local_infile_dir=tempfile.gettempdir() if bulk_load else None)
+    db_connector.check_db_availability(max_retries=20)
+    api_connector = SparkApiConnector()
+    masker_secret = get_masking_secret() if masking_strategy == 'hmac' else None
+    masker = create_masker(masking_strategy, db_connector, masker_secret)
+    work_queue = WorkQueue(db_connector, lease_seconds=lease_seconds,
+                           max_attempts=max_attempts)
+    print(f'worker {worker_id} started')
+
+    idle_since = time.monotonic()
+    while True:
+        shard = work_queue.claim(worker_id)
+        if shard is None:
+            if work_queue.pending_shards():
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since >= idle_exit_seconds:
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        print(f'worker {worker_id}: processing shard {shard["shard_id"]} '
+              f'({shard["end_point"]}, pages {shard["first_page"]} to '
+              f'{shard["last_page"] or "end"}, attempt {shard["attempts"]})')
+        metrics.inc('shards_claimed_total', end_point=shard['end_point'])
+        with _LeaseHeartbeat(work_queue, shard['shard_id'], worker_id,
+                             interval=lease_seconds / 3) as heartbeat:
+            try:
+                records, latest, loaded = process_shard(
+                    shard, api_connector, db_connector, masker, root_password,
+                    rollups=rollups)
+                error = None if loaded else 'some records could not be loaded'
+            except Exception as err:
+                error = err
+        if heartbeat.lost:
+            # another worker holds the shard now, and reloads it idempotently
+            metrics.inc('shards_lost_total', end_point=shard['end_point'])
+            continue
+        if error is None:
+            work_queue.complete(shard['shard_id'], worker_id, records, latest)
+            metrics.inc('shards_done_total', end_point=shard['end_point'])
+        else:
+            print(f'shard {shard["shard_id"]} failed due to error: {error}')
+            work_queue.fail(shard['shard_id'], worker_id, shard['attempts'],
+                            error)
+            metrics.inc('shards_failed_total', end_point=shard['end_point'])
+
+    masker.close()
+    masker.report()
+    db_connector.close()
+    print(f'worker {worker_id} stopped, no shard left')
+    if metrics_dir:
+        metrics.write_metrics(metrics_dir,
+                              name=f'worker_{worker_id}'.replace('/', '_'))
+
+
+def run_coordinator(pages_per_shard=20,
+                    page_size=100,
+                    typed_schema=False,
+                    materialized_monitoring=False,
+                    poll_seconds=10,
+                    lease_seconds=60,
+                    max_attempts=3,
+                    metrics_dir='run_metrics',
+                    rollups=False):
+    """
+    Function running the coordinator of a sharded run: the database is
+    initialised, the shards are queued and, once the workers have processed
+    all of them, the high-water marks of the end points whose shards are all
+    done are updated and the monitoring views are refreshed.
+
+    :param pages_per_shard: The number of pages per shard.
+    :param page_size: The number of records per page.
+    :param typed_schema: Create (or migrate to) the typed raw tables.
+    :param materialized_monitoring: Store the monitoring query results in
+                                    backing tables, see etl_main.
+    :param poll_seconds: The wait between two checks of the progress.
+    :param lease_seconds: The duration of the leases of the workers.
+    :param max_attempts: The number of times a shard is claimed before it is
+                         marked as failed.
+    :param metrics_dir: The directory the metrics of the run are written to,
+                        None to not write them.
+    :param rollups: Create the rollup tables (see rollups.py), updated by
+                    workers started with the rollups enabled.
+    """
+    root_password = get_root_password()
+    db_connector = MySqlDbConnector(username='root', password=root_password)
+    db_connector.check_db_availability(max_retries=20)
+    db_connector.initialise_db_and_create_tables(drop_if_exists=False,
+                                                 typed_schema=typed_schema)
+    if rollups:
+        create_rollup_tables(db_connector)
+    else:
+        warn_if_rollups_exist(db_connector)
+    work_queue = WorkQueue(db_connector, lease_seconds=lease_seconds,
+                           max_attempts=max_attempts)
+    work_queue.create_table()
+
+    run_id = db_connector.start_etl_run()
+    run_start_time = time.perf_counter()
+    shards = plan_shards(SparkApiConnector(), pages_per_shard, page_size)
+    work_queue.enqueue(run_id, shards)
+    print(f'{len(shards)} shards queued for run {run_id}')
+
+    while work_queue.pending_shards(run_id):
+        time.sleep(poll_seconds)
+        work_queue.requeue_expired()
+        print(f'run {run_id}: {work_queue.run_status(run_id)}')
+    statuses = work_queue.run_status(run_id)
+    print(f'run {run_id} finished: {statuses}')
+    metrics.set_gauge('run_pipeline_seconds',
+                      time.perf_counter() - run_start_time, mode='sharded')
+
+    # the high-water marks only move forward if all the shards were loaded
+    for end_point, (latest, all_done) in \
+            work_queue.latest_records(run_id).items():
+        if all_done:
+            update_watermark(db_connector, end_point, latest)
+        else:
+            print(f'Error: some {end_point} shards failed, the high-water '
+                  f'mark is not updated')
+    db_connector.finish_etl_run(run_id, set(statuses) == {'done'})
+
+    print('creating monitoring views..')
+    with metrics.stage_timer('monitoring'):
+        create_monitoring_views('root', root_password,
+                                db_connector=db_connector,
+                                materialized=materialized_monitoring)
+    db_connector.close()
+    for status, count in statuses.items():
+        metrics.set_gauge('shards', count, status=status)
+    metrics.set_gauge('run_seconds', time.perf_counter() - run_start_time)
+    metrics.set_gauge('run_timestamp_seconds', time.time())
+    if metrics_dir:
+        metrics.write_metrics(metrics_dir)
+
+
+def parse_args():
+    """
+    Parse the command line arguments of the sharding script.
+    """
+    parser = argparse.ArgumentParser(
+        description='Run the spark ETL process sharded over several workers.')
+    parser.add_argument('role', choices=['coordinator', 'worker'])
+    parser.add_argument('--pages-per-shard', type=int, default=20,
+                        help='Number of pages of an end point per shard '
+                             '(coordinator).')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='Number of records per page (coordinator).')
+    parser.add_argument('--typed-schema', action='store_true',
+                        help='Use the typed raw tables (coordinator).')
+    parser.add_argument('--materialized-monitoring', action='store_true',
+                        help='Store the monitoring query results in tables '
+                             '(coordinator).')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of worker processes started on this '
+                             'node (worker).')
+    parser.add_argument('--masking-strategy', choices=MASKING_STRATEGIES,
+                        default='auto_increment',
+                        help='Strategy used to mask city, zipcode and '
+                             'profession (worker).')
+    parser.add_argument('--no-bulk-load', action='store_true',
+                        help='Never use LOAD DATA LOCAL INFILE (worker).')
+    parser.add_argument('--lease-seconds', type=int, default=60,
+                        help='Duration of the lease of a shard, renewed '
+                             'every third of it while the shard is '
+                             'processed.')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='Number of times a shard is claimed before it '
+                             'is marked as failed.')
+    parser.add_argument('--metrics-dir', default='run_metrics',
+                        help='Directory the metrics are written to.')
+    parser.add_argument('--rollups', action='store_true',
+                        help='Maintain the rollup tables (coordinator and '
+                             'workers).')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.role == 'coordinator':
+        run_coordinator(pages_per_shard=args.pages_per_shard,
+                        page_size=args.page_size,
+                        typed_schema=args.typed_schema,
+                        materialized_monitoring=args.materialized_monitoring,
+                        lease_seconds=args.lease_seconds,
+                        max_attempts=args.max_attempts,
+                        metrics_dir=args.metrics_dir,
+                        rollups=args.rollups)
+    else:
+        worker_args = {'masking_strategy': args.masking_strategy,
+                       'lease_seconds': args.lease_seconds,
+                       'max_attempts': args.max_attempts,
+                       'bulk_load': not args.no_bulk_load,
+                       'metrics_dir': args.metrics_dir,
+                       'rollups': args.rollups}
+        processes = [multiprocessing.Process(target=run_worker,
+                                             kwargs=worker_args)
+                     for _ in range(max(args.processes, 1))]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
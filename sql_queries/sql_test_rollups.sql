@@ -0,0 +1,67 @@
+-- the queries of sql_test.sql, reading the rollup tables maintained by the
+-- loader instead of scanning the raw tables
+
+-- how many total messages are sent each day
+select 
+    calendar_date, 
+    sum(total_messages) as total_messages 
+from spark_dwh.daily_message_counts
+group by calendar_date;
+
+-- users that did not receive any messages
+select 
+    a.* 
+from
+spark_dwh.users_raw a 
+left join spark_dwh.user_message_summary b 
+     on a.user_id = b.user_id 
+where coalesce(b.messages_received, 0) = 0;
+
+-- active subscriptions as of today
+select * from spark_dwh.user_subscription_intervals
+where status = 'Active' and end_date >= current_date();
+
+-- users sending messages without active subscriptions: the messages of
+-- sql_test.sql counted per day and sender. Days not overlapped by any
+-- fulfilled subscription of the sender are read from the rollup. On the
+-- boundary days, where a subscription starts or ends, the messages are checked
+-- one by one against the subscription intervals as in sql_test.sql.
+select 
+    a.calendar_date,
+    a.sender_id,
+    a.total_messages
+from spark_dwh.daily_message_counts a
+where not exists (
+    select 1 from spark_dwh.user_subscription_intervals b
+    where b.user_id = a.sender_id 
+    and b.status <> 'Rejected'
+    and b.start_date < a.calendar_date + interval 1 day
+    and b.end_date >= a.calendar_date)
+union all
+select 
+    a.calendar_date,
+    a.sender_id,
+    count(*) as total_messages
+from spark_dwh.daily_message_counts a
+join spark_dwh.messages_raw m
+     on m.sender_id = a.sender_id 
+     and m.created_at >= a.calendar_date 
+     and m.created_at < a.calendar_date + interval 1 day
+where exists (
+    select 1 from spark_dwh.user_subscription_intervals b
+    where b.user_id = a.sender_id 
+    and b.status <> 'Rejected'
+    and b.start_date < a.calendar_date + interval 1 day
+    and b.end_date >= a.calendar_date)
+and not exists (
+    select 1 from spark_dwh.user_subscription_intervals b
+    where b.user_id = a.sender_id 
+    and b.status <> 'Rejected'
+    and b.start_date <= a.calendar_date
+    and b.end_date >= a.calendar_date + interval 1 day)
+and not exists (
+    select 1 from spark_dwh.user_subscription_intervals b
+    where b.user_id = m.sender_id 
+    and b.status <> 'Rejected'
+    and m.created_at between b.start_date and b.end_date)
+group by a.calendar_date, a.sender_id;
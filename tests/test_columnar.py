@@ -0,0 +1,81 @@
+"""
+Tests checking that the columnar transform path (columnar.py) gives the same
+users_raw and subscriptions_raw records as the row path.
+"""
+import random
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('pandas')
+
+from benchmark import generate_users
+from columnar import compare_with_row_path
+from masking import HmacMasker
+
+
+def make_edge_users():
+    """
+    Function to build users with missing, null and unusual values.
+    """
+    subscription = {'createdAt': '2021-03-01T10:00:00.000Z',
+                    'startDate': '2021-03-01T10:00:00.000Z',
+                    'endDate': '2021-04-01T10:00:00.000Z',
+                    'status': 'Active',
+                    'amount': '9.99'}
+    return [
+        # all the values null
+        {'id': '1', 'createdAt': None, 'updatedAt': None, 'firstName': None,
+         'lastName': None, 'address': None, 'city': None, 'country': None,
+         'zipCode': None, 'email': None, 'birthDate': None, 'profile': {},
+         'subscription': []},
+        # all the fields missing
+        {'id': '2'},
+        # empty values, an email without domain, a profile without values
+        {'id': '3', 'createdAt': '', 'updatedAt': '', 'city': '',
+         'country': '', 'zipCode': '', 'email': 'no-domain',
+         'birthDate': '', 'profile': {}, 'subscription': []},
+        # unusual email and values, a subscription with null fields
+        {'id': '4', 'createdAt': '2021-01-01T00:00:00.000Z',
+         'updatedAt': '2021-01-02T00:00:00Z', 'firstName': 'Zoë',
+         'lastName': "O'Brien", 'address': '1 Rue', 'city': 'Zürich',
+         'country': 'Switzerland', 'zipCode': '00000',
+         'email': 'a@b@Example.COM', 'birthDate': '1900-01-01T00:00:00.000Z',
+         'profile': {'gender': None, 'isSmoking': None, 'profession': None,
+                     'income': None},
+         'subscription': [dict(subscription),
+                          {'createdAt': None, 'startDate': None,
+                           'endDate': None, 'status': None,
+                           'amount': None}]},
+        # numeric values as numbers instead of strings
+        {'id': 5, 'createdAt': '2021-01-01T00:00:00.000Z', 'city': 'Zürich',
+         'zipCode': '00000', 'email': 'x@example.com',
+         'profile': {'gender': 'other', 'isSmoking': False,
+                     'profession': 'Chef', 'income': 0},
+         'subscription': [dict(subscription, amount=0, status='Rejected')]},
+    ]
+
+
+@pytest.mark.parametrize('users', [
+    pytest.param(generate_users(500, datetime(2021, 1, 1), random.Random(7)),
+                 id='generated'),
+    pytest.param(make_edge_users(), id='edge_values'),
+    pytest.param([], id='no_users')])
+def test_columnar_path_matches_row_path(users):
+    masker = HmacMasker('test secret')
+    assert compare_with_row_path(users, masker) == []
+
+
+def test_comparison_detects_differences(monkeypatch):
+    import columnar
+
+    users = generate_users(10, datetime(2021, 1, 1), random.Random(7))
+    transform_users_columnar = columnar.transform_users_columnar
+
+    def drop_first_user(users_data, masker):
+        user_records, subscription_records = transform_users_columnar(
+            users_data, masker)
+        return user_records[1:], subscription_records
+
+    monkeypatch.setattr(columnar, 'transform_users_columnar', drop_first_user)
+    assert compare_with_row_path(users, HmacMasker('test secret'))
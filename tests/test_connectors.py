@@ -0,0 +1,213 @@
+"""
+Tests of the API fetcher and of the row fingerprints of connectors.py.
+"""
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+import pytest
+import requests
+
+import connectors
+from connectors import (ConcurrentPageFetcher, compute_row_hash,
+                        parse_retry_after, row_hash_sql)
+
+
+def make_response(status_code, body=b'[]', headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body
+    response.headers.update(headers or {})
+    response.url = 'http://api/messages'
+    return response
+
+
+class FakeSession:
+    """
+    Session answering the requests with the given responses, in order.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+
+    def get(self, url, params=None, headers=None, stream=False):
+        self.requests += 1
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(connectors.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, None),
+    ('', None),
+    ('7', 7),
+    (' 120 ', 120),
+    ('Wed, 21 Oct 2015 07:28:30 GMT', 30),
+    ('Wed, 21 Oct 2015 07:27:00 GMT', 0),
+    ('soon', None),
+    ('-1', None)])
+def test_parse_retry_after(value, expected):
+    now = datetime(2015, 10, 21, 7, 28, tzinfo=timezone.utc)
+    assert parse_retry_after(value, now=now) == expected
+
+
+@pytest.mark.parametrize('status_code', [429, 503])
+def test_retry_after_header_is_honoured(sleeps, status_code):
+    session = FakeSession([
+        make_response(status_code, headers={'Retry-After': '7'}),
+        make_response(200, b'[{"id": 1}]')])
+    fetcher = ConcurrentPageFetcher(session, requests_per_second=None)
+    assert fetcher.fetch('http://api/messages') == [{'id': 1}]
+    assert session.requests == 2
+    assert sleeps == [7]
+
+
+def test_retry_after_is_capped_by_backoff_max(sleeps):
+    session = FakeSession([
+        make_response(429, headers={'Retry-After': '3600'}),
+        make_response(200, b'[]')])
+    fetcher = ConcurrentPageFetcher(session, requests_per_second=None,
+                                    backoff_max=30)
+    assert fetcher.fetch('http://api/messages') == []
+    assert sleeps == [30]
+
+
+def test_exponential_backoff_without_retry_after(sleeps):
+    session = FakeSession([make_response(503), make_response(503),
+                           make_response(200, b'[]')])
+    fetcher = ConcurrentPageFetcher(session, requests_per_second=None,
+                                    backoff_base=1)
+    assert fetcher.fetch('http://api/messages') == []
+    assert len(sleeps) == 2
+    assert 0.5 <= sleeps[0] <= 1.5 and 1 <= sleeps[1] <= 3
+
+
+def test_failed_page_raises_after_retries(sleeps):
+    session = FakeSession([make_response(503)] * 3)
+    fetcher = ConcurrentPageFetcher(session, requests_per_second=None,
+                                    max_retries=2)
+    with pytest.raises(connectors.ApiFetchError):
+        fetcher.fetch('http://api/messages')
+    assert session.requests == 3
+
+
+class FakeConnection:
+    def __init__(self):
+        self.connection_id = 1
+        self.pings = 0
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        self.pings += 1
+        self.connection_id += 1
+
+    def rollback(self):
+        pass
+
+
+class PooledConnection:
+    """
+    The wrapper returned by each checkout of a mysql.connector pool.
+    """
+    def __init__(self, cnx):
+        self._cnx = cnx
+        self.connection_id = cnx.connection_id
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+        self.cnx = FakeConnection()
+
+    def get_connection(self):
+        return PooledConnection(self.cnx)
+
+
+def make_db_connector(pool_size=1):
+    db_connector = connectors.MySqlDbConnector('root', 'password',
+                                               pool_size=pool_size)
+    pools = {}
+    db_connector._get_pool = \
+        lambda database=None, **args: pools.setdefault(database, FakePool())
+    return db_connector
+
+
+def test_connections_of_other_databases_can_be_nested():
+    db_connector = make_db_connector(pool_size=1)
+    acquired = threading.Event()
+
+    def nested_checkout():
+        with db_connector.connection(database='spark_dwh'):
+            with db_connector.connection(database='sensitive_data'):
+                acquired.set()
+
+    thread = threading.Thread(target=nested_checkout, daemon=True)
+    thread.start()
+    assert acquired.wait(5)
+
+
+def test_idle_time_is_kept_across_reconnects():
+    db_connector = make_db_connector()
+    with db_connector.connection() as db_conn:
+        cnx = db_conn._cnx
+    # pinged once on the first checkout, which changes its connection_id
+    assert cnx.pings == 1
+    with db_connector.connection():
+        pass
+    assert cnx.pings == 1
+    assert len(db_connector._last_used) == 1
+
+
+def mysql_row_hashes(columns, rows):
+    """
+    Runs the expression of row_hash_sql on rows in SQLite, with the MySQL
+    functions it uses: CONCAT_WS skips NULLs, SHA2 hashes the bytes of its
+    utf8mb4 argument.
+    """
+    db = sqlite3.connect(':memory:')
+    db.create_function('SHA2', 2, lambda value, bits: hashlib.sha256(
+        value.encode('utf-8')).hexdigest())
+    db.create_function('CONCAT_WS', -1, lambda separator, *values: separator
+                       .join(value for value in values if value is not None))
+    db.create_function('CHAR', 1, chr)
+    db.create_function('CONVERT', 1, lambda value: value)
+    db.execute(f'CREATE TABLE t ({", ".join(columns)})')
+    db.executemany(f'INSERT INTO t VALUES ({", ".join("?" * len(columns))})',
+                   rows)
+    expression = row_hash_sql(columns).replace(' USING utf8mb4', '')
+    return [row_hash for row_hash, in db.execute(f'SELECT {expression} FROM t')]
+
+
+@pytest.mark.parametrize('values', [
+    ('1', '2023-01-31 10:00:00', 'Paris', 'a@b.com'),
+    (None, None, None, None),
+    ('', '', '', ''),
+    ('1', '', None, 'None'),
+    ('Zoë', 'Köln', '北京', 'emoji 🎉'),
+    ('tab\tand\nnewline', '\\', ' trailing ', 'x\x1fy'),
+])
+def test_row_hash_matches_the_sql_backfill(values):
+    # not in the sorted order, with the load time left out of the fingerprint
+    columns = ['user_id', 'created_at', 'city', 'email', 'last_updated_at']
+    row = values + ('2023-02-01 00:00:00',)
+    record = dict(zip(columns, row))
+    assert mysql_row_hashes(columns, [row]) == [compute_row_hash(record)]
+
+
+def test_row_hash_sql_canonical_form():
+    assert row_hash_sql(['b', 'row_hash', 'a', 'last_updated_at']) == (
+        "SHA2(CONCAT_WS(CHAR(31 USING utf8mb4), "
+        "CONVERT(COALESCE(a, 'None') USING utf8mb4), "
+        "CONVERT(COALESCE(b, 'None') USING utf8mb4)), 256)")
+    assert compute_row_hash({'b': 'é', 'a': None, 'row_hash': 'x'}) == \
+        hashlib.sha256('None\x1fé'.encode('utf-8')).hexdigest()
@@ -0,0 +1,69 @@
+"""
+Tests of the incremental parsing of the API responses, both backends being
+compared with json.loads on documents split in chunks at every position.
+"""
+import json
+
+import pytest
+
+import json_stream
+from json_stream import iter_json_array
+
+BACKENDS = ['scanner',
+            pytest.param('ijson', marks=pytest.mark.skipif(
+                json_stream.ijson is None, reason='ijson is not installed'))]
+
+DOCUMENTS = {
+    'empty array': '[ ]',
+    'escaped quotes': '[{"text": "say \\"hi\\" \\\\"}, {"text": "\\"\\""}]',
+    'big integers': '[{"id": 123456789012345678901234567890, '
+                    '"balance": -18446744073709551617, "rate": 2.5}]',
+    'nested objects': '[{"user": {"address": {"city": "Köln", "zip": [1, '
+                      '{"a": null}]}, "tags": []}, "active": true}, [], 7]',
+}
+
+
+def split_at(data, *positions):
+    bounds = [0, *positions, len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('name', sorted(DOCUMENTS))
+def test_chunks_split_anywhere(backend, name):
+    data = DOCUMENTS[name].encode()
+    expected = json.loads(data)
+    for position in range(len(data) + 1):
+        chunks = split_at(data, position)
+        assert list(iter_json_array(chunks, backend=backend)) == expected
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_closing_bracket_in_a_later_chunk(backend):
+    chunks = [b'[{"id": 1}, {"id": 2}', b'  ', b'', b']']
+    assert list(iter_json_array(chunks, backend=backend)) == \
+        [{'id': 1}, {'id': 2}]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_escaped_quote_across_chunks(backend):
+    data = b'[{"text": "a\\"b"}]'
+    backslash = data.index(b'\\')
+    # the backslash ends a chunk, the quote it escapes starts the next one
+    chunks = split_at(data, backslash + 1)
+    assert list(iter_json_array(chunks, backend=backend)) == json.loads(data)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_single_byte_chunks(backend):
+    data = json.dumps([{'id': 2 ** 70, 'nested': {'a': [1.5, 'x"y']},
+                        'name': 'Zoë'}]).encode()
+    chunks = [data[index:index + 1] for index in range(len(data))]
+    assert list(iter_json_array(chunks, backend=backend)) == json.loads(data)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('data', [b'{"id": 1}', b'[{"id": 1}', b'[1] 2'])
+def test_invalid_documents(backend, data):
+    with pytest.raises(ValueError):
+        list(iter_json_array(split_at(data, 3), backend=backend))
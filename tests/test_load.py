@@ -0,0 +1,234 @@
+"""
+Tests of the load checkpoints and of the bulk loader of load.py.
+"""
+import io
+import os
+from contextlib import contextmanager
+from datetime import date, datetime
+
+import pytest
+
+from connectors import MySqlDbConnector
+from load import (LoadCheckpoint, RunCheckpoints, _bulk_load_data,
+                  prepare_message_records, write_tsv)
+
+
+def make_messages(ids):
+    return list(prepare_message_records([
+        {'id': str(message_id), 'sender_id': '1', 'receiver_id': '2',
+         'created_at': '2023-01-31T10:00:00.000Z',
+         'last_updated_at': '2023-02-01 00:00:00'}
+        for message_id in ids]))
+
+
+class FakeConnection:
+    """
+    Connection on which no statement is expected to run.
+    """
+    def cursor(self, *args, **kwargs):
+        raise AssertionError('no statement expected')
+
+
+class StubConnector(MySqlDbConnector):
+    """
+    Connector holding the checkpoint rows of a run in memory.
+    """
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.requested_streams = []
+
+    def get_load_checkpoints(self, run_id, streams=None, database='spark_dwh'):
+        self.requested_streams.append(streams)
+        committed = {}
+        for row_run_id, stream, offset, digest in self.rows:
+            if row_run_id == run_id and (streams is None or stream in streams):
+                committed.setdefault(stream, {})[offset] = digest
+        return committed
+
+    def get_table_columns(self, table_name, database='spark_dwh'):
+        return {'row_hash': 'varchar'}
+
+    @contextmanager
+    def connection(self, database=None):
+        yield FakeConnection()
+
+
+def recorded_rows(checkpoint, batches):
+    rows = []
+
+    def execute(query, params):
+        run_id, stream, offset, _, digest, _ = params
+        rows.append((run_id, stream, offset, digest))
+
+    for offset, batch in batches:
+        checkpoint.record(execute, offset, batch)
+    return rows
+
+
+def test_digest_does_not_depend_on_record_order():
+    batch = make_messages([1, 2, 3])
+    assert LoadCheckpoint.digest(batch) == \
+        LoadCheckpoint.digest(list(reversed(batch)))
+
+
+def test_digest_changes_with_a_record():
+    batch = make_messages([1, 2, 3])
+    changed = make_messages([1, 2, 3])
+    changed[1]['receiver_id'] = '3'
+    assert LoadCheckpoint.digest(batch) != LoadCheckpoint.digest(changed)
+    assert LoadCheckpoint.digest(batch) != \
+        LoadCheckpoint.digest(make_messages([1, 2]))
+
+
+def test_committed_batches_of_the_run_only():
+    batch = make_messages([1, 2])
+    rows = recorded_rows(LoadCheckpoint(7, 'messages_raw'), [(0, batch)])
+    rows += recorded_rows(LoadCheckpoint(8, 'messages_raw'),
+                          [(2, make_messages([3, 4]))])
+
+    checkpoint = RunCheckpoints(StubConnector(rows), 7).stream('messages_raw')
+    assert checkpoint.is_committed(0, batch)
+    assert not checkpoint.is_committed(2, make_messages([3, 4]))
+    assert not checkpoint.is_committed(0, make_messages([1, 3]))
+    assert not RunCheckpoints(StubConnector(rows), 7) \
+        .stream('users_raw').is_committed(0, batch)
+
+
+def test_only_the_given_streams_are_read():
+    rows = recorded_rows(LoadCheckpoint(7, 'messages_raw/shard-1'),
+                         [(0, make_messages([1]))])
+    rows += recorded_rows(LoadCheckpoint(7, 'messages_raw/shard-2'),
+                          [(0, make_messages([2]))])
+    connector = StubConnector(rows)
+    checkpoints = RunCheckpoints(connector, 7,
+                                 streams=['messages_raw/shard-2'])
+    assert connector.requested_streams == [['messages_raw/shard-2']]
+    assert checkpoints.stream('messages_raw/shard-2') \
+        .is_committed(0, make_messages([2]))
+    assert not checkpoints.stream('messages_raw/shard-1') \
+        .is_committed(0, make_messages([1]))
+
+
+@pytest.mark.parametrize('batch_size', [2, 4])
+def test_checkpointed_batches_are_skipped(batch_size):
+    records = make_messages([1, 2, 3, 4])
+    batches = [(offset, records[offset:offset + batch_size])
+               for offset in range(0, len(records), batch_size)]
+    connector = StubConnector(recorded_rows(LoadCheckpoint(7, 'messages_raw'),
+                                            batches))
+    committed = []
+
+    inserted, skipped, failed = connector.insert_records(
+        'messages_raw', records, batch_size=batch_size,
+        checkpoint=RunCheckpoints(connector, 7).stream('messages_raw'),
+        on_batch_committed=committed.append)
+
+    assert (inserted, skipped, failed) == (0, 4, 0)
+    assert committed == [batch for _, batch in batches]
+
+
+def read_tsv(text, fields):
+    """
+    Reads the lines written by write_tsv as LOAD DATA does with its default
+    options.
+    """
+    unescape = {'t': '\t', 'n': '\n', 'r': '\r', '0': '\0', '\\': '\\'}
+    records = []
+    for line in text.split('\n')[:-1]:
+        values = []
+        for value in line.split('\t'):
+            if value == '\\N':
+                values.append(None)
+                continue
+            chars = iter(value)
+            values.append(''.join(unescape[next(chars)] if char == '\\'
+                                  else char for char in chars))
+        records.append(dict(zip(fields, values)))
+    return records
+
+
+def test_write_tsv_round_trip():
+    fields = ['id', 'text', 'missing', 'flag', 'created_at', 'day']
+    records = [
+        {'id': 1, 'text': 'tab\there', 'missing': None, 'flag': True,
+         'created_at': datetime(2023, 1, 31, 10, 0, 1),
+         'day': date(2023, 1, 31)},
+        {'id': 2, 'text': 'line\nbreak\r\nend', 'missing': '', 'flag': False},
+        {'id': 3, 'text': 'back\\slash \\N \\t\\', 'missing': '\\N'},
+        {'id': 4, 'text': 'nul\0 and ünïcode', 'missing': 'N'},
+    ]
+    file = io.StringIO()
+    write_tsv(records, fields, file)
+    assert file.getvalue().count('\n') == len(records)
+
+    expected = [{field: record.get(field) for field in fields}
+                for record in records]
+    for record in expected:
+        for field, value in record.items():
+            if isinstance(value, bool):
+                record[field] = str(int(value))
+            elif isinstance(value, datetime):
+                record[field] = value.isoformat(' ')
+            elif value is not None:
+                record[field] = str(value)
+    assert read_tsv(file.getvalue(), fields) == expected
+
+
+class LocalInfileError(Exception):
+    errno = 1148
+
+
+class BulkLoadConnector(MySqlDbConnector):
+    """
+    Connector whose bulk loader fails from a given chunk on, recording the
+    records inserted in batches instead.
+    """
+    def __init__(self, local_infile_dir, failing_chunk, error):
+        self._local_infile_dir = local_infile_dir
+        self.failing_chunk = failing_chunk
+        self.error = error
+        self.bulk_loaded = []
+        self.files = []
+        self.inserted = []
+
+    def get_local_infile_dir(self):
+        return self._local_infile_dir
+
+    def bulk_load_file(self, table_name, path, fields, records, **kwargs):
+        self.files.append(path)
+        assert os.path.exists(path)
+        if len(self.bulk_loaded) == self.failing_chunk:
+            raise self.error
+        self.bulk_loaded.append(records)
+        return len(records), 0, 0
+
+    def insert_records(self, table_name, records, checkpoint_offset=0,
+                       **kwargs):
+        records = list(records)
+        self.inserted.append((checkpoint_offset, records))
+        return len(records), 0, 0
+
+
+@pytest.mark.parametrize('failing_chunk', [0, 1])
+def test_bulk_load_falls_back_to_batches(tmp_path, failing_chunk):
+    records = make_messages([1, 2, 3, 4, 5])
+    connector = BulkLoadConnector(str(tmp_path), failing_chunk,
+                                  LocalInfileError('LOAD DATA not allowed'))
+
+    counts = _bulk_load_data('messages_raw', records, connector, chunk_size=2)
+
+    assert counts == (5, 0, 0)
+    loaded = 2 * failing_chunk
+    assert connector.bulk_loaded == [records[:2]] * failing_chunk
+    assert connector.inserted == [(loaded, records[loaded:])]
+    assert not any(os.path.exists(path) for path in connector.files)
+
+
+def test_bulk_load_raises_other_errors(tmp_path):
+    error = Exception('server has gone away')
+    error.errno = 2006
+    connector = BulkLoadConnector(str(tmp_path), 0, error)
+    with pytest.raises(Exception, match='gone away'):
+        _bulk_load_data('messages_raw', make_messages([1]), connector)
+    assert connector.inserted == []
+    assert not os.listdir(str(tmp_path))
@@ -0,0 +1,61 @@
+"""
+Tests of the writing of the token mappings of the HmacMasker.
+"""
+import time
+
+import pytest
+
+from masking import HmacMasker
+
+
+class FlakyConnector:
+    """
+    Connector failing the first `failures` writes of mappings.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        self.stored = {}
+
+    def store_mask_tokens(self, table_name, field, tokens,
+                          database='spark_dwh'):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('lost connection')
+        self.stored.setdefault(field, {}).update(tokens)
+
+
+def make_masker(connector, max_write_retries=2):
+    return HmacMasker('secret', db_connector=connector, flush_interval=0.01,
+                      max_write_retries=max_write_retries, retry_backoff=0)
+
+
+def test_failed_write_is_retried():
+    connector = FlakyConnector(failures=2)
+    masker = make_masker(connector)
+    ids = masker.get_ids('city', ['Paris', 'Lyon', 'Paris'])
+    masker.close()
+    assert connector.stored['city'] == {ids['Paris']: 'Paris',
+                                        ids['Lyon']: 'Lyon'}
+
+
+def test_close_raises_when_mappings_are_lost():
+    connector = FlakyConnector(failures=10)
+    masker = make_masker(connector, max_write_retries=1)
+    masker.get_ids('zipcode', ['00001'])
+    with pytest.raises(RuntimeError, match='zipcode'):
+        masker.close()
+    assert not connector.stored
+
+
+def test_unwritten_mappings_are_queued_again():
+    connector = FlakyConnector(failures=2)
+    masker = make_masker(connector, max_write_retries=1)
+    masker.get_ids('profession', ['Chef'])
+    deadline = time.monotonic() + 5
+    while not masker._unwritten['profession'] and \
+            time.monotonic() < deadline:
+        time.sleep(0.01)
+    # the first write and its retry failed, the value is masked again
+    masker.get_ids('profession', ['Chef'])
+    masker.close()
+    assert list(connector.stored['profession'].values()) == ['Chef']
@@ -0,0 +1,60 @@
+"""
+Tests of the Prometheus text format written by the MetricsRegistry.
+"""
+from metrics import MetricsRegistry
+
+
+def test_counters_and_gauges():
+    registry = MetricsRegistry()
+    registry.inc('db_commits_total')
+    registry.inc('db_commits_total', 2)
+    registry.inc('stage_records', 5, stage='load', direction='in')
+    registry.set_gauge('queue_size', 3, queue='shards')
+
+    assert registry.to_prometheus().splitlines() == [
+        '# TYPE spark_etl_db_commits_total counter',
+        'spark_etl_db_commits_total 3',
+        '# TYPE spark_etl_stage_records_total counter',
+        'spark_etl_stage_records_total{direction="in",stage="load"} 5',
+        '# TYPE spark_etl_queue_size gauge',
+        'spark_etl_queue_size{queue="shards"} 3',
+    ]
+
+
+def test_type_declared_once_per_metric():
+    registry = MetricsRegistry()
+    registry.inc('api_requests_total', end_point='users')
+    registry.inc('api_requests_total', end_point='messages')
+    lines = registry.to_prometheus(prefix='etl').splitlines()
+    assert lines == ['# TYPE etl_api_requests_total counter',
+                     'etl_api_requests_total{end_point="messages"} 1',
+                     'etl_api_requests_total{end_point="users"} 1']
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.inc('api_errors_total', error='say "hi"\\path\nnext', code=500)
+    assert registry.to_prometheus().splitlines()[1] == (
+        'spark_etl_api_errors_total'
+        '{code="500",error="say \\"hi\\"\\\\path\\nnext"} 1')
+
+
+def test_histogram_buckets():
+    registry = MetricsRegistry(buckets=(0.1, 1, 10))
+    for value in [0.05, 0.1, 0.5, 20]:
+        registry.observe('db_statement_seconds', value, statement='SELECT')
+
+    assert registry.to_prometheus().splitlines() == [
+        '# TYPE spark_etl_db_statement_seconds histogram',
+        # cumulative counts, the le label coming last
+        'spark_etl_db_statement_seconds_bucket{statement="SELECT",le="0.1"} 2',
+        'spark_etl_db_statement_seconds_bucket{statement="SELECT",le="1"} 3',
+        'spark_etl_db_statement_seconds_bucket{statement="SELECT",le="10"} 3',
+        'spark_etl_db_statement_seconds_bucket{statement="SELECT",le="+Inf"} 4',
+        'spark_etl_db_statement_seconds_sum{statement="SELECT"} 20.65',
+        'spark_etl_db_statement_seconds_count{statement="SELECT"} 4',
+    ]
+
+
+def test_empty_registry():
+    assert MetricsRegistry().to_prometheus() == '\n'
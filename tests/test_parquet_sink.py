@@ -0,0 +1,53 @@
+"""
+Tests of the skipping of the records already written by the ParquetSink.
+"""
+import pytest
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+import parquet_sink
+from parquet_sink import ParquetSink, manifest_files
+
+
+def make_messages(ids):
+    return [{'id': str(message_id), 'sender_id': '1', 'receiver_id': '2',
+             'created_at': '2023-01-31T10:00:00.000Z',
+             'last_updated_at': '2023-02-01 00:00:00'}
+            for message_id in ids]
+
+
+def read_ids(output_dir):
+    return sorted(message_id for path in manifest_files(output_dir,
+                                                        'messages_raw')
+                  for message_id in pq.read_table(path).column('id')
+                  .to_pylist())
+
+
+def test_records_are_written_once(tmp_path):
+    sink = ParquetSink(str(tmp_path))
+    for record in make_messages([1, 2, 2]) + make_messages([2, 3]):
+        sink.add('messages_raw', record)
+    sink.flush()
+    for record in make_messages([3, 4]):
+        sink.add('messages_raw', record)
+    sink.close()
+    assert read_ids(str(tmp_path)) == [1, 2, 3, 4]
+
+
+def test_records_of_a_failed_write_are_written_again(tmp_path, monkeypatch):
+    sink = ParquetSink(str(tmp_path))
+    write_table = pq.write_table
+
+    def failing_write_table(*args, **kwargs):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(parquet_sink.pq, 'write_table', failing_write_table)
+    for record in make_messages([1, 2]):
+        sink.add('messages_raw', record)
+    with pytest.raises(OSError):
+        sink.flush()
+    monkeypatch.setattr(parquet_sink.pq, 'write_table', write_table)
+    for record in make_messages([1, 2]):
+        sink.add('messages_raw', record)
+    sink.close()
+    assert read_ids(str(tmp_path)) == [1, 2]
@@ -0,0 +1,132 @@
+"""
+Tests of the record types of records.py, which must be taken by the loader as
+it takes dictionaries.
+"""
+from array import array
+
+import pytest
+
+from connectors import compute_row_hash
+from records import (MessageBatch, MessageRecord, SubscriptionRecord,
+                     UserRecord, map_record_values, str_record)
+
+API_MESSAGES = [
+    {'id': '1', 'createdAt': '2023-01-31T10:00:00.000Z', 'receiverId': '20',
+     'senderId': '30', 'message': 'hello'},
+    {'id': '2', 'createdAt': '2023-01-31T11:00:00.000Z', 'receiverId': '21',
+     'senderId': '31', 'message': 'bye'},
+]
+
+
+def make_user(**fields):
+    user = dict(user_id=1, created_at='2023-01-01', updated_at='2023-01-02',
+                city_id=None, country='France', zipcode_id=7,
+                email='a@b.com', birth_date='1990-05-04', gender='F',
+                is_smoking=False, profession_id=3, income=12.5)
+    user.update(fields)
+    return UserRecord(**user), user
+
+
+def test_record_behaves_like_a_dict():
+    record, user = make_user()
+    assert list(record.keys()) == list(UserRecord.FIELDS)
+    assert list(record) == list(user)
+    assert len(record) == len(user)
+    assert record.items() == list(user.items())
+    assert record.values() == list(user.values())
+    assert record['email'] == 'a@b.com'
+    assert record.get('city_id', 'missing') is None
+    assert record.get('unknown') is None
+    assert record.get('unknown', 0) == 0
+    assert 'email' in record and 'unknown' not in record
+    with pytest.raises(KeyError):
+        record['unknown']
+    with pytest.raises(KeyError):
+        record['unknown'] = 1
+
+
+def test_load_fields_are_only_part_of_the_record_once_set():
+    record, user = make_user()
+    assert 'row_hash' not in record
+    assert record.get('row_hash') is None
+    with pytest.raises(KeyError):
+        record['row_hash']
+    record['last_updated_at'] = '2023-02-01 00:00:00'
+    user['last_updated_at'] = '2023-02-01 00:00:00'
+    assert list(record.keys())[-1] == 'last_updated_at'
+    assert dict(record.items()) == user
+
+
+def test_equality():
+    record, user = make_user()
+    assert record == make_user()[0]
+    assert record == user and user == record
+    assert record != make_user(income=13)[0]
+    assert record != dict(user, income=13)
+    # same values, other record type
+    assert MessageRecord(1, 'a', 2, 3) != SubscriptionRecord(1, 'a', 2, 3, 4,
+                                                             5)
+    assert MessageRecord(1, 'a', 2, 3) != [1, 'a', 2, 3]
+
+
+def test_map_and_str_values():
+    record, user = make_user()
+    record['row_hash'] = 'abc'
+    user['row_hash'] = 'abc'
+    assert str_record(record) == str_record(user)
+    assert isinstance(str_record(record), UserRecord)
+
+    def upper(field, value):
+        return value.upper() if isinstance(value, str) else value
+
+    assert map_record_values(record, upper) == map_record_values(user, upper)
+    assert isinstance(map_record_values(record, upper), UserRecord)
+
+
+@pytest.mark.parametrize('record', [
+    make_user()[0],
+    make_user(city_id='', email='é@ü.com', income=None)[0],
+    SubscriptionRecord(1, '2023-01-01', '2023-01-01', '2023-02-01',
+                       'Active', 9.99),
+    MessageRecord.from_api(API_MESSAGES[0]),
+])
+def test_row_hash_of_records_and_dicts(record):
+    as_dict = dict(record.items())
+    assert compute_row_hash(record) == compute_row_hash(as_dict)
+    # the load fields are not part of the fingerprint
+    row_hash = compute_row_hash(record)
+    record['last_updated_at'] = '2023-02-01 00:00:00'
+    record['row_hash'] = 'abc'
+    assert compute_row_hash(record) == row_hash
+    assert compute_row_hash(dict(record.items())) == row_hash
+
+
+def test_message_batch_columns():
+    batch = MessageBatch.from_api(API_MESSAGES)
+    ids, created_at, receiver_ids, sender_ids = batch._columns
+    for column in (ids, receiver_ids, sender_ids):
+        assert isinstance(column, array) and column.typecode == 'q'
+    assert isinstance(created_at, list)
+
+    assert len(batch) == 2
+    records = [MessageRecord.from_api(message) for message in API_MESSAGES]
+    # the ids are read back as int, with the same string and fingerprint
+    assert list(batch) == [record.map_values(
+        lambda field, value: value if field == 'created_at' else int(value))
+        for record in records]
+    assert batch[1]['sender_id'] == 31
+    assert [compute_row_hash(record) for record in batch] == \
+        [compute_row_hash(record) for record in records]
+
+
+@pytest.mark.parametrize('ids', [
+    ['1', 'a'],
+    ['01', '2'],
+    [1, None],
+    [True, 2],
+    [1, 2 ** 64],
+])
+def test_message_batch_keeps_other_ids_as_they_are(ids):
+    batch = MessageBatch(ids, ['t1', 't2'], [1, 2], [3, 4])
+    assert batch._columns[0] == ids
+    assert [record['id'] for record in batch] == ids
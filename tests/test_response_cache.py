@@ -0,0 +1,174 @@
+"""
+Tests of the ResponseCache and of its use by the ConcurrentPageFetcher
+(conditional requests and replay).
+"""
+import os
+
+import pytest
+import requests
+
+import response_cache
+from connectors import ApiFetchError, ConcurrentPageFetcher
+from response_cache import ResponseCache
+
+URL = 'http://api/messages'
+BODY = b'[{"id": 1}, {"id": 2}]'
+
+
+def make_response(status_code, body=b'', headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body
+    response.headers.update(headers or {})
+    response.url = URL
+    return response
+
+
+class RecordingSession:
+    """
+    Session answering the requests with the given responses, in order, and
+    recording the headers of each request.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.headers = []
+
+    def get(self, url, params=None, headers=None, stream=False):
+        self.headers.append(headers or {})
+        return self.responses.pop(0)
+
+
+class RawBody:
+    """
+    Raw body of a streamed response, read in chunks.
+    """
+    def __init__(self, body):
+        self._body = body
+        self._position = 0
+
+    def read(self, size=-1, **kwargs):
+        if size is None or size < 0:
+            size = len(self._body)
+        chunk = self._body[self._position:self._position + size]
+        self._position += len(chunk)
+        return chunk
+
+    def stream(self, size, decode_content=True):
+        while True:
+            chunk = self.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+    def tell(self):
+        return self._position
+
+
+def test_store_and_load(tmp_path):
+    cache = ResponseCache(str(tmp_path), compression='gzip')
+    assert cache.load(URL, {'page': 1}) is None
+    assert cache.conditional_headers(URL, {'page': 1}) == {}
+
+    cache.store(URL, {'page': 1}, BODY, etag='"v1"',
+                last_modified='Wed, 21 Oct 2015 07:28:00 GMT')
+    assert cache.load(URL, {'page': 1}) == BODY
+    assert cache.load(URL, {'page': 2}) is None
+    assert cache.conditional_headers(URL, {'page': 1}) == {
+        'If-None-Match': '"v1"',
+        'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+    # one directory per end point, no temporary file left behind
+    assert sorted(os.listdir(str(tmp_path / 'messages')))[0].endswith('.body')
+    assert not [name for name in os.listdir(str(tmp_path / 'messages'))
+                if name.endswith('.tmp')]
+
+
+def test_params_order_does_not_matter(tmp_path):
+    cache = ResponseCache(str(tmp_path), compression='gzip')
+    cache.store(URL, {'page': 1, 'limit': 10}, BODY)
+    assert cache.load(URL, {'limit': 10, 'page': 1}) == BODY
+    assert cache.conditional_headers(URL, {'page': 1, 'limit': 10}) == {}
+
+
+def test_missing_body_is_not_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path), compression='gzip')
+    cache.store(URL, None, BODY, etag='"v1"')
+    for name in os.listdir(str(tmp_path / 'messages')):
+        if name.endswith('.body'):
+            os.remove(str(tmp_path / 'messages' / name))
+    assert cache.load(URL) is None
+
+
+def test_zstd_round_trip(tmp_path):
+    pytest.importorskip('zstandard')
+    cache = ResponseCache(str(tmp_path))
+    cache.store(URL, None, BODY)
+    assert cache.load(URL) == BODY
+    # the responses stored with another compression are still read
+    ResponseCache(str(tmp_path), compression='gzip').store(URL, None, BODY)
+    assert cache.load(URL) == BODY
+
+
+def test_gzip_without_zstandard(tmp_path, monkeypatch):
+    monkeypatch.setattr(response_cache, 'zstandard', None)
+    cache = ResponseCache(str(tmp_path))
+    cache.store(URL, None, BODY)
+    assert cache.load(URL) == BODY
+    assert cache._read_metadata(URL, None)['compression'] == 'gzip'
+    with pytest.raises(ImportError):
+        ResponseCache(str(tmp_path), compression='zstd')
+
+
+def test_zstd_responses_require_zstandard(tmp_path, monkeypatch):
+    pytest.importorskip('zstandard')
+    ResponseCache(str(tmp_path), compression='zstd').store(URL, None, BODY)
+    monkeypatch.setattr(response_cache, 'zstandard', None)
+    with pytest.raises(ImportError):
+        ResponseCache(str(tmp_path)).load(URL)
+
+
+def test_unknown_compression(tmp_path):
+    with pytest.raises(ValueError):
+        ResponseCache(str(tmp_path), compression='lz4')
+
+
+@pytest.mark.parametrize('stream_json', [False, True])
+def test_not_modified_pages_are_read_from_the_cache(tmp_path, stream_json):
+    cache = ResponseCache(str(tmp_path), compression='gzip')
+    session = RecordingSession([
+        make_response(200, BODY, {'ETag': '"v1"'}),
+        make_response(304)])
+    fetcher = ConcurrentPageFetcher(session, requests_per_second=None,
+                                    response_cache=cache,
+                                    stream_json=stream_json,
+                                    json_backend='scanner')
+    if stream_json:
+        # the streamed bodies are read through the raw response
+        for response in session.responses:
+            response.raw = RawBody(response._content)
+            response._content = False
+    expected = [{'id': 1}, {'id': 2}]
+
+    assert list(fetcher.iter_records(URL, {'page': 1})) == expected
+    assert cache.load(URL, {'page': 1}) == BODY
+    assert list(fetcher.iter_records(URL, {'page': 1})) == expected
+    assert session.headers == [{}, {'If-None-Match': '"v1"'}]
+
+
+def test_replay(tmp_path):
+    cache = ResponseCache(str(tmp_path), compression='gzip')
+    cache.store(URL, {'page': 1}, BODY, etag='"v1"')
+    session = RecordingSession([])
+    fetcher = ConcurrentPageFetcher(session, requests_per_second=None,
+                                    response_cache=cache, replay=True)
+
+    assert list(fetcher.iter_records(URL, {'page': 1})) == \
+        [{'id': 1}, {'id': 2}]
+    with pytest.raises(ApiFetchError):
+        list(fetcher.iter_records(URL, {'page': 2}))
+    assert session.headers == []
+
+
+def test_replay_requires_a_cache():
+    with pytest.raises(ValueError):
+        ConcurrentPageFetcher(RecordingSession([]), replay=True)
+
@@ -0,0 +1,92 @@
+"""
+Tests of the statement fingerprints and of the report of the QueryTracer.
+"""
+import pytest
+
+from tracing import QueryTracer, fingerprint
+
+
+@pytest.mark.parametrize('query, expected', [
+    # literals
+    ("SELECT * FROM users_raw WHERE city = 'Paris'",
+     'select * from users_raw where city = ?'),
+    ("SELECT * FROM t WHERE name = 'O''Brien' AND nick = 'a\\'b'",
+     'select * from t where name = ? and nick = ?'),
+    ('SELECT * FROM t WHERE name = "say \\"hi\\""',
+     'select * from t where name = ?'),
+    ('SELECT * FROM t WHERE id = %s AND city = %(city)s',
+     'select * from t where id = ? and city = ?'),
+    # numbers, not the digits of identifiers
+    ('SELECT * FROM users_raw WHERE user_id = 42',
+     'select * from users_raw where user_id = ?'),
+    ('SELECT col1 FROM t2 WHERE x > -1.5e3 AND y = 3.25',
+     'select col1 from t2 where x > ? and y = ?'),
+    # IN lists and multi-row statements, whatever their length
+    ('SELECT * FROM t WHERE id IN (1, 2, 3)',
+     'select * from t where id in (?+)'),
+    ('SELECT * FROM t WHERE id IN (%s,%s)',
+     'select * from t where id in (?+)'),
+    ('SELECT * FROM t WHERE (a, b) IN ((%s, %s), (%s, %s), (%s, %s))',
+     'select * from t where (a, b) in ((?+))'),
+    ('INSERT IGNORE INTO t (a, b) VALUES (%s, %s), (%s, %s)',
+     'insert ignore into t (a, b) values (?+)'),
+    ('SELECT v.value FROM (SELECT %s AS value UNION ALL SELECT %s '
+     'UNION ALL SELECT %s) v',
+     'select v.value from (select ? as value union all select ?+) v'),
+    # comments and whitespace
+    ('SELECT a\n  FROM t -- the table\n WHERE b = %s /* c */',
+     'select a from t where b = ?'),
+])
+def test_fingerprint(query, expected):
+    assert fingerprint(query) == expected
+
+
+def test_statements_differing_by_values_share_a_fingerprint():
+    assert fingerprint('SELECT * FROM t WHERE id IN (1, 2)') == \
+        fingerprint("select *  from t where id in ('a', 'b', 'c')")
+    assert fingerprint('SELECT * FROM t1 WHERE a = 1') != \
+        fingerprint('SELECT * FROM t2 WHERE a = 1')
+
+
+def make_tracer():
+    tracer = QueryTracer(slow_query_seconds=None)
+    for user_id in range(5):
+        tracer.record(f'SELECT * FROM users_raw WHERE user_id = {user_id}',
+                      0.01, rows=1)
+    tracer.record('INSERT INTO t (a) VALUES (%s), (%s)', 2.0, rows=2)
+    tracer.record('INSERT INTO t (a) VALUES (%s)', 1.0, rows=-1)
+    tracer.record('COMMIT', 0.5)
+    return tracer
+
+
+def report_statements(report):
+    # the first two lines are the headers
+    return [line.split('  ')[0] for line in report.splitlines()[2:]]
+
+
+@pytest.mark.parametrize('sort_by, top_n, expected', [
+    ('total_seconds', 10, ['insert into t (a) values (?+)', 'commit',
+                           'select * from users_raw where user_id = ?']),
+    ('total_seconds', 1, ['insert into t (a) values (?+)']),
+    ('calls', 2, ['select * from users_raw where user_id = ?',
+                  'insert into t (a) values (?+)']),
+])
+def test_report_top_n(sort_by, top_n, expected):
+    assert report_statements(make_tracer().report(top_n=top_n,
+                                                  sort_by=sort_by)) == expected
+
+
+def test_stats():
+    stats = {stats['fingerprint']: stats for stats in make_tracer().stats()}
+    insert = stats['insert into t (a) values (?+)']
+    assert (insert['calls'], insert['total_seconds'], insert['max_seconds'],
+            insert['mean_seconds'], insert['rows']) == (2, 3.0, 2.0, 1.5, 2)
+    assert stats['select * from users_raw where user_id = ?']['rows'] == 5
+
+
+def test_report_truncates_statements():
+    tracer = QueryTracer(slow_query_seconds=None)
+    tracer.record('SELECT ' + ', '.join(f'column_{i}' for i in range(50)) +
+                  ' FROM t', 0.1)
+    statement, = report_statements(tracer.report(max_width=40))
+    assert len(statement) == 40 and statement.endswith('...')
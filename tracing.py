@@ -0,0 +1,152 @@
+"""
+This module contains the QueryTracer, which can be plugged into a
+MySqlDbConnector (see its query_tracer argument) to trace all the statements
+sent to the database. The statements are grouped by fingerprint, i.e. the
+statement with its literals and placeholders replaced by '?' and its lists of
+values collapsed, so that the same statement run with different values (e.g. a
+lookup run once per record) shows up as a single entry with a high call count.
+Statements slower than a threshold are logged in full, and a report of the most
+expensive fingerprints can be printed at the end of the run.
+"""
+import re
+import threading
+from tabulate import tabulate
+
+
+_COMMENT = re.compile(r'/\*.*?\*/|--[^\n]*|#[^\n]*', re.DOTALL)
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b')
+_PLACEHOLDER = re.compile(r'%s|%\(\w+\)s')
+_WHITESPACE = re.compile(r'\s+')
+# a parenthesised list of values, e.g. (?, ?, ?), and repetitions of these,
+# e.g. the rows of a multi-row INSERT or of an IN list of tuples
+_VALUE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_REPEATED_LISTS = re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+')
+_REPEATED_UNIONS = re.compile(r'(select \? as \w+)(?: union all select \?)+')
+
+
+def fingerprint(query):
+    """
+    Function to get the fingerprint of a statement: the statement without
+    comments, in lower case with collapsed whitespace, with its literals and
+    placeholders replaced by '?' and its lists of values replaced by '(?+)', so
+    that the statements only differing by their values or by their number of
+    rows have the same fingerprint.
+
+    :param query: The statement.
+    """
+    query = _COMMENT.sub(' ', query)
+    query = _STRING_LITERAL.sub('?', query)
+    query = _PLACEHOLDER.sub('?', query)
+    query = _NUMBER.sub('?', query)
+    query = _WHITESPACE.sub(' ', query).strip().lower()
+    query = _VALUE_LIST.sub('(?+)', query)
+    query = _REPEATED_LISTS.sub('(?+)', query)
+    query = _REPEATED_UNIONS.sub(r'\1 union all select ?+', query)
+    return query
+
+
+class QueryTracer:
+    """
+    This class accumulates, per statement fingerprint, the number of calls, the
+    total and maximum latency and the number of rows returned (for queries) or
+    affected (for the other statements). It can be shared between threads.
+
+    Only the statements are logged, not their parameters, as these can hold the
+    PII of the sensitive tables.
+    """
+    def __init__(self, slow_query_seconds=1.0, max_logged_length=2000):
+        """
+        :param slow_query_seconds: The latency above which a statement is
+                                   logged in full. Nothing is logged if None.
+        :param max_logged_length: The maximum number of characters logged for
+                                  a slow statement (e.g. for the multi-row
+                                  INSERTs), or None to log them entirely.
+        """
+        self._slow_query_seconds = slow_query_seconds
+        self._max_logged_length = max_logged_length
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, query, duration, rows=None, params_count=0):
+        """
+        Method called by the connector for each statement executed.
+
+        :param query: The statement executed.
+        :param duration: The latency of the statement (in seconds), including
+                         the fetching of its results.
+        :param rows: The number of rows returned or affected, negative or None
+                     if unknown.
+        :param params_count: The number of parameters of the statement.
+        """
+        key = fingerprint(query)
+        if rows is not None and rows < 0:
+            rows = None
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {'calls': 0, 'total_seconds': 0.0,
+                                            'max_seconds': 0.0, 'rows': 0,
+                                            'slow_calls': 0}
+            stats['calls'] += 1
+            stats['total_seconds'] += duration
+            stats['max_seconds'] = max(stats['max_seconds'], duration)
+            if rows is not None:
+                stats['rows'] += rows
+            is_slow = (self._slow_query_seconds is not None and
+                       duration >= self._slow_query_seconds)
+            if is_slow:
+                stats['slow_calls'] += 1
+
+        if is_slow:
+            statement = _WHITESPACE.sub(' ', query).strip()
+            if self._max_logged_length and \
+                    len(statement) > self._max_logged_length:
+                statement = (statement[:self._max_logged_length] +
+                             f'... ({len(statement)} characters)')
+            print(f'slow query ({duration:.3f}s, {params_count} parameters, '
+                  f'{rows if rows is not None else "?"} rows): {statement}')
+
+    def stats(self):
+        """
+        Method to get the statistics of all the fingerprints, as a list of
+        dictionaries with the keys fingerprint, calls, total_seconds,
+        max_seconds, mean_seconds, rows and slow_calls.
+        """
+        with self._lock:
+            return [dict(stats, fingerprint=key,
+                         mean_seconds=stats['total_seconds'] / stats['calls'])
+                    for key, stats in self._stats.items()]
+
+    def report(self, top_n=10, sort_by='total_seconds', max_width=100):
+        """
+        Method to get a table of the top_n fingerprints with the highest
+        sort_by, e.g. 'total_seconds' for the most expensive statements or
+        'calls' for the statements run once per record.
+
+        :param top_n: The number of fingerprints in the report.
+        :param sort_by: The statistic by which the fingerprints are ranked.
+        :param max_width: The maximum number of characters of the fingerprints
+                          shown.
+        """
+        rows = []
+        for stats in sorted(self.stats(), key=lambda stats: stats[sort_by],
+                            reverse=True)[:top_n]:
+            statement = stats['fingerprint']
+            if max_width and len(statement) > max_width:
+                statement = statement[:max_width - 3] + '...'
+            rows.append([statement, stats['calls'],
+                         round(stats['total_seconds'], 3),
+                         round(stats['mean_seconds'] * 1000, 2),
+                         round(stats['max_seconds'] * 1000, 2),
+                         stats['rows'], stats['slow_calls']])
+        return tabulate(rows, headers=['statement', 'calls', 'total (s)',
+                                       'mean (ms)', 'max (ms)', 'rows',
+                                       'slow'])
+
+    def reset(self):
+        """
+        Method to clear the statistics, e.g. between two runs.
+        """
+        with self._lock:
+            self._stats.clear()
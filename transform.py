@@ -5,10 +5,64 @@ the data coming from the API. In particular the functions to handle PII
 """
 
 from glob import glob
-from connectors import MySqlDbConnector
+import metrics
+from connectors import MySqlDbConnector, iter_batches, record_position
+from masking import MaskIdCache
 
 
-def sanitize_sensitive_data_users(users_data, root_password):
+def _sanitize_user_batch(batch, masker, subscriptions=None):
+    """
+    Convenience function to remove / mask the PII fields of a batch of users
+    (see sanitize_sensitive_data_users). The masking ids of all the values in
+    the batch are obtained together from the masker.
+
+    :param batch: A list of dictionaries specifiying user data records as
+                  obtained directly from the API.
+    :param masker: The MaskIdCache or HmacMasker to get the masking ids from.
+    :param subscriptions: If a list is given, the subscriptions of the users
+                          (see get_subscription_data) are appended to it in
+                          the same pass over the batch.
+    """
+    metrics.inc('users_sanitized_total', len(batch))
+    sensitive_fields_remove = ['firstName', 'lastName', 'address']
+    batch = [{k: v for k, v in user_data.items() 
+              if k not in sensitive_fields_remove}
+             for user_data in batch]
+    cities = [user_data.get('city') for user_data in batch]
+    zipcodes = [user_data.get('zipCode') for user_data in batch]
+    professions = [user_data.get('profile', {}).get('profession')
+                   for user_data in batch]
+    city_ids = masker.get_ids('city', filter(None, cities))
+    zipcode_ids = masker.get_ids('zipcode', filter(None, zipcodes))
+    profession_ids = masker.get_ids('profession', filter(None, professions))
+
+    for user_data, city, zipcode, profession in zip(batch, cities,
+                                                    zipcodes, professions):
+        if subscriptions is not None:
+            subscriptions.extend(_get_user_subscriptions(user_data))
+        email = user_data.get('email')
+        if city:
+            user_data['city'] = city_ids[city]
+        if zipcode:
+            user_data['zipcode'] = zipcode_ids[zipcode]
+        if profession:
+            user_data['profile'] = dict(user_data['profile'],
+                                        profession=profession_ids[profession])
+        if email and '@' in email:
+            email_domain = email.split('@')[1]
+            user_data['email'] = email_domain
+        else:
+            user_data['email'] = None
+            metrics.inc('emails_without_domain_total')
+
+    return batch
+
+
+def sanitize_sensitive_data_users(users_data,
+                                  root_password,
+                                  db_connector=None,
+                                  masker=None,
+                                  batch_size=1000):
     """
     This function processes the user data coming from the API to remove or
     mask the PII fields. In particular, the fields 'firstName', 'lastName' and
@@ -17,44 +71,49 @@ def sanitize_sensitive_data_users(users_data, root_password):
     numeric value, generated and stored in the database. The actual ID to value
     mapping for these fields will be only accessible to the root user (or any
     other service user which is non-human) that will be executing this code.
+    The users are processed in batches, and the masking ids of all the values
+    in a batch are obtained together from the masker, which implements one of
+    the masking strategies of the module masking.py.
 
     :param users_data: A list of dictionaries specifiying user data records 
                        as obtained directly from the API. This will contain
                        PII information.
+    :param root_password: The root password to use when connecting to database.
+    :param db_connector: The database connector (connected as root) to use, if
+                         already available.
+    :param masker: The MaskIdCache or HmacMasker to get the masking ids from.
+                   If not provided, a new MaskIdCache is created (and
+                   preloaded).
+    :param batch_size: The number of users for which the masking ids are
+                       obtained together.
     """
-    sensitive_fields_remove = ['firstName', 'lastName', 'address']
-    db_connector = MySqlDbConnector(username='root', password=root_password)
+    if masker is None:
+        if db_connector is None:
+            db_connector = MySqlDbConnector(username='root',
+                                            password=root_password)
+        masker = MaskIdCache(db_connector)
     sanitized_user_data = []
-    for user_data in users_data.copy():
-        user_data = {k: v for k, v in user_data.items() 
-                     if k not in sensitive_fields_remove}
-        city = user_data.get('city')
-        zipcode = user_data.get('zipCode')
-        email = user_data.get('email')
-        profession = user_data.get('profile', {}).get('profession')
-    
-        if city:
-            city_id = db_connector.get_or_create_mask_id('sensitive_city_ids',
-                                                          {'city': city})
-            user_data['city'] = city_id
-        if zipcode:
-            zipcode_id = db_connector.get_or_create_mask_id('sensitive_zipcode_ids',
-                                                            {'zipcode': zipcode})
-            user_data['zipcode'] = zipcode_id
-        if profession:
-            profession_id = db_connector.get_or_create_mask_id('sensitive_profession_ids',
-                                                               {'profession': profession})
-            user_data['profile']['profession'] = profession_id
-        if email and '@' in email:
-            email_domain = email.split('@')[1]
-            user_data['email'] = email_domain
-        else:
-            user_data['email'] = None
-        sanitized_user_data.append(user_data)
+    for batch in iter_batches(users_data, batch_size):
+        sanitized_user_data.extend(_sanitize_user_batch(batch, masker))
 
     return sanitized_user_data
 
 
+def _get_user_subscriptions(user_data):
+    """
+    Convenience function to get the subscriptions of a single user, each with
+    the id of the user added.
+
+    :param user_data: A dictionary specifying a user record as obtained from
+                      the API.
+    """
+    user_id = user_data.get('id')
+    subscriptions = user_data.get('subscription')
+    if not subscriptions:
+        return []
+    return [dict(item, **{'user_id': user_id}) for item in subscriptions]
+
+
 def get_subscription_data(users_data):
     """
     Function to parse the subscription related data from the user data coming 
@@ -65,32 +124,83 @@ def get_subscription_data(users_data):
     """
     all_subscription_data = []
     for user_data in users_data:
-        user_id = user_data.get('id')
-        subscriptions = user_data.get('subscription')
-        if subscriptions:
-            subscriptions  = [dict(item, **{'user_id': user_id}) 
-                              for item in subscriptions]
-            all_subscription_data.extend(subscriptions)
+        all_subscription_data.extend(_get_user_subscriptions(user_data))
     
     return all_subscription_data
 
+
+def iter_sanitized_user_chunks(users_data, masker, chunk_size=1000):
+    """
+    Generator stage of the streaming pipeline: splits the users coming from
+    the API into chunks, and for each chunk yields the sanitised users (see
+    sanitize_sensitive_data_users) together with their subscriptions (see
+    get_subscription_data), both obtained in a single pass over the chunk.
+    Only one chunk is held in memory at a time.
+
+    :param users_data: An iterable of dictionaries specifiying user data
+                       records as obtained directly from the API.
+    :param masker: The MaskIdCache or HmacMasker to get the masking ids from.
+    :param chunk_size: The number of users per chunk.
+    """
+    for chunk in iter_batches(users_data, chunk_size):
+        subscriptions = []
+        sanitized_users = _sanitize_user_batch(chunk, masker, subscriptions)
+        yield sanitized_users, subscriptions
+
+
+def get_latest_record(records, timestamp_field):
+    """
+    Function to find the latest of a list of API records, by timestamp and
+    then by id. Used to compute the high-water mark of an end point after its
+    records are loaded.
+
+    :param records: A list of dictionaries specifying API records.
+    :param timestamp_field: The field holding the timestamp of the records.
+    :return: A (timestamp, id) tuple of the latest record, or None if there
+             are no records.
+    """
+    if not records:
+        return None
+    latest = max(records,
+                 key=lambda record: record_position(record, timestamp_field))
+    return latest.get(timestamp_field), latest.get('id')
+
 def create_monitoring_views(db_user, 
                             db_password, 
-                            query_base_path='sql_queries/monitoring'):
+                            query_base_path='sql_queries/monitoring',
+                            db_connector=None,
+                            materialized=False,
+                            loaded_since=None):
     """
     Create a set of views which are expected to be stored as
     .sql files in the path specified by parameter query_base_path. Each 
     file within the query_base_path is expected to be query to create a single
     monitoring view.
 
+    In materialized mode, the result of each query is stored in a backing table
+    read by the view (see MySqlDbConnector.refresh_materialized_view). If
+    loaded_since is given, only the rows loaded since then are added to the
+    backing tables, otherwise these are rebuilt.
+
     :param db_user: The username to use when connecting to database.
     :param db_password: The password to use when connecting to database.
     :param query_base_path: The path to the folder containing the queries to 
                             be executed.
+    :param db_connector: The database connector to use, if already available.
+    :param materialized: Flag to specify if the query results are to be stored
+                         in backing tables, rather than run on every read.
+    :param loaded_since: The start time of the current run, for incremental
+                         refreshes of the backing tables.
     """
-    db_connector = MySqlDbConnector(username=db_user, password=db_password)
+    if db_connector is None:
+        db_connector = MySqlDbConnector(username=db_user, password=db_password)
     sql_files = glob(query_base_path + '/*')
     for file in sql_files:
         view_name = file.split('/')[-1].replace('.sql', '')
         query = open(file, 'r').read()
-        db_connector.create_view(view_name=view_name, sql_query=query)
\ No newline at end of file
+        if materialized:
+            db_connector.refresh_materialized_view(view_name=view_name,
+                                                   sql_query=query,
+                                                   loaded_since=loaded_since)
+        else:
+            db_connector.create_view(view_name=view_name, sql_query=query)